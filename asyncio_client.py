@@ -0,0 +1,293 @@
+import socket
+import config
+import logging
+import requests
+import torrent_exceptions
+import events
+from peer import Peer
+from disk_io import DiskQueue
+from functools import partial
+from strategies import TorrentManager
+from requests.exceptions import RequestException
+
+try:
+    import asyncio
+except ImportError:  # Python 2
+    import trollius as asyncio
+
+logger = logging.getLogger(__name__)
+
+# BufferedProtocol lets the loop read straight into a peer's inbox; older
+# asyncio and trollius only have Protocol, which hands over a copy
+_Protocol = getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)
+
+
+def new_event_loop():
+    '''The loop the engine runs on -- uvloop's if it's installed and
+    config.USE_UVLOOP is set'''
+    if config.USE_UVLOOP:
+        try:
+            import uvloop
+        except ImportError:
+            logger.info('uvloop not installed, using the default loop')
+        else:
+            return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+class AsyncioBitTorrentClient(torrent_exceptions.ExceptionManager,
+                              events.EventManager,
+                              object):
+    '''Alternative to BitTorrentClient that hands sockets, timers and
+    tracker requests to an asyncio loop. It offers the same connect,
+    add_timer and make_tracker_request surface, so the strategies don't
+    need to know which engine they run under.'''
+
+    def __init__(self, port=config.DEFAULT_PORT, client_id=config.CLIENT_ID,
+                 loop=None):
+        self.port,  self.client_id = port,  client_id
+        self.loop = loop if loop is not None else new_event_loop()
+        self.managers = set()  # strategy managers
+        self.disk = DiskQueue(self.loop.call_soon_threadsafe)
+        logger.info('Starting up on port %d', port)
+
+        self._server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: PeerProtocol(self),
+                                    socket.gethostname(), self.port,
+                                    reuse_address=True,
+                                    backlog=config.MAX_LISTEN))
+
+        # peers that haven't been matched to a torrent yet
+        self._exception_handlers = {
+            torrent_exceptions.ConnectionLost:
+            lambda e: self._drop_connection(e.peer),
+
+            torrent_exceptions.FatallyFlawedIncomingMessage:
+            lambda e: self._drop_connection(e.peer),
+
+            torrent_exceptions.FatallyFlawedOutgoingMessage:
+            lambda e: self._drop_connection(e.peer)
+            }
+
+        self._event_handlers = {
+            events.UnknownPeerHandshake: self._unknown_peer_callback}
+
+    def __str__(self):
+        return "<Joe's BitTorrent Client (asyncio)--{0}>".format(
+            self.client_id)
+
+    def start_torrent(self, filename, options=None):
+        '''Takes a filename for a torrent file and processes that file'''
+
+        logger.info('Adding torrent described by %s', filename)
+        self.managers.add(TorrentManager(self, filename, options))
+
+    def connect(self, address, callback):
+        '''Opens a non-blocking connection to a peer address and calls
+        callback with the new Peer once it is established'''
+        connecting = self.loop.create_task(
+            self.loop.create_connection(lambda: PeerProtocol(self, callback),
+                                        *address))
+        connecting.add_done_callback(
+            partial(self._connection_done, address))
+
+    def add_timer(self, interval, callback, exception_handler, repeat=False):
+        '''Adds a callback to fire in a specified time -- and every interval
+        thereafter if repeat is set. Returns a handle with cancel() and
+        reschedule(delay).'''
+        logger.info('Adding a callback in %d seconds: %s', interval, callback)
+        return LoopTimer(self.loop, interval, callback, exception_handler,
+                         repeat)
+
+    def make_tracker_request(self, url, data, handler, e_handler):
+        '''Runs the announce in the loop's executor and calls handler on
+        the response, or e_handler on an http error, back on the loop'''
+
+        logger.info('Making tracker request to %s', url)
+
+        future = self.loop.run_in_executor(None, partial(requests.get, url,
+                                                         params=data))
+        future.add_done_callback(
+            partial(self._handle_http_response, handler, e_handler))
+
+    def run_loop(self):
+        '''Main loop'''
+        logger.info('Beginning main loop...')
+        try:
+            self.loop.run_forever()
+        finally:
+            self._server.close()
+
+    def _connection_done(self, address, future):
+        try:
+            future.result()
+        except (OSError, socket.error) as e:
+            logger.info('Could not connect to %s: %s', address, e)
+
+    def _handle_http_response(self, handler, e_handler, future):
+        try:
+            response = future.result()
+            response.raise_for_status()
+        except RequestException as e:
+            e_handler(e)
+        else:
+            handler(response)
+
+    def _drop_connection(self, peer):
+        logger.info('Dropping %s', peer)
+        peer.drop()
+
+    def _unknown_peer_callback(self, e):
+        peer, msg = e.peer, e.msg
+
+        for manager in self.managers:
+            if manager.hashed_info == msg.info_hash:
+                manager.register_unknown_peer(peer)
+                break
+        else:
+            # not interested in any of our torrents
+            peer.drop()
+
+
+class PeerProtocol(_Protocol, events.EventManager,
+                   torrent_exceptions.ExceptionManager):
+    '''Connects a Peer to an asyncio transport. The peer keeps parsing and
+    dispatching messages exactly as it does under the reactor; this just
+    feeds it data and drains its outbox into the transport until the
+    transport's buffer passes its high-water mark and it pauses writing.
+    What's left stays in the outbox, where the strategy sees it backing
+    up just as it would under the reactor.'''
+
+    def __init__(self, client, on_connected=None):
+        self.event_observer = client
+        self.next_exception_level = client
+        self._exception_handlers = {}
+        self.peer = None
+        self._loop = client.loop
+        self._on_connected = on_connected
+        self._flush_scheduled = False
+        self._paused = False  # the transport's buffer is full
+
+        self._event_handlers = {
+            events.PeerRegistration: lambda ev: None,  # transport is ours
+            events.PeerReadyToSend: lambda ev: self._schedule_flush(),
+            events.PeerDoneSending: lambda ev: None,
+            events.PeerDropped: lambda ev: None
+            }
+
+    def connection_made(self, transport):
+        self.peer = Peer(_TransportSocket(transport), self)
+        if self._on_connected is not None:
+            self._on_connected(self.peer)
+
+    def get_buffer(self, sizehint):
+        return self.peer.inbox.writable(config.DEFAULT_READ_AMOUNT)
+
+    def buffer_updated(self, nbytes):
+        try:
+            self.peer.received_into(nbytes)
+        except Exception as e:
+            self.peer.handle_exception(e)
+
+    def data_received(self, data):
+        try:
+            self.peer.receive(data)
+        except Exception as e:
+            self.peer.handle_exception(e)
+
+    def connection_lost(self, exc):
+        logger.info('Lost connection to %s', self.peer)
+        if self.peer.active:  # closed from the other end
+            self.peer.handle_error(torrent_exceptions.ConnectionLost(
+                str(exc) if exc else 'closed by peer'))
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # coalesces every message enqueued this pass into one write
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        # each send takes at most config.SEND_IOV_MAX buffers, or a slice
+        # of a file, so keep going until the outbox or the transport is
+        # done
+        self._flush_scheduled = False
+        peer = self.peer
+        try:
+            while peer.active and peer.outbox and not self._paused:
+                peer.handle_outgoing()
+        except Exception as e:
+            peer.handle_exception(e)
+
+
+class _TransportSocket(object):
+    '''The slice of the socket interface Peer uses, backed by a transport.
+    Transports buffer whatever they're given, so every send is complete.
+    Sending from files has to go through the transport too, to keep its
+    place in the stream.'''
+
+    accepts_sendfile = False
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._socket = transport.get_extra_info('socket')
+
+    def getpeername(self):
+        return self._transport.get_extra_info('peername')
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def send(self, data):
+        self._transport.write(data)
+        return len(data)
+
+    def sendmsg(self, buffers):
+        self._transport.writelines(buffers)
+        return sum(len(b) for b in buffers)
+
+    def close(self):
+        self._transport.close()
+
+
+class LoopTimer(object):
+    '''Timer handle on top of loop.call_later, mirroring timers.Timer'''
+
+    def __init__(self, loop, delay, callback, exception_handler, repeat):
+        if repeat and delay <= 0:
+            raise ValueError('repeating timers need a positive interval')
+        self.callback = callback
+        self.exception_handler = exception_handler
+        self.interval = delay if repeat else None
+        self._loop = loop
+        self._handle = None
+        self.reschedule(delay)
+
+    @property
+    def active(self):
+        return self._handle is not None
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def reschedule(self, delay):
+        self.cancel()
+        self._handle = self._loop.call_later(delay, self._fire)
+
+    def _fire(self):
+        self._handle = None
+        if self.interval is not None:
+            self.reschedule(self.interval)
+        try:
+            self.callback()
+        except Exception as e:
+            self.exception_handler(e)
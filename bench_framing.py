@@ -0,0 +1,80 @@
+'''Microbenchmark for framing.FrameDecoder.
+
+Replays a recorded peer stream -- the raw bytes one side of a connection
+sent, handshake first, e.g. as dumped by tcpflow -- through a decoder in
+recv-sized chunks and reports frames per second. Without a recording it
+replays a synthetic stream shaped like a download: a handshake, a bitfield,
+then Piece blocks interleaved with Haves and the odd KeepAlive.
+
+    $ python bench_framing.py [--messages] [--chunk N] [recording]
+'''
+
+import struct
+import timeit
+import argparse
+import config
+from framing import FrameDecoder
+
+
+def synthetic_stream(blocks=2000, block_size=2**14, num_pieces=4096):
+    frames = [b'\x13BitTorrent protocol' + b'\x00' * 8 + b'i' * 20 +
+              b'p' * 20]
+
+    bitfield = b'\xff' * (num_pieces // 8)
+    frames.append(struct.pack('>IB', len(bitfield) + 1, 5) + bitfield)
+    frames.append(struct.pack('>IB', 1, 1))  # unchoke
+
+    block = b'\xab' * block_size
+    for i in range(blocks):
+        index, begin = divmod(i, 16)
+        frames.append(struct.pack('>IBII', len(block) + 9, 7, index,
+                                  begin * block_size) + block)
+        frames.append(struct.pack('>IBI', 5, 4, i % num_pieces))  # have
+        if i % 100 == 0:
+            frames.append(struct.pack('>I', 0))  # keepalive
+
+    return b''.join(frames)
+
+
+def replay(stream, chunk, build_messages):
+    decoder = FrameDecoder()
+    decode = decoder.messages if build_messages else decoder.frames
+    count = 0
+    for start in range(0, len(stream), chunk):
+        decoder.buffer.feed(stream[start:start+chunk])
+        for _ in decode():
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('recording', nargs='?',
+                        help='raw bytes of one direction of a connection')
+    parser.add_argument('--chunk', type=int,
+                        default=config.DEFAULT_READ_AMOUNT,
+                        help='bytes per simulated recv')
+    parser.add_argument('--messages', action='store_true',
+                        help='build message objects, not just frames')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.recording:
+        with open(args.recording, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = synthetic_stream()
+
+    count = replay(stream, args.chunk, args.messages)
+    best = min(timeit.repeat(
+        lambda: replay(stream, args.chunk, args.messages),
+        number=1, repeat=args.repeat))
+
+    print('{0} frames, {1:.1f} MiB in {2}-byte chunks'.format(
+        count, len(stream) / 2.0**20, args.chunk))
+    print('{0:,.0f} frames/s, {1:,.1f} MiB/s (best of {2})'.format(
+        count / best, len(stream) / 2.0**20 / best, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+'''Microbenchmark for piece_picker.PiecePicker.
+
+Has a swarm of peers arrive at a torrent of --pieces pieces with their
+bitfields -- a few seeds, most partway through, a few with only a handful
+of pieces -- and times adding each of them. Then times picks for random
+peers while Haves keep arriving, the way a strategy tops up requests as
+blocks come in, and now and then a peer leaves and another takes its place.
+Means are reported along with the worst case.
+
+    $ python bench_picker.py [--pieces N] [--peers N] [--count N]
+'''
+
+import numpy
+import random
+import timeit
+import argparse
+from bitarray import bitarray
+from piece_picker import PiecePicker
+
+
+def swarm(num_pieces, num_peers, seed=1):
+    '''Bitfields for num_peers peers: one in ten a seed, one in ten with
+    a few pieces, the rest anywhere from 10% to 90% done'''
+    rng = numpy.random.RandomState(seed)
+    peers = []
+    for i in range(num_peers):
+        if i % 10 == 0:
+            done = 1.0
+        elif i % 10 == 1:
+            done = 0.001
+        else:
+            done = rng.uniform(0.1, 0.9)
+        has = bitarray()
+        has.frombytes(numpy.packbits(rng.random_sample(num_pieces) < done)
+                      .tobytes())
+        peers.append(has[:num_pieces])
+    return peers
+
+
+def timed(call, *args):
+    start = timeit.default_timer()
+    call(*args)
+    return timeit.default_timer() - start
+
+
+def run(num_pieces, peers, count, rounds, seed=2):
+    '''Seconds taken by each bitfield added, and by each pick'''
+    rng = random.Random(seed)
+    picker = PiecePicker(num_pieces)
+    peers = [has.copy() for has in peers]
+    adds = [timed(picker.add_pieces, has) for has in peers]
+
+    partial = set(rng.sample(range(num_pieces), 20))
+    picks = []
+    for i in range(rounds):
+        has = rng.choice(peers)
+        index = rng.randrange(num_pieces)
+        if not has[index]:
+            has[index] = True
+            picker.increment(index)
+        if i % 100 == 99:  # churn
+            adds.append(timed(picker.remove_pieces, has))
+            adds.append(timed(picker.add_pieces, has))
+        picks.append(timed(picker.pick, has, count, partial))
+    return adds, picks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pieces', type=int, default=200000)
+    parser.add_argument('--peers', type=int, default=500)
+    parser.add_argument('--count', type=int, default=4,
+                        help='pieces wanted per pick')
+    parser.add_argument('--rounds', type=int, default=2000,
+                        help='picks timed')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    peers = swarm(args.pieces, args.peers)
+    adds, picks = [], []
+    for _ in range(args.repeat):
+        run_adds, run_picks = run(args.pieces, peers, args.count,
+                                  args.rounds)
+        adds.append(run_adds)
+        picks.append(run_picks)
+    # the run with the best mean, so one noisy run doesn't count
+    adds = min(adds, key=sum)
+    picks = min(picks, key=sum)
+
+    print('{0} pieces, {1} peers, {2} pieces a pick (best of {3})'.format(
+        args.pieces, args.peers, args.count, args.repeat))
+    print('{0} bitfields added or removed: {1:.3f} ms each, '
+          'longest {2:.3f} ms'.format(len(adds), sum(adds) / len(adds) * 1e3,
+                                      max(adds) * 1e3))
+    print('{0} picks: {1:.1f} us each, longest {2:.3f} ms'.format(
+        len(picks), sum(picks) / len(picks) * 1e6, max(picks) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
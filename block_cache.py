@@ -0,0 +1,168 @@
+import config
+import logging
+from hashlib import sha1
+from collections import OrderedDict
+
+'''Blocks of unfinished pieces, held in memory until the piece can be hashed
+and written out whole. One cache is shared by every torrent, so the memory
+budget is global; when it's exceeded the pieces written to least recently
+-- the stalled ones -- go to disk early, and finishing them means reading
+them back.
+
+Pieces are hashed as they fill in: whenever the run of blocks from the
+start of a piece grows, the new bytes go into the piece's running SHA-1.
+Blocks are requested in order within a piece, so by the time the last one
+lands there's usually nothing left to hash.'''
+
+logger = logging.getLogger(__name__)
+
+_DISK_SHARE = 2  # pieces queued for disk may fill 1/2 of the budget
+
+
+class CachedPiece(object):
+    '''A piece's buffer, which of its blocks are in it, and the hash of
+    the blocks in order so far'''
+
+    __slots__ = ('data', 'filled', 'hashed', '_hash', '_block_size',
+                 '_blocks')
+
+    def __init__(self, length, block_size):
+        self.data = bytearray(length)
+        self.filled = 0  # bytes of blocks in the buffer
+        self.hashed = 0  # bytes from the start fed to the hash
+        self._hash = sha1()
+        self._block_size = block_size
+        self._blocks = bytearray(-(-length // block_size))
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def complete(self):
+        return self.filled == len(self.data)
+
+    def put(self, begin, block):
+        first = begin // self._block_size
+        last = -(-(begin + len(block)) // self._block_size)
+        self.data[begin:begin + len(block)] = block
+        for b in range(first, last):
+            if not self._blocks[b]:
+                self._blocks[b] = 1
+                self.filled += min(self._block_size,
+                                   len(self.data) - b * self._block_size)
+        if first * self._block_size == self.hashed:
+            self._advance_hash(last)
+
+    def digest(self):
+        '''SHA-1 of the piece; only once it's complete'''
+        if self.hashed < len(self.data):
+            self._advance_hash(0)  # blocks may have landed out of order
+        return self._hash.digest()
+
+    def runs(self):
+        '''(begin, end) of each stretch of consecutive blocks in the
+        buffer, so each can go to disk in one write'''
+        size, blocks, start = self._block_size, self._blocks, None
+        for b in range(len(blocks) + 1):
+            if b < len(blocks) and blocks[b]:
+                if start is None:
+                    start = b
+            elif start is not None:
+                yield start * size, min(b * size, len(self.data))
+                start = None
+
+    def _advance_hash(self, block):
+        '''Hashes on through block and any consecutive blocks after it'''
+        blocks = self._blocks
+        block = max(block, self.hashed // self._block_size)
+        while block < len(blocks) and blocks[block]:
+            block += 1
+        end = min(block * self._block_size, len(self.data))
+        if end > self.hashed:
+            self._hash.update(memoryview(self.data)[self.hashed:end])
+            self.hashed = end
+
+
+class BlockCache(object):
+    '''Pieces by (owner, index), least recently written to first. Owners
+    are FileHandlers; over budget, a piece is handed to its owner's
+    flush_cached and forgotten.
+
+    Pieces taken out to be checked still count against the budget until
+    their owner releases them, once the disk job holding them is done.
+    Evicted pieces are already on their way out, so evicting more for
+    them wouldn't help; but they count towards the cache being full,
+    which is when pieces waiting on the disk take up a share of the
+    budget and torrents stop asking for more blocks.'''
+
+    def __init__(self, budget=config.CACHE_SIZE,
+                 block_size=config.MAX_REQUEST_AMOUNT):
+        self.budget = budget
+        self.block_size = block_size
+        self.size = 0  # bytes of buffers held in the cache
+        self.in_flight = 0  # bytes of buffers taken out and not released
+        self.evictions = 0  # pieces written out unfinished
+        self._pieces = OrderedDict()
+        self._evicted = set()  # pieces evicted and not released
+        self._evicting = 0  # and their bytes
+
+    def __len__(self):
+        return len(self._pieces)
+
+    def put(self, owner, index, length, begin, block):
+        '''Copies a block of the length byte piece into the cache'''
+        key = owner, index
+        piece = self._pieces.pop(key, None)
+        if piece is None:
+            piece = CachedPiece(length, self.block_size)
+            self.size += length
+        piece.put(begin, block)
+        self._pieces[key] = piece  # now the most recently written
+        self._trim()
+
+    @property
+    def full(self):
+        return self.in_flight * _DISK_SHARE >= self.budget
+
+    def take(self, owner, index):
+        '''Removes the piece and returns it, or None if it isn't held.
+        Hand it back to release once it's done with.'''
+        piece = self._pieces.pop((owner, index), None)
+        if piece is not None:
+            self.size -= len(piece)
+            self.in_flight += len(piece)
+        return piece
+
+    def release(self, piece):
+        self.in_flight -= len(piece)
+        if piece in self._evicted:
+            self._evicted.remove(piece)
+            self._evicting -= len(piece)
+
+    def flush(self, owner):
+        '''Writes out all of owner's pieces, say before it closes'''
+        for key in [key for key in self._pieces if key[0] is owner]:
+            owner.flush_cached(key[1], self.take(*key))
+
+    def _trim(self):
+        while self.size + self.in_flight - self._evicting > self.budget \
+                and self._pieces:
+            (owner, index), piece = self._pieces.popitem(last=False)
+            self.size -= len(piece)
+            self.in_flight += len(piece)
+            self._evicted.add(piece)
+            self._evicting += len(piece)
+            self.evictions += 1
+            logger.debug('Flushing unfinished piece %d to make room', index)
+            owner.flush_cached(index, piece)
+
+
+_shared = None
+
+
+def shared_cache():
+    '''The cache every torrent's FileHandler uses unless given its own'''
+    global _shared
+    if _shared is None:
+        _shared = BlockCache()
+    return _shared
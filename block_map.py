@@ -0,0 +1,193 @@
+import config
+from array import array
+
+'''Where every block of a torrent stands. States are one byte per block in
+a single flat array, found through a per-piece offset table, and only
+blocks actually in flight have an entry saying who they were asked of --
+so the map stays small however many blocks the torrent has.'''
+
+MISSING = 0
+REQUESTED = 1
+RECEIVED = 2
+VERIFIED = 3
+
+_MISSING = bytearray([MISSING])
+
+
+class BlockMap(object):
+    '''Tracks each block from missing to verified. Each piece keeps a
+    cursor at its first block that might still be missing, so the next
+    block to request is found without scanning the piece.'''
+
+    def __init__(self, piece_lengths, block_size=config.MAX_REQUEST_AMOUNT):
+        self.block_size = block_size
+        self._piece_lengths = piece_lengths
+
+        self._first = array('l', [0])  # first block of each piece
+        for length in piece_lengths:
+            self._first.append(self._first[-1] - (-length // block_size))
+
+        blocks = self._first[-1]
+        self._state = bytearray(blocks)
+        self._cursor = array('l', [0]) * len(piece_lengths)
+        self._received = array('l', [0]) * len(piece_lengths)
+        self._wanted = bytearray([1]) * len(piece_lengths)
+
+        # of the pieces we want
+        self.remaining = blocks  # blocks not yet received
+        self.unrequested = blocks  # blocks missing and asked of nobody
+        # bytes asked of a second peer, or third...; the endgame's overhead
+        self.duplicate_bytes = 0
+
+        self._owners = {}  # block in flight -> peers asked for it
+        self._assigned = {}  # peer -> blocks in flight from it
+
+    def blocks_in(self, index):
+        return self._first[index + 1] - self._first[index]
+
+    def length(self, index, begin):
+        return self._triple(index, begin // self.block_size)[2]
+
+    def state(self, index, begin):
+        return self._state[self._block(index, begin)]
+
+    def next_missing(self, index):
+        '''(index, begin, length) of the first block of the piece nobody
+        has been asked for, or None'''
+        first, end = self._first[index], self._first[index + 1]
+        block, state = first + self._cursor[index], self._state
+        while block < end and state[block] != MISSING:
+            block += 1
+        self._cursor[index] = block - first
+        if block == end:
+            return None
+        return self._triple(index, block - first)
+
+    def unreceived(self, index):
+        '''(index, begin, length) of each block of the piece not yet had,
+        requested or not'''
+        first, state = self._first[index], self._state
+        for block in range(self.blocks_in(index)):
+            if state[first + block] < RECEIVED:
+                yield self._triple(index, block)
+
+    def set_wanted(self, index, wanted):
+        '''Pieces we don't want -- piece_picker.DONT_DOWNLOAD -- are left
+        out of remaining and unrequested'''
+        wanted = bool(wanted)
+        if self._wanted[index] == wanted:
+            return
+        self._wanted[index] = wanted
+        first, end = self._first[index], self._first[index + 1]
+        sign = 1 if wanted else -1
+        self.remaining += sign * (end - first - self._received[index])
+        self.unrequested += sign * self._state[first:end].count(_MISSING)
+
+    def request(self, index, begin, peer):
+        block = self._block(index, begin)
+        if self._state[block] == MISSING:
+            self._state[block] = REQUESTED
+            self.unrequested -= self._wanted[index]
+        if self._state[block] == REQUESTED:
+            owners = self._owners.setdefault(block, set())
+            if owners and peer not in owners:
+                self.duplicate_bytes += self.length(index, begin)
+            owners.add(peer)
+            self._assigned.setdefault(peer, set()).add(block)
+
+    def asked(self, index, begin, peer):
+        '''Whether peer has been asked for the block and not yet sent it'''
+        return peer in self._owners.get(self._block(index, begin), ())
+
+    def release(self, index, begin, peer):
+        '''peer won't be sending the block -- it was rejected, cancelled
+        or timed out'''
+        self._release(self._block(index, begin), peer)
+
+    def release_peer(self, peer):
+        '''Frees every block peer was asked for, on choke or disconnect'''
+        for block in list(self._assigned.get(peer, ())):
+            self._release(block, peer)
+
+    def receive(self, index, begin):
+        '''Marks a block received. False if it already was.'''
+        block = self._block(index, begin)
+        state = self._state[block]
+        if state >= RECEIVED:
+            return False
+        if state == MISSING:
+            self.unrequested -= self._wanted[index]
+        self._disown(block, index)
+        self._state[block] = RECEIVED
+        self._received[index] += 1
+        self.remaining -= self._wanted[index]
+        return True
+
+    def received(self, index):
+        '''Number of the piece's blocks received'''
+        return self._received[index]
+
+    def verify(self, index):
+        first, end = self._first[index], self._first[index + 1]
+        self._state[first:end] = bytearray([VERIFIED]) * (end - first)
+
+    def reset(self, index):
+        '''The piece failed its hash check, so every block is missing
+        again'''
+        first, end = self._first[index], self._first[index + 1]
+        wanted = self._wanted[index]
+        for block in range(first, end):
+            self._disown(block, index)
+            if self._state[block] != MISSING:
+                self.unrequested += wanted
+        self.remaining += wanted * self._received[index]
+        self._state[first:end] = bytearray(end - first)
+        self._received[index] = 0
+        self._cursor[index] = 0
+
+    def _release(self, block, peer):
+        owners = self._owners.get(block)
+        if owners is None or peer not in owners:
+            return
+        owners.discard(peer)
+        self._unassign(peer, block)
+        index = self._piece_of(block)
+        if owners:
+            self.duplicate_bytes -= self._length_of(index, block)
+        else:
+            del self._owners[block]
+            self._state[block] = MISSING
+            self.unrequested += self._wanted[index]
+            self._cursor[index] = min(self._cursor[index],
+                                      block - self._first[index])
+
+    def _disown(self, block, index):
+        '''Forgets who the block was asked of, once it's in or reset'''
+        owners = self._owners.pop(block, ())
+        if len(owners) > 1:
+            self.duplicate_bytes -= (len(owners) - 1) * \
+                self._length_of(index, block)
+        for peer in owners:
+            self._unassign(peer, block)
+
+    def _unassign(self, peer, block):
+        assigned = self._assigned.get(peer)
+        if assigned is not None:
+            assigned.discard(block)
+            if not assigned:
+                del self._assigned[peer]
+
+    def _block(self, index, begin):
+        return self._first[index] + begin // self.block_size
+
+    def _piece_of(self, block):
+        # pieces are all one length bar the last
+        return min(block // self.blocks_in(0), len(self._piece_lengths) - 1)
+
+    def _length_of(self, index, block):
+        return self._triple(index, block - self._first[index])[2]
+
+    def _triple(self, index, block):
+        begin = block * self.block_size
+        return index, begin, min(self.block_size,
+                                 self._piece_lengths[index] - begin)
@@ -0,0 +1,229 @@
+import os
+import errno
+import struct
+import config
+from file_pool import pread
+from collections import deque
+from itertools import islice
+
+_INT = struct.Struct('>I')
+
+_sendfile = getattr(os, 'sendfile', None)  # Python 3.3+
+
+# errors meaning sendfile can't be used for this pair of descriptors
+_SENDFILE_UNSUPPORTED = {errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                         errno.EOPNOTSUPP}
+
+
+class ReceiveBuffer(object):
+    '''Preallocated bytearray a peer's socket reads straight into with
+    recv_into. Unconsumed bytes sit between _start and _end; consume hands
+    them out as memoryview slices without copying.
+
+    Views handed out are only good until the next read into the buffer,
+    which may slide the unconsumed tail back to the front to make room.
+    The buffer is only ever replaced, never resized, so outstanding views
+    never pin it.'''
+
+    def __init__(self, size=config.RECEIVE_BUFFER_SIZE):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def writable(self, amount):
+        '''A view of at least amount free bytes to read into. Follow the
+        read with commit.'''
+        if len(self._buffer) - self._end < amount:
+            self._make_room(amount)
+        return self._view[self._end:]
+
+    def commit(self, amount):
+        self._end += amount
+
+    def recv_into(self, sock, amount=config.DEFAULT_READ_AMOUNT):
+        '''Reads up to amount bytes from sock. Returns the number read.'''
+        received = sock.recv_into(self.writable(amount), amount)
+        self._end += received
+        return received
+
+    def feed(self, data):
+        '''Copies in bytes that were read by someone else'''
+        amount = len(data)
+        self.writable(amount)[:amount] = data
+        self._end += amount
+
+    def byte_at(self, offset):
+        return self._buffer[self._start + offset]
+
+    def int_at(self, offset):
+        '''Big-endian unsigned four byte int at offset'''
+        return _INT.unpack_from(self._buffer, self._start + offset)[0]
+
+    def consume(self, amount):
+        '''Returns a view of the next amount bytes and moves past them'''
+        view = self._view[self._start:self._start + amount]
+        self._start += amount
+        if self._start == self._end:  # drained -- start over at the front
+            self._start = self._end = 0
+        return view
+
+    def _make_room(self, amount):
+        pending = self._end - self._start
+        if pending + amount > len(self._buffer):
+            grown = bytearray(max(2 * len(self._buffer), pending + amount))
+            grown[:pending] = self._view[self._start:self._end]
+            self._buffer, self._view = grown, memoryview(grown)
+        else:
+            # only ever a partial message, so this copy stays small
+            self._view[:pending] = self._view[self._start:self._end].tobytes()
+        self._start, self._end = 0, pending
+
+
+class SendQueue(object):
+    '''Outbox of encoded messages waiting to go out on a peer's socket.
+    Each send hands as many queued buffers as possible to one scatter/gather
+    sendmsg call. A partial write just moves a view over the head buffer
+    forward, so nothing is re-joined or re-encoded.
+
+    Without sendmsg (Python 2), small buffers at the head are coalesced
+    into one send of at most config.SEND_BATCH bytes.
+
+    FileSegments can be queued between buffers; they go out with sendfile
+    once everything ahead of them has been sent.'''
+
+    def __init__(self, high_water=config.SEND_HIGH_WATER):
+        self.high_water = high_water
+        self._buffers = deque()  # [unsent view, message] pairs
+        self._queued = 0  # bytes not yet sent
+
+    def __len__(self):
+        return self._queued
+
+    @property
+    def above_high_water(self):
+        '''True once enough is queued that the strategy should stop
+        generating requests and pieces for this peer'''
+        return self._queued >= self.high_water
+
+    def push(self, data, msg=None):
+        '''Queues encoded bytes; msg is handed back by send once the last
+        of them has gone out'''
+        self._buffers.append([memoryview(data), msg])
+        self._queued += len(data)
+
+    def push_file(self, segment, msg=None):
+        '''Queues a FileSegment, which is closed once sent'''
+        self._buffers.append([segment, msg])
+        self._queued += len(segment)
+
+    def send(self, sock):
+        '''Writes as much as sock will take and returns the messages that
+        were completely sent'''
+        head = self._buffers[0][0]
+        if isinstance(head, FileSegment):
+            return self._advance(head.send_to(sock))
+
+        try:
+            sendmsg = sock.sendmsg
+        except AttributeError:
+            sent = sock.send(self._coalesce())
+        else:
+            sent = sendmsg(list(islice(self._memory_views(),
+                                       config.SEND_IOV_MAX)))
+        return self._advance(sent)
+
+    def close(self):
+        '''Closes any file segments still queued'''
+        for entry, _ in self._buffers:
+            if isinstance(entry, FileSegment):
+                entry.close()
+        self._buffers.clear()
+        self._queued = 0
+
+    def _memory_views(self):
+        '''Queued views up to the first file segment'''
+        for entry, _ in self._buffers:
+            if isinstance(entry, FileSegment):
+                return
+            yield entry
+
+    def _coalesce(self):
+        head = self._buffers[0][0]
+        if len(head) >= config.SEND_BATCH or len(self._buffers) == 1:
+            return head
+
+        batch = bytearray()
+        for view in self._memory_views():
+            batch += view
+            if len(batch) >= config.SEND_BATCH:
+                break
+        return batch
+
+    def _advance(self, sent):
+        self._queued -= sent
+        buffers, done = self._buffers, []
+
+        while buffers:
+            head = buffers[0]
+            if len(head[0]) > sent:
+                if isinstance(head[0], FileSegment):
+                    head[0].advance(sent)
+                else:
+                    head[0] = head[0][sent:]
+                break
+            sent -= len(head[0])
+            entry, msg = buffers.popleft()
+            if isinstance(entry, FileSegment):
+                entry.close()
+            if msg is not None:
+                done.append(msg)
+        return done
+
+
+class FileSegment(object):
+    '''A run of bytes in an open file, queued to be sent without passing
+    through Python. Owns its descriptor and closes it once sent -- or,
+    given release, hands it back by calling that instead.
+
+    Falls back to reading the bytes and sending them normally when sendfile
+    isn't there (Python 2), the socket can't take it, or the socket is a
+    shim whose owner buffers writes itself (accepts_sendfile = False).'''
+
+    __slots__ = ('fd', 'offset', 'length', '_release')
+
+    def __init__(self, fd, offset, length, release=None):
+        self.fd, self.offset, self.length = fd, offset, length
+        self._release = release
+
+    def __len__(self):
+        return self.length
+
+    def advance(self, amount):
+        self.offset += amount
+        self.length -= amount
+
+    def send_to(self, sock):
+        if _sendfile is not None and getattr(sock, 'accepts_sendfile', True):
+            try:
+                return _sendfile(sock.fileno(), self.fd, self.offset,
+                                 self.length)
+            except OSError as e:
+                if e.errno not in _SENDFILE_UNSUPPORTED:
+                    raise
+        return sock.send(self._read())
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self._release is not None:
+            self._release()
+        else:
+            os.close(self.fd)
+        self.fd = None
+
+    def _read(self):
+        return pread(self.fd, min(self.length, config.SEND_BATCH),
+                     self.offset)
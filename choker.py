@@ -0,0 +1,91 @@
+import math
+import random
+import config
+from time import time
+
+'''Chokers decide, once a round, which peers a torrent uploads to. A
+strategy owns one and applies its decisions by sending Choke and Unchoke.'''
+
+
+class Choker(object):
+    '''Base class: unchokes the best ranked interested peers, plus one
+    optimistic unchoke rotated every few rounds. Subclasses define rank.'''
+
+    def __init__(self, slots=config.UNCHOKE_SLOTS, clock=time):
+        self.slots = slots  # None scales with upload capacity
+        self.optimistic = None
+        self._clock = clock
+        self._round = 0
+        self._peak_upload_rate = 0.0
+
+    def choose(self, peers, seeding, upload_rate):
+        '''Returns the set of peers to unchoke this round'''
+        self._peak_upload_rate = max(self._peak_upload_rate, upload_rate)
+        candidates = [p for p in peers if p.interested_me and p.active]
+
+        regular = [p for p in candidates if self.eligible(p, seeding)]
+        regular.sort(key=lambda p: self.rank(p, seeding), reverse=True)
+        unchoke = set(regular[:self.regular_slots()])
+
+        if self.optimistic not in candidates or self.optimistic in unchoke \
+                or self._round % config.OPTIMISTIC_UNCHOKE_ROUNDS == 0:
+            self.optimistic = self._pick_optimistic(
+                [p for p in candidates if p not in unchoke])
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+
+        now = self._clock()
+        for peer in unchoke:
+            peer.unchoked_at = now
+        self._round += 1
+        return unchoke
+
+    def regular_slots(self):
+        '''Slots besides the optimistic one'''
+        slots = self.slots if self.slots is not None \
+            else self._auto_slots()
+        return max(0, slots - 1)
+
+    def eligible(self, peer, seeding):
+        '''Snubbed peers only get a look in optimistically while leeching'''
+        return seeding or not peer.snubbed
+
+    def rank(self, peer, seeding):
+        raise NotImplementedError
+
+    def _auto_slots(self):
+        # BitTorrent mainline's rule of thumb, upload rate in KiB/s
+        rate = self._peak_upload_rate / 1024
+        if rate < 9:
+            return 2
+        if rate < 15:
+            return 3
+        if rate < 42:
+            return 4
+        return int(math.sqrt(rate * 0.6))
+
+    def _pick_optimistic(self, peers):
+        '''New connections are likelier picks, since they've had no chance
+        to earn a regular slot yet'''
+        if not peers:
+            return None
+        now = self._clock()
+        weighted = []
+        for peer in peers:
+            new = now - peer.connected_at < config.NEW_PEER_AGE
+            weighted.extend([peer] * (config.NEW_PEER_WEIGHT if new else 1))
+        return random.choice(weighted)
+
+
+class TitForTatChoker(Choker):
+    '''Leeching, reciprocates to the peers we download from fastest.
+    Seeding, favours the peers we upload to fastest, or with
+    config.SEED_ROUND_ROBIN set, whoever has gone longest without a
+    slot.'''
+
+    def rank(self, peer, seeding):
+        if not seeding:
+            return peer.download_rate
+        if config.SEED_ROUND_ROBIN:
+            return -peer.unchoked_at
+        return peer.upload_rate
@@ -1,13 +1,47 @@
 from random import choice
 
-PROTOCOL = 'BitTorrent protocol'
-RESERVED_BYTES = '\x00\x00\x00\x00\x00\x00\x00\x00'
-CLIENT_ID = '-jw0001-123456789012'
+PROTOCOL = b'BitTorrent protocol'
+RESERVED_BYTES = b'\x00\x00\x00\x00\x00\x00\x00\x04'  # BEP 6 fast extension
+FAST_EXTENSION_BIT = (7, 0x04)  # reserved byte and mask
+CLIENT_ID = b'-jw0001-123456789012'
 MAX_LISTEN = 50
 PORT_RANGE = range(6880,6890)
 DEFAULT_PORT = choice(list(PORT_RANGE))
 DEFAULT_ANNOUNCE_INTERVAL = 1800
 DEFAULT_READ_AMOUNT = 1024*20
-MAX_REQUEST_AMOUNT = 2**13
-SELECT_TIMEOUT = 0.05
+MAX_REQUEST_AMOUNT = 2**14
 
+ENGINE = 'reactor'  # or 'asyncio'
+USE_UVLOOP = True  # asyncio engine only, if uvloop is installed
+STATS_INTERVAL = 5  # seconds between worker reports in sharded mode
+HANDSHAKE_TIMEOUT = 30  # seconds the supervisor waits for an info hash
+CONNECT_TIMEOUT = 10  # seconds an outbound connection may take
+RECEIVE_BUFFER_SIZE = 2**16  # per peer; grows to fit the largest message
+MAX_MESSAGE_LENGTH = 2**20  # longer length prefixes get a peer dropped
+SEND_HIGH_WATER = 2**18  # queued bytes per peer before the strategy backs off
+SEND_IOV_MAX = 64  # buffers per sendmsg call
+SEND_BATCH = 2**16  # most bytes coalesced per send without sendmsg
+MAX_REQUESTED_PIECE_LENGTH = 2**17  # longest block we'll serve
+HAVE_BATCH_WINDOW = 0.5  # seconds to coalesce Haves over; 0 sends at once
+ALLOWED_FAST_COUNT = 10  # pieces a choked fast-extension peer may request
+SUGGEST_COUNT = 4  # recently served pieces suggested to interested peers
+REQUEST_QUEUE_TIME = 3  # seconds of download queued past a round trip
+REQUEST_QUEUE_MIN = 4  # requests kept outstanding per peer, at least...
+REQUEST_QUEUE_MAX = 250  # ...and at most
+REQUEST_INTERVAL = 1  # seconds between sweeps topping up every peer
+RATE_WINDOW = 10  # seconds transfer rates are measured over
+RATE_BUCKETS = 10  # resolution of that window
+CHOKE_INTERVAL = 10  # seconds between choking rounds
+OPTIMISTIC_UNCHOKE_ROUNDS = 3  # rounds each optimistic unchoke lasts
+UNCHOKE_SLOTS = None  # peers unchoked at once; None scales with upload rate
+SEED_ROUND_ROBIN = False  # seeding, rotate slots instead of ranking by rate
+SNUB_TIMEOUT = 60  # seconds without a requested block before a peer's snubbed
+NEW_PEER_AGE = 60  # seconds a connection counts as new...
+NEW_PEER_WEIGHT = 3  # ...and how much likelier it is an optimistic pick
+ENDGAME_MAX_DUPLICATE_BYTES = 2**22  # duplicate requests in flight at once
+REQUEST_TIMEOUT = 60  # seconds before an unanswered request is cancelled
+MAX_OPEN_FILES = 512  # file descriptors the shared file pool keeps open...
+OPEN_FILES_SHARE = 0.25  # ...or at most this share of RLIMIT_NOFILE
+CACHE_SIZE = 2**26  # bytes of unfinished pieces held in memory, all torrents
+DISK_THREADS = 4  # workers hashing pieces and writing them out
+DISK_QUEUE_DEPTH = 64  # disk jobs per torrent before it stops requesting
@@ -0,0 +1,114 @@
+import config
+import logging
+import threading
+from time import time
+from functools import partial
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+'''Hashing and file writes, kept off the event loop. Jobs run on a small
+pool of worker threads -- hashlib and file I/O let go of the GIL while they
+work -- and their callbacks are handed back to the loop through its
+thread-safe call_soon, which wakes it.'''
+
+logger = logging.getLogger(__name__)
+
+_GAIN = 0.125  # weight of each job in the smoothed timings
+
+
+class DiskStats(object):
+    '''One owner's jobs: how many are waiting or running, and how long
+    they wait for a worker and then take'''
+
+    __slots__ = ('depth', 'jobs', 'latency', 'max_latency', 'service')
+
+    def __init__(self):
+        self.depth = self.jobs = 0
+        self.latency = self.max_latency = 0.0  # seconds queued
+        self.service = 0.0  # seconds running
+
+    def finished(self, latency, service):
+        self.depth -= 1
+        self.jobs += 1
+        self.latency += _GAIN * (latency - self.latency)
+        self.max_latency = max(self.max_latency, latency)
+        self.service += _GAIN * (service - self.service)
+
+
+class DiskQueue(object):
+    '''Runs jobs on worker threads and their callbacks back on the loop.
+    Jobs with the same key always go to the same worker, so they run in
+    the order they were submitted -- a piece's early flush is written
+    before the piece is read back to be checked.
+
+    Owners each get config.DISK_QUEUE_DEPTH jobs before full reports them
+    backed up. Nothing is refused; it's up to the owner to stop making
+    work.'''
+
+    def __init__(self, call_soon, threads=config.DISK_THREADS,
+                 depth=config.DISK_QUEUE_DEPTH, clock=time):
+        self.depth = depth
+        self._call_soon = call_soon
+        self._clock = clock
+        self._stats = {}  # owner -> DiskStats
+        self._queues = [queue.Queue() for _ in range(threads)]
+        for q in self._queues:
+            worker = threading.Thread(target=self._work, args=(q,))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, owner, key, job, callback=None):
+        '''Runs job() on a worker, then callback with its result on the
+        loop. A job that raises is logged and its callback gets None.'''
+        self.stats(owner).depth += 1
+        q = self._queues[hash(key) % len(self._queues)]
+        q.put((owner, job, callback, self._clock()))
+
+    def full(self, owner):
+        return self.stats(owner).depth >= self.depth
+
+    def stats(self, owner):
+        try:
+            return self._stats[owner]
+        except KeyError:
+            return self._stats.setdefault(owner, DiskStats())
+
+    def _work(self, q):
+        while True:
+            owner, job, callback, queued_at = q.get()
+            started = self._clock()
+            result = self._run(job)
+            self._call_soon(partial(self._finish, owner, callback, result,
+                                    started - queued_at,
+                                    self._clock() - started))
+
+    def _run(self, job):
+        try:
+            return job()
+        except Exception:
+            logger.exception('Disk job failed')
+            return None
+
+    def _finish(self, owner, callback, result, latency, service):
+        self.stats(owner).finished(latency, service)
+        if callback is not None:
+            callback(result)
+
+
+class InlineQueue(DiskQueue):
+    '''Runs jobs there and then, for when there's no loop to hand
+    callbacks back to'''
+
+    def __init__(self, depth=config.DISK_QUEUE_DEPTH, clock=time):
+        self.depth = depth
+        self._clock = clock
+        self._stats = {}
+
+    def submit(self, owner, key, job, callback=None):
+        self.stats(owner).depth += 1
+        started = self._clock()
+        result = self._run(job)
+        self._finish(owner, callback, result, 0.0, self._clock() - started)
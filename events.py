@@ -8,12 +8,14 @@ class EventManager(object):
             e_type = type(event)
 
         try:
-            self._event_handlers[e_type](event, e_type)
+            handler = self._event_handlers[e_type]
         except KeyError:
             try:
                 self.event_observer.handle_event(event, e_type)
             except AttributeError:
                 pass
+        else:
+            handler(event)
 
 
 class Event(object):
@@ -28,11 +30,11 @@ class Event(object):
 
         self._data = kwargs
 
-    def __getattr_(self, key):
+    def __getattr__(self, key):
         try:
-            return self._data[key]
+            return self.__dict__['_data'][key]
         except KeyError:
-            raise AttributeError
+            raise AttributeError(key)
 
 
 class TorrentEvent(Event):
@@ -46,8 +48,9 @@ class HaveCompletePiece(TorrentEvent):
     pass
 
 
-class UnknownPeerHandshake(TorrentEvent):
-    '''Contains a peer and the handshake'''
+class PieceHashFailed(TorrentEvent):
+    '''Created with a piece index when a downloaded piece fails its hash
+    check'''
     pass
 
 
@@ -87,11 +90,21 @@ class PeerReadyToSend(PeerEvent):
     pass
 
 
-class PeerDoneSending(TorrentEvent):
+class PeerDoneSending(PeerEvent):
     '''Created when a peer is done sending messages'''
     pass
 
 
+class PeerDropped(PeerEvent):
+    '''Created when a peer's connection is closed, before its socket is'''
+    pass
+
+
+class UnknownPeerHandshake(PeerEvent):
+    '''Contains a peer and the handshake'''
+    required_keywords = {'peer', 'msg'}
+
+
 class TrackerEvent(TorrentEvent):
     required_keywords = {'tracker'}
     pass
@@ -1,6 +1,11 @@
 import os
 import io
-import events
+import disk_io
+import file_pool
+import block_cache
+from bisect import bisect_right
+from buffers import FileSegment
+from functools import partial
 from hashlib import sha1
 
 
@@ -12,11 +17,20 @@ class FileHandler(object):
     '''A class for handling file operations within the torrent. Takes files,
      a list of dictionaries of length and path,  and a list of piece lengths.
      The basic idea is to break all reads and writes into the common
-     denominator of bytes'''
-
-    def __init__(self, name, files, piece_lengths, piece_hashes, dirname=None):
-
-        start_name = os.splitext(name) if dirname is None else dirname
+     denominator of bytes. Files are read and written through a FilePool,
+    and blocks wait in a BlockCache until their piece checks out -- by
+    default the pool and cache shared by all torrents. Hashing and writes
+    are jobs for disk, a DiskQueue; without one they run inline.'''
+
+    def __init__(self, name, files, piece_lengths, piece_hashes, dirname=None,
+                 pool=None, cache=None, disk=None):
+        self._pool = pool if pool is not None else file_pool.shared_pool()
+        self._cache = cache if cache is not None \
+            else block_cache.shared_cache()
+        self.disk = disk if disk is not None else disk_io.InlineQueue()
+
+        start_name = os.path.splitext(name)[0] if dirname is None \
+            else dirname
         directory = test_name = safe_filename(start_name)
 
         i = 1
@@ -27,8 +41,10 @@ class FileHandler(object):
         self._directory = test_name+'/'
         os.mkdir(self._directory)
 
-        self._files = {}
-        start_in_bytes = 0
+        # files in torrent order, with the byte offset each starts at in
+        # the torrent as a whole; the extra offset at the end is the total
+        self._file_paths = []
+        self._file_starts = [0]
 
         for f in files:
             full_path = \
@@ -37,62 +53,118 @@ class FileHandler(object):
             if not os.path.exists(dir_path):
                 os.makedirs(dir_path)
 
-            f.open(full_path, mode='w').close()
-
-            end_in_bytes = start_in_bytes + int(f['length'])
-            self._files[start_in_bytes, end_in_bytes] = full_path
-
-            start_in_bytes = end_in_bytes
+            io.open(full_path, mode='wb').close()
 
-        self._piece_starts = [sum(p_l for p_l in piece_lengths[:i])
-                              for i in range(len(piece_lengths))]
+            self._file_paths.append(full_path)
+            self._file_starts.append(self._file_starts[-1] + int(f['length']))
 
+        # every piece is the same length bar the last, so a piece starts at
+        # its index times that length
         self._piece_length = piece_lengths[0]
-        self._piece_hashes = piece_hashes
+        self.piece_lengths = piece_lengths
+        self.piece_hashes = piece_hashes
 
     def write(self, piece, offset, value):
-        stream = io.BytesIO(value)
-        for f_path, s_point, length in self._block_to_files(piece, offset,
-                                                            len(value)):
-            with io.open(f_path, mode='ab') as f:
-                f.seek(s_point)
-                f.write(stream.read(length))
-
-        self._is_piece_complete(piece)
+        '''Caches a block until its piece is checked. value may be a view
+        into a peer's receive buffer; it's copied.'''
+        self._cache.put(self, piece, self.piece_lengths[piece], offset, value)
+
+    def check_piece(self, index, callback):
+        '''Checks a piece whose blocks have all been written, and writes it
+        to disk if it's good; a bad piece is thrown away. callback is then
+        called back on the loop with whether it was good.'''
+        piece = self._cache.take(self, index)
+        self.disk.submit(self, (self, index),
+                         partial(self._check, index, piece),
+                         partial(self._done, piece, callback))
+
+    def flush_cached(self, index, piece):
+        '''Writes whatever blocks of a piece taken from the cache there
+        are'''
+        self.disk.submit(self, (self, index),
+                         partial(self._flush, index, piece),
+                         partial(self._done, piece, None))
+
+    @property
+    def backlogged(self):
+        '''Whether enough is waiting on the disk, for this torrent or all
+        of them, that no more blocks should be requested'''
+        return self.disk.full(self) or self._cache.full
 
     def read(self, piece, offset, length):
         '''Takes piece coordinates and returns chained together bytearrays'''
-        return ''.join(self._read_helper(file_path, seek_point, read_amount)
-                       for file_path, seek_point, read_amount
-                       in self._block_to_files(piece, offset, length))
-
-    def _is_piece_complete(self, index):
-        '''Check if piece at given index is proper length and hash'''
-        length = self.piece_lengths[index]
-        in_file = self.read(index, 0, length)
-        if len(in_file) == length and \
-                sha1(in_file).digest() == self.piece_hashes[index]:
-            self.handle_event(events.HaveComplete(index=index))
-
-    def _read_helper(self, file_path, seek_point, amount):
-        with io.open(file_path, mode='rb') as f:
-            f.seek(seek_point)
-            return f.read(amount)
+        return b''.join(self._pool.read(file_path, seek_point, read_amount)
+                        for file_path, seek_point, read_amount
+                        in self._block_to_files(piece, offset, length))
+
+    def segments(self, piece, offset, length):
+        '''The FileSegments backing a block, for sending straight from
+        disk. Each borrows its file's pooled descriptor until it has been
+        sent.'''
+        return [FileSegment(self._pool.acquire(file_path), seek_point,
+                            read_amount, self._releaser(file_path))
+                for file_path, seek_point, read_amount
+                in self._block_to_files(piece, offset, length)]
+
+    def close(self):
+        '''Writes out cached blocks and closes the torrent's files that
+        aren't being sent from'''
+        self._cache.flush(self)
+        for file_path in self._file_paths:
+            self._pool.close(file_path)
+
+    def _done(self, piece, callback, result):
+        # back on the loop, with the job finished with piece
+        if piece is not None:
+            self._cache.release(piece)
+        if callback is not None:
+            callback(result)
+
+    def _check(self, index, piece):
+        if piece is not None and piece.complete:
+            if piece.digest() != self.piece_hashes[index]:
+                return False
+            self._write(index, 0, piece.data)
+            return True
+
+        # some of it went to disk early, so hash it from there
+        if piece is not None:
+            self._flush(index, piece)
+        data = self.read(index, 0, self.piece_lengths[index])
+        return sha1(data).digest() == self.piece_hashes[index]
+
+    def _flush(self, index, piece):
+        view = memoryview(piece.data)
+        for begin, end in piece.runs():
+            self._write(index, begin, view[begin:end])
+
+    def _write(self, piece, offset, value):
+        view, written = memoryview(value), 0
+        for f_path, s_point, length in self._block_to_files(piece, offset,
+                                                            len(value)):
+            self._pool.write(f_path, s_point, view[written:written+length])
+            written += length
+
+    def _releaser(self, file_path):
+        return lambda: self._pool.release(file_path)
 
     def _block_to_files(self, piece_index, offset, block_length):
         '''Takes a piece index,  an offset,  and a length; yields triples of
-        filename,  seek_point,  and length.'''
-
-        block_start = self._piece_starts[piece_index] + offset
+        filename,  seek_point,  and length, one for each file the block
+        overlaps. The first file is found by bisecting the file offsets.'''
+        starts = self._file_starts
+        block_start = piece_index * self._piece_length + offset
         block_end = block_start + block_length
-
-        files = ((file_path, file_start, file_end)
-                 for file_start, file_end, file_path in self._files.items()
-                 if file_start <= block_start and file_end >= block_end)
-
-        for file_path, file_start, file_end in files:
-            seek = block_start - file_start
-            remaining_length = block_end - file_end
-            end = (file_end if remaining_length else block_end) - file_start
-            yield file_path, seek, end
-            block_start,  block_length = file_end,  remaining_length
+        if block_end > starts[-1]:
+            raise ValueError('block runs past the end of the torrent')
+
+        # the last file starting at or before the block -- past any empty
+        # files at the same offset
+        f = bisect_right(starts, block_start, 0, len(starts) - 1) - 1
+
+        while block_start < block_end:
+            amount = min(block_end, starts[f + 1]) - block_start
+            if amount:
+                yield self._file_paths[f], block_start - starts[f], amount
+            block_start += amount
+            f += 1
@@ -0,0 +1,142 @@
+import os
+import config
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+'''Open file descriptors kept between reads and writes. Every torrent's
+blocks go through one bounded pool, so a block costs a positional read or
+write rather than an open and close, and however many files the torrents
+hold the client stays under its descriptor limit.'''
+
+logger = logging.getLogger(__name__)
+
+_pread = getattr(os, 'pread', None)  # Python 3.3+
+_pwrite = getattr(os, 'pwrite', None)
+_seek_lock = threading.Lock()  # keeps lseek and the read or write together
+
+
+def pread(fd, amount, offset):
+    '''Reads without moving the descriptor's file offset, or at least
+    without anyone else's seek getting in between'''
+    if _pread is not None:
+        return _pread(fd, amount, offset)
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, amount)
+
+
+def pwrite(fd, data, offset):
+    if _pwrite is not None:
+        return _pwrite(fd, data, offset)
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+
+def default_capacity():
+    '''config.MAX_OPEN_FILES, or a share of RLIMIT_NOFILE if that's less;
+    sockets need descriptors too'''
+    if resource is None:
+        return config.MAX_OPEN_FILES
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return config.MAX_OPEN_FILES
+    return max(1, min(config.MAX_OPEN_FILES,
+                      int(soft * config.OPEN_FILES_SHARE)))
+
+
+class FilePool(object):
+    '''Descriptors by path, least recently used first. Each file is opened
+    read-write once, and closed when the pool is full and something else
+    needs opening. Descriptors lent out with acquire aren't closed until
+    they're released, so the pool can briefly run over its capacity.'''
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity or default_capacity()
+        self._files = OrderedDict()  # path -> [fd, users]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def read(self, path, offset, amount):
+        fd = self.acquire(path)
+        try:
+            return pread(fd, amount, offset)
+        finally:
+            self.release(path)
+
+    def write(self, path, offset, data):
+        view = memoryview(data)
+        fd = self.acquire(path)
+        try:
+            while view:
+                written = pwrite(fd, view, offset)
+                view, offset = view[written:], offset + written
+        finally:
+            self.release(path)
+
+    def acquire(self, path):
+        '''Lends out path's descriptor; give it back with release'''
+        with self._lock:
+            entry = self._files.pop(path, None)
+            if entry is None:
+                entry = [os.open(path, os.O_RDWR | os.O_CREAT), 0]
+            self._files[path] = entry  # now the most recently used
+            entry[1] += 1
+            self._evict()
+            return entry[0]
+
+    def release(self, path):
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is not None:
+                entry[1] -= 1
+            self._evict()
+
+    def close(self, path):
+        '''Closes path's descriptor once nobody is using it, say before
+        the file is renamed or deleted'''
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is not None and not entry[1]:
+                del self._files[path]
+                os.close(entry[0])
+
+    def close_all(self):
+        with self._lock:
+            for path, (fd, users) in list(self._files.items()):
+                if not users:
+                    del self._files[path]
+                    os.close(fd)
+
+    def _evict(self):
+        excess = len(self._files) - self.capacity
+        if excess <= 0:
+            return
+        for path, (fd, users) in list(self._files.items()):
+            if not users:
+                del self._files[path]
+                os.close(fd)
+                excess -= 1
+                if not excess:
+                    return
+        logger.debug('{} files open and in use; capacity is {}'.format(
+            len(self._files), self.capacity))
+
+
+_shared = None
+
+
+def shared_pool():
+    '''The pool every torrent's FileHandler uses unless given its own'''
+    global _shared
+    if _shared is None:
+        _shared = FilePool()
+    return _shared
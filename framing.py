@@ -0,0 +1,101 @@
+import config
+import messages
+import torrent_exceptions
+from buffers import ReceiveBuffer
+
+'''Resumable decoder for the peer wire protocol. It keeps its place between
+reads, so a frame split across recv boundaries is simply picked up where it
+was left off -- nothing is re-joined and nothing is raised on the normal
+path.'''
+
+AWAITING_HANDSHAKE = 'AWAITING_HANDSHAKE'
+AWAITING_LENGTH = 'AWAITING_LENGTH'
+AWAITING_BODY = 'AWAITING_BODY'
+
+HANDSHAKE = 'HANDSHAKE'  # frame ids for the two frames that don't carry one
+KEEPALIVE = 'KEEPALIVE'
+
+
+class FrameDecoder(object):
+    '''Decodes frames out of a ReceiveBuffer -- a peer's inbox, or one of
+    its own when used standalone through feed.'''
+
+    def __init__(self, buffer=None, expect_handshake=True):
+        self.buffer = buffer if buffer is not None else ReceiveBuffer()
+        self.state = AWAITING_HANDSHAKE if expect_handshake \
+            else AWAITING_LENGTH
+        self._body_length = 0
+
+    def feed(self, data):
+        '''Adds bytes and returns the messages they complete'''
+        self.buffer.feed(data)
+        return self.messages()
+
+    def frames(self):
+        '''Yields (msg_id, body) for each complete frame in the buffer:
+        HANDSHAKE with the whole handshake, KEEPALIVE with None, or the
+        message id with the rest of the body as a view into the buffer.'''
+        buf = self.buffer
+
+        while True:
+            if self.state is AWAITING_LENGTH:
+                if len(buf) < 4:
+                    return
+                length = buf.int_at(0)
+                if length > config.MAX_MESSAGE_LENGTH:
+                    raise torrent_exceptions.MessageParsingError(
+                        'frame of {0} bytes'.format(length))
+                buf.consume(4)
+                if length == 0:
+                    yield KEEPALIVE, None
+                    continue
+                self._body_length = length
+                self.state = AWAITING_BODY
+
+            elif self.state is AWAITING_BODY:
+                if len(buf) < self._body_length:
+                    return
+                msg_id = buf.byte_at(0)
+                body = buf.consume(self._body_length)[1:]
+                self.state = AWAITING_LENGTH
+                yield msg_id, body
+
+            else:  # AWAITING_HANDSHAKE
+                if not buf:
+                    return
+                # length,  protocol string,  reserved,  info hash,  peer_id
+                length = 1 + buf.byte_at(0) + 48
+                if len(buf) < length:
+                    return
+                frame = buf.consume(length)
+                self.state = AWAITING_LENGTH
+                yield HANDSHAKE, frame
+
+    def messages(self):
+        '''Yields a message object for each complete frame. Piece blocks
+        are views into the buffer, valid while the message is handled;
+        everything else is small and some of it (handshakes, bitfields)
+        outlives the buffer, so it's copied. Unknown ids are skipped.'''
+        lookup, piece = messages.lookup, messages.Piece
+
+        for msg_id, body in self.frames():
+            if msg_id is KEEPALIVE:
+                yield messages.KeepAlive()
+            elif msg_id is HANDSHAKE:
+                yield self._handshake(body.tobytes())
+            else:
+                try:
+                    msg_type = lookup[msg_id]
+                except KeyError:
+                    continue
+                yield msg_type(body if msg_type is piece else body.tobytes(),
+                               from_string=True,
+                               msg_event=messages.INCOMING)
+
+    def _handshake(self, frame):
+        reserved_at = 1 + ord(frame[0:1])
+        return messages.Handshake(frame[-20:],
+                                  frame[reserved_at+8:reserved_at+28],
+                                  reserved=frame[reserved_at:reserved_at+8],
+                                  pstr=frame[1:reserved_at],
+                                  msg_event=messages.INCOMING)
@@ -1,19 +1,29 @@
-import select
+import os
+import errno
 import socket
 import config
 import logging
 import torrent_exceptions
 import events
 from peer import Peer
-from time import time
+from reactor import Reactor, Waker
+from disk_io import DiskQueue
+from timers import TimerScheduler
 from strategies import TorrentManager
-from collections import defaultdict
+from functools import partial
+from collections import deque
 from requests_futures.sessions import FuturesSession
-from requests.exceptions import HTTPError
+from requests.exceptions import RequestException
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# connect_ex results that mean the connection is on its way
+_CONNECTING = {0, errno.EINPROGRESS, errno.EWOULDBLOCK}
+# accept errors that just mean the connection went away first
+_NOTHING_TO_ACCEPT = {errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR,
+                      errno.ECONNABORTED}
+
 
 class BitTorrentClient(torrent_exceptions.ExceptionManager,
                        events.EventManager,
@@ -21,32 +31,50 @@ class BitTorrentClient(torrent_exceptions.ExceptionManager,
     '''Main object encapsulating central info and work flow for the
     process'''
 
-    _listen_to = set()
-    _handlers = defaultdict(dict)
-    waiting_to_write = set()  # peers register themselves in this set
-    _dropped = set()  # peers to ignore
-
-    _futures = set()  # pending http_requests
     torrents = set()
     managers = set()  # strategy managers
-    _timers = set()  # timer tuple pairs -- callback,  timestamp
 
-    def __init__(self, port=config.DEFAULT_PORT, client_id=config.CLIENT_ID):
+    def __init__(self, port=config.DEFAULT_PORT, client_id=config.CLIENT_ID,
+                 listen=True):
+        '''With listen off, the client still announces port but leaves
+        accepting connections to someone else -- see supervisor.py'''
         self.port,  self.client_id = port,  client_id
         logger.info('Starting up on port %d', port)
 
-        s = socket.socket()
-        s.bind((socket.gethostname(), self.port))
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.listen(config.MAX_LISTEN)
+        self._reactor = Reactor()
+        self._timers = TimerScheduler()
+
+        if listen:
+            s = socket.socket()
+            s.bind((socket.gethostname(), self.port))
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.listen(config.MAX_LISTEN)
+            s.setblocking(False)
 
-        self._socket = s
+            self._socket = s
+            self.register(self, read=self._accept_connection)
 
-        self.register(self, read=self._accept_connection)
+        # callbacks queued from other threads, run on the next pass
+        self._ready = deque()
+        self._waker = Waker()
+        self.register(self._waker, read=self._waker.drain)
+
+        # pieces are hashed and written on worker threads, which hand
+        # their results back through the waker
+        self.disk = DiskQueue(self.call_soon)
 
         self._http_session = FuturesSession()
 
+        # peers that haven't been matched to a torrent yet
         self._exception_handlers = {
+            torrent_exceptions.ConnectionLost:
+            lambda e: self._drop_connection(e.peer),
+
+            torrent_exceptions.FatallyFlawedIncomingMessage:
+            lambda e: self._drop_connection(e.peer),
+
+            torrent_exceptions.FatallyFlawedOutgoingMessage:
+            lambda e: self._drop_connection(e.peer)
             }
 
         self._event_handlers = {
@@ -57,10 +85,12 @@ class BitTorrentClient(torrent_exceptions.ExceptionManager,
                                      error=ev.error),
 
             events.PeerReadyToSend:
-            lambda ev: self.waiting_to_write.add(ev.peer),
+            lambda ev: self._reactor.want_write(ev.peer, True),
 
             events.PeerDoneSending:
-            lambda ev: self.waiting_to_write.discard(ev.peer),
+            lambda ev: self._reactor.want_write(ev.peer, False),
+
+            events.PeerDropped: lambda ev: self.unregister(ev.peer),
 
             events.UnknownPeerHandshake: self._unknown_peer_callback}
 
@@ -75,31 +105,56 @@ class BitTorrentClient(torrent_exceptions.ExceptionManager,
         enqueues a request via socket.'''
 
         logger.info('Adding torrent described by %s', filename)
-        self.managers.add(TorrentManager(self.client_id,
-                                         filename,
-                                         options))
+        self.managers.add(TorrentManager(self, filename, options))
+
+    def connect(self, address, callback):
+        '''Starts connecting to a peer address without waiting for it, and
+        calls callback with the new Peer once the connection is made'''
+        s = socket.socket()
+        s.setblocking(False)
+        error = s.connect_ex(address)
+        if error not in _CONNECTING:
+            logger.info('Could not connect to %s: %s', address,
+                        os.strerror(error))
+            s.close()
+            return
+
+        pending = PendingConnection(s, address, callback, self)
+        pending.timer = self.add_timer(config.CONNECT_TIMEOUT,
+                                       lambda: self._abandon(pending),
+                                       self.handle_exception)
+        # writable once connected; failing shows up as an error
+        self.register(pending, write=lambda: self._connected(pending),
+                      error=lambda e: self._connected(pending))
+        self._reactor.want_write(pending)
+
+    def adopt_connection(self, sock, received=b''):
+        '''Takes over a connection accepted elsewhere, along with any bytes
+        already read from it'''
+        sock.setblocking(False)
+        peer = Peer(sock, self)
+        if received:
+            peer.receive(received)
+        return peer
 
     def register(self, sock_manager, **socket_handlers):
         '''Register socket_abstraction with fileno and handlers'''
-        if 'read' in socket_handlers:
-            self._listen_to.add(sock_manager)
-
         logger.info('Registering socket manager')
 
-        self._handlers[sock_manager].update(socket_handlers)
+        self._reactor.register(sock_manager, **socket_handlers)
 
     def unregister(self, sock_manager):
         logger.info('Unregistering socket')
 
-        del self._handlers[sock_manager]
-        self._listen_to.discard(sock_manager)
-        self.waiting_to_write.discard(sock_manager)
-        self._dropped.add(sock_manager)
+        self._reactor.unregister(sock_manager)
 
-    def add_timer(self, interval, callback, exception_handler):
-        '''Adds a callback to fire in a specified time'''
+    def add_timer(self, interval, callback, exception_handler, repeat=False):
+        '''Adds a callback to fire in a specified time -- and every interval
+        thereafter if repeat is set. Returns a handle with cancel() and
+        reschedule(delay).'''
         logger.info('Adding a callback in %d seconds: %s', interval, callback)
-        self._timers.add((callback, time()+interval, exception_handler))
+        return self._timers.add(interval, callback, exception_handler,
+                                repeat=repeat)
 
     def make_tracker_request(self, url, data, handler, e_handler):
         '''This instantiates a future object,  while binding a handler that
@@ -109,83 +164,88 @@ class BitTorrentClient(torrent_exceptions.ExceptionManager,
         logger.info('Making tracker request to %s', url)
 
         future = self._http_session.get(url, params=data)
-        self._futures.add((future, handler, e_handler))
+        future.add_done_callback(
+            lambda f: self.call_soon(partial(self._handle_http_response,
+                                             f, handler, e_handler)))
+
+    def call_soon(self, callback):
+        '''Queues a callback to run on the loop's next pass and wakes the
+        loop. Safe to call from any thread.'''
+        self._ready.append(callback)
+        self._waker.wake()
 
     def run_loop(self):
         '''Main loop'''
         logger.info('Beginning main loop...')
         while True:
             self._check_timers()
-            self._handle_http_requests()
-            self._select_sockets_and_handle()
+            self._run_ready_callbacks()
+            self._poll_sockets_and_handle()
 
     def _accept_connection(self):
-        sock,  address = self._socket.accept()
+        try:
+            sock,  address = self._socket.accept()
+        except socket.error as e:
+            if e.errno in _NOTHING_TO_ACCEPT:
+                return
+            raise
         logger.info('Connecting at %s.', address)
+        sock.setblocking(False)
 
          # b/c no torrent included yet,  will require handshake
         Peer(sock, self)  # __init__ registers peer with torrent
 
-    def _check_timers(self):
-        '''For time- and interval-sensitive callbacks'''
-        now = time()
-        ready_to_go = {(c, t, e) for (c, t, e) in self._timers if t <= now}
+    def _connected(self, pending):
+        self._forget(pending)
+        error = pending.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            logger.info('Could not connect to %s: %s', pending.address,
+                        os.strerror(error))
+            pending.socket.close()
+        else:
+            # __init__ registers peer with client
+            pending.callback(Peer(pending.socket, self))
 
-        for callback,  timestamp,  exception_handler in ready_to_go:
-            logger.info('Running callback %s at %d', repr(callback), timestamp)
-            try:
-                callback()
-            except Exception as e:
-                exception_handler(e)
+    def _abandon(self, pending):
+        logger.info('Timed out connecting to %s', pending.address)
+        self._forget(pending)
+        pending.socket.close()
 
-        self._timers -= ready_to_go
+    def _forget(self, pending):
+        self._reactor.unregister(pending)
+        pending.timer.cancel()
 
-    def _handle_http_requests(self):
-        '''Checks futures and if complete,  calls an appropriate handler'''
+    def _check_timers(self):
+        '''For time- and interval-sensitive callbacks'''
+        self._timers.run_due()
 
-        logger.info('Checking HTTP requests...')
-        completed = {(f, h, e) for (f, h, e) in self._futures if f.done()}
+    def _run_ready_callbacks(self):
+        '''Runs the callbacks queued before this pass; anything they queue
+        waits for the next one'''
+        for _ in range(len(self._ready)):
+            self._ready.popleft()()
 
-        for future,  handler,  e_handler in completed:
+    def _handle_http_response(self, future, handler, e_handler):
+        '''Calls the appropriate handler for a completed request'''
+        try:
             response = future.result()
+            response.raise_for_status()
+        except RequestException as e:
+            e_handler(e)
+        else:
+            handler(response)
+
+    def _poll_sockets_and_handle(self):
+        '''Poll the reactor for prepared sockets,  and then call the
+        registered handlers.'''
+        # block until the next timer is due; queued callbacks and completed
+        # HTTP requests interrupt the wait through the waker
+        timeout = 0 if self._ready else self._timers.time_until_next()
+        fired = self._reactor.poll(timeout)
 
-            try:
-                response.raise_for_status()
-            except HTTPError as e:
-                e_handler(e)
-            else:
-                handler(response)
-
-        self._futures -= completed
-
-    def _select_sockets_and_handle(self):
-        '''Use select interface to get prepared sockets,  and then
-        call the registered handlers.'''
-        logger.info('Checking sockets: %s %s',
-                    len(self._listen_to),
-                    len(self.waiting_to_write))
-
-        read,  write,  error = select.select(self._listen_to,
-                                             self.waiting_to_write,
-                                             self._listen_to,
-                                             config.SELECT_TIMEOUT)
-
-        logger.info('Read %d; Write %d; Error %d',
-                    len(read),
-                    len(write),
-                    len(error))
-
-        for event, socktype in (('read', read),
-                                ('write', write),
-                                ('error', error)):
-            for sock_manager in socktype:
-                logger.info('Handling %s event', event)
-                try:
-                    self._handlers[sock_manager][event]()
-                except KeyError:
-                    raise torrent_exceptions.UnhandledSocketEvent
-                except Exception as e:
-                    sock_manager.handle_exception(e)
+        logger.debug('%d events on %d sockets', len(fired), len(self._reactor))
+
+        self._reactor.dispatch(fired)
 
     def _unknown_peer_callback(self, e):
         peer, msg = e.peer, e.msg
@@ -199,13 +259,39 @@ class BitTorrentClient(torrent_exceptions.ExceptionManager,
             self.unregister(peer)
             peer.drop()
 
+    def _drop_connection(self, peer):
+        logger.info('Dropping %s', peer)
+        peer.drop()
+
     def _socket_error_handler(self, e):
         '''What has to happen here?'''
         raise e
 
+
+class PendingConnection(object):
+    '''An outbound connection the reactor is waiting on'''
+
+    def __init__(self, sock, address, callback, client):
+        self.socket = sock
+        self.address = address
+        self.callback = callback
+        self.timer = None
+        self._client = client
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def handle_exception(self, e):
+        self._client.handle_exception(e)
+
+
 if __name__ == '__main__':
     import sys
-    c = BitTorrentClient()
+    if config.ENGINE == 'asyncio':
+        from asyncio_client import AsyncioBitTorrentClient
+        c = AsyncioBitTorrentClient()
+    else:
+        c = BitTorrentClient()
     try:
         c.start_torrent(sys.argv[1])
     except KeyError:
@@ -1,6 +1,7 @@
+import struct
 import config
+import torrent_exceptions
 from bitarray import bitarray
-from utils import int_to_big_endian,  four_bytes_to_int,  prop_and_memo,  memo
 
 OUTGOING = 'OUTGOING'
 INCOMING = 'INCOMING'
@@ -14,21 +15,27 @@ class MessageManager():
             msg_type = type(msg)
 
         try:
-            self._message_handlers[msg.EVENT_TYPE][msg_type](msg)
+            handler = self._message_handlers[msg.EVENT_TYPE][msg_type]
         except KeyError:
             pass
+        else:
+            handler(msg)
 
         try:
-            self.next_message_level.handle_message_event(self, msg, msg_type)
+            next_level = self.next_message_level
         except AttributeError:
             pass
+        else:
+            next_level.handle_message_event(msg, msg_type)
 
 
 class Msg(object):
     '''super class'''
 
-    def __init__(self, **kwargs):
-        self.EVENT_TYPE = kwargs.pop('msg_event')
+    __slots__ = ('EVENT_TYPE', 'peer')
+
+    def __init__(self, msg_event=OUTGOING):
+        self.EVENT_TYPE = msg_event
         self.peer = None
 
     def __repr__(self):
@@ -37,190 +44,238 @@ class Msg(object):
 
 class Handshake(Msg):
 
+    __slots__ = ('peer_id', 'info_hash', 'reserved', 'pstr')
+
     def __init__(self, peerid, info_hash,
-                 reserved=config.RESERVED_BYTES, pstr=config.PROTOCOL):
-        super(Handshake, self).__init__()
+                 reserved=config.RESERVED_BYTES, pstr=config.PROTOCOL,
+                 **kwargs):
+        super(Handshake, self).__init__(**kwargs)
         self.peer_id = peerid
         self.info_hash = info_hash
         self.reserved = reserved
         self.pstr = pstr
-        self.pstrlen = chr(len(self.pstr))
 
-    def __str__(self):
-        return '{0}{1}{2}{3}{4}'.format(self.pstrlen, self.pstr,
-                                        self.reserved, self.info_hash,
-                                        self.peer_id)
+    @property
+    def pstrlen(self):
+        return len(self.pstr)
+
+    def encode(self):
+        return b''.join((struct.pack('B', len(self.pstr)), self.pstr,
+                         self.reserved, self.info_hash, self.peer_id))
 
 
 class Message(Msg):
-    id = ''
+    '''Length-prefixed message. A subclass names its fixed-size fields in
+    __slots__ and gives their struct format in _format; a variable-length
+    tail (a bitfield, a block) goes in _tail. Codecs are compiled once per
+    class, and nothing is cached per message.'''
+
+    __slots__ = ()
+    id = None
+    _format = ''
+    _tail = None
 
     def __init__(self, *args, **kwargs):
-        super(Message, self).__init__()
         from_string = kwargs.pop('from_string', False)
+        super(Message, self).__init__(**kwargs)
 
         if from_string:
-            self._string = args[0]
+            self._decode(args[0])
         else:
-            self._payload = args
-
-    @memo
-    def __str__(self):
-        body = '{0}{1}'.format(self._encoded_id(), self.string)
-        strlen = int_to_big_endian(len(body))
-        msg = '{0}{1}'.format(strlen, body)
-        print 'This {0} is {1} characters long.'.format(type(self), len(msg))
-        return msg
-
-    @prop_and_memo
-    def string(self):
-        '''the body of the message as a string'''
-        try:
-            return self._string
-        except AttributeError:
-            self._string = self._parse_payload()
-            return self._string
+            for name, value in zip(self._fields, args):
+                setattr(self, name, value)
 
-    @prop_and_memo
+    @property
     def payload(self):
-        '''the body of the message as a list'''
-        try:
-            return self._payload
-        except:
-            self._payload = self._parse_string()
-            return self._payload
+        '''the body of the message as a tuple'''
+        return tuple(getattr(self, name) for name in self._fields)
+
+    def encode(self):
+        '''The message as it goes on the wire'''
+        values = [getattr(self, name) for name in self._fields]
+        if self._tail is None:
+            return self._frame.pack(self._frame.size - 4, self.id, *values)
+        tail = values.pop()
+        return self._frame.pack(self._frame.size - 4 + len(tail), self.id,
+                                *values) + tail
+
+    def _decode(self, body):
+        codec = self._codec
+        if len(body) < codec.size:
+            raise torrent_exceptions.MessageParsingError(
+                '{0} of {1} bytes'.format(type(self).__name__, len(body)))
+        for name, value in zip(self._fields, codec.unpack_from(body)):
+            setattr(self, name, value)
+        if self._tail is not None:
+            setattr(self, self._tail, body[codec.size:])
+
+    def __repr__(self):
+        return '<{0} {1}>'.format(type(self).__name__, ' '.join(
+            '{0}={1}'.format(name, getattr(self, name, None))
+            for name in self._fields if name != self._tail))
+
+
+def _compile(cls):
+    '''Precompiles the struct codecs for a Message subclass'''
+    below_message = cls.__mro__[:cls.__mro__.index(Message)]
+    slots = [name for klass in reversed(below_message)
+             for name in klass.__dict__.get('__slots__', ())]
+    fixed = [name for name in slots if name != cls._tail]
+    cls._fields = tuple(fixed) + ((cls._tail,) if cls._tail else ())
+    cls._codec = struct.Struct('>' + cls._format)  # body after the id
+    cls._frame = struct.Struct('>IB' + cls._format)  # prefix through fields
+    if issubclass(cls, FixedMessage) and cls.id is not None:
+        cls._wire = cls._frame.pack(1, cls.id)
+    return cls
 
-    def _parse_string(self):
-        return []
 
-    def _parse_payload(self):
-        return ''
+class FixedMessage(Message):
+    '''A message without a payload always encodes to the same bytes, so
+    they're built once per class and shared by every instance'''
+    __slots__ = ()
+    _wire = None
 
-    @memo
-    def _encoded_id(self):
-        return chr(self.id)
+    def encode(self):
+        return self._wire
 
 
-class KeepAlive(Message):
+class KeepAlive(FixedMessage):
     '''No payload or id'''
-    pass
+    __slots__ = ()
+    _wire = b'\x00\x00\x00\x00'
 
 
-class Choke(Message):
+class Choke(FixedMessage):
     '''No payload'''
     id = 0
+    __slots__ = ()
 
 
-class Unchoke(Message):
+class Unchoke(FixedMessage):
     '''No payload'''
     id = 1
+    __slots__ = ()
 
 
-class Interested(Message):
+class Interested(FixedMessage):
     '''No payload'''
     id = 2
+    __slots__ = ()
 
 
-class NotInterested(Message):
+class NotInterested(FixedMessage):
     '''No payload'''
     id = 3
+    __slots__ = ()
 
 
 class Have(Message):
     '''Expects piece index as an init arg'''
     id = 4
-
-    @property
-    def piece_index(self):
-        return four_bytes_to_int(self.payload)
-
-    def _parse_string(self):
-        return self._string
+    __slots__ = ('piece_index',)
+    _format = 'I'
 
 
 class Bitfield(Message):
-    '''Expects a bitfield as an init arg'''
+    '''Expects a bitfield, as bytes, as an init arg'''
     id = 5
+    __slots__ = ('data',)
+    _tail = 'data'
 
     @property
     def bitfield(self):
         b = bitarray()
-        b.frombytes(self.payload)
+        b.frombytes(self.data)
         return b
 
-    def _parse_string(self):
-        return self._string
-
-    def _parse_payload(self):
-        return self.bitfield.tobytes()
-
 
 class Request(Message):
     '''Expects index,  begin,  length as init args'''
     id = 6
-
-    @property
-    def index(self):
-        return self.payload[0]
-
-    @property
-    def begin(self):
-        return self.payload[1]
-
-    @property
-    def length(self):
-        return self.payload[2]
+    __slots__ = ('index', 'begin', 'length')
+    _format = 'III'
 
     def get_triple(self):
         return self.index, self.begin, self.length
 
-    def _parse_string(self):
-        return [four_bytes_to_int(self._string[i:i+4]) for i in (0, 4, 8)]
-
-    def _parse_payload(self):
-        return ''.join(int_to_big_endian(i) for i in self._payload)
-
     def __repr__(self):
         return '<Request for piece {0} beginning at {1} with length {2}>' \
             .format(self.index, self.begin, self.length)
 
 
 class Piece(Message):
-    '''Expects index,  begin,  block as init args'''
+    '''Expects index,  begin,  block as init args. Off the wire, block is a
+    view into the peer's inbox and only valid while the message is being
+    handled.'''
     id = 7
-
-    @property
-    def index(self):
-        return self.payload[0]
-
-    @property
-    def begin(self):
-        return self.payload[1]
-
-    @property
-    def block(self):
-        return self.payload[2]
-
-    def _parse_string(self):
-        return [four_bytes_to_int(self._string[i:i+4])
-                for i in (0, 4)]+[self._string[8:]]
-
-    def _parse_payload(self):
-        return ''.join(int_to_big_endian(i) for i in self._payload)
+    __slots__ = ('index', 'begin', 'block')
+    _format = 'II'
+    _tail = 'block'
 
     def __repr__(self):
-        return '<Piece {0} beginning at {1} with length {2}>'\
-            .format(self.index, self.begin, len(self.block))
+        return '<Piece {0} beginning at {1}>'.format(self.index, self.begin)
 
 
 class Cancel(Request):  # employs same payload as Request
     '''Expects index,  begin,  length as init args'''
     id = 8
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<Cancel for piece {0} beginning at {1} with length {2}>' \
+            .format(self.index, self.begin, self.length)
 
 
 class Port(Message):
     '''Expects listen-port as an argument'''
     id = 9
+    __slots__ = ('listen_port',)
+    _format = 'H'
+
+
+# BEP 6 Fast Extension -- only exchanged once both handshakes set the bit
+
+
+class SuggestPiece(Have):
+    '''Expects piece index as an init arg'''
+    id = 13
+    __slots__ = ()
+
+
+class HaveAll(FixedMessage):
+    '''No payload'''
+    id = 14
+    __slots__ = ()
+
+
+class HaveNone(FixedMessage):
+    '''No payload'''
+    id = 15
+    __slots__ = ()
+
+
+class RejectRequest(Request):
+    '''Expects index,  begin,  length as init args'''
+    id = 16
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<Reject for piece {0} beginning at {1} with length {2}>' \
+            .format(self.index, self.begin, self.length)
+
+
+class AllowedFast(Have):
+    '''Expects piece index as an init arg'''
+    id = 17
+    __slots__ = ()
+
 
+FAST_EXTENSION = (SuggestPiece, HaveAll, HaveNone, RejectRequest,
+                  AllowedFast)
 
-lookup = {sc.id: sc for sc in Message.__subclasses__()}
+lookup = {}
+for _cls in (KeepAlive, Choke, Unchoke, Interested, NotInterested, Have,
+             Bitfield, Request, Piece, Cancel, Port) + FAST_EXTENSION:
+    _compile(_cls)
+    if _cls.id is not None:
+        lookup[_cls.id] = _cls
@@ -1,16 +1,27 @@
+import errno
+import socket
+import struct
 import messages
 import config
 import torrent_exceptions
 import logging
 import events
 from time import time
-from collections import deque
 from functools import partial
-from utils import four_bytes_to_int,  StreamReader
+from collections import deque
+from buffers import ReceiveBuffer,  SendQueue
+from framing import FrameDecoder
+from rates import RateMeter
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# length prefix,  id,  index and begin of a Piece, ahead of its block
+_PIECE_HEADER = struct.Struct('>IBII')
+
+# socket errors that just mean there was nothing to do after all
+_RETRY = {errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR}
+
 
 class Peer(torrent_exceptions.ExceptionManager,
            messages.MessageManager,
@@ -18,16 +29,21 @@ class Peer(torrent_exceptions.ExceptionManager,
     '''Class representing peer for specific torrent download and
     providing interface with specific TCP socket'''
 
-    def __init__(self, socket):
+    def __init__(self, socket, event_observer=None):
         logger.info('Instantiating peer %s', str(socket.getpeername()))
         self.socket = socket
+        self.event_observer = event_observer
+        # until a strategy takes it on
+        self.next_exception_level = event_observer
+        self._event_handlers = {}
         self.active = True
         self.peer_id = None
+        self.torrent = None
 
         self.address = socket.getpeername()
         self.ip,  self.port = self.address
 
-        self.outbox = deque()
+        self.outbox = SendQueue()
         self.sent_folder,  self.archive = [],  []
 
         self.handshake = {'sent': False, 'received': False}
@@ -35,15 +51,34 @@ class Peer(torrent_exceptions.ExceptionManager,
         self.handle_event(events.PeerRegistration(peer=self,
                                                   read=self.handle_incoming,
                                                   write=self.handle_outgoing,
-                                                  error=self.handle_exception))
+                                                  error=self.handle_error))
 
         self.last_heard_from = time()
         self.last_spoke_to = 0
-
-        self._read_buffer = ''
-        self._pending_send = deque()
-
-        self.outstanding_requests = set()
+        self.connected_at = time()
+        self.last_piece_at = time()
+        self.unchoked_at = 0  # last choking round it got a slot
+
+        self.inbox = ReceiveBuffer()
+        self._decoder = FrameDecoder(self.inbox)
+
+        # (index, begin) -> when the Request went out
+        self.outstanding_requests = {}
+        self.unsent_requests = 0  # Requests still in the outbox
+        # fewest seconds from a Request to its block -- the round trip
+        # with as little of the peer's queue in it as we've seen
+        self.request_rtt = None
+
+        # bytes on the wire and Piece blocks, each way
+        self.down, self.up = RateMeter(), RateMeter()
+        self._file_blocks = deque()  # lengths of Pieces queued from disk
+        self.wants = set()  # (index, begin, length) the peer has requested
+
+        # BEP 6 fast extension state -- fast is set once both sides have it
+        self.fast = False
+        self.allowed_fast = set()  # pieces we may request while choked
+        self.granted_fast = set()  # pieces it may request while we choke
+        self.suggested = set()
 
         self.am_choking,  self.am_interested = True,  False
         self.choking_me,  self.interested_me = True,  False
@@ -61,32 +96,39 @@ class Peer(torrent_exceptions.ExceptionManager,
         self._message_handlers = {
             messages.INCOMING: {
                 messages.Handshake: self._process_handshake,
-                messages.Choke: lambda _: choking_me_setter(True),
+                messages.Choke: self._process_choke,
                 messages.Unchoke: lambda _: choking_me_setter(False),
                 messages.Interested: lambda _: interested_me_setter(True),
                 messages.NotInterested: lambda _: interested_me_setter(False),
                 messages.Have: self._process_have,
                 messages.Bitfield: self._process_bitfield,
                 messages.Request: self._process_request,
-                messages.Piece:
-                lambda m: self.outstanding_requests.discard((m.index,
-                                                             m.begin)),
-
-                messages.Cancel: self._process_cancel
+                messages.Piece: self._process_piece,
+                messages.Cancel: self._process_cancel,
+
+                messages.HaveAll: self._fast_only(),
+                messages.HaveNone: self._fast_only(),
+                messages.RejectRequest: self._fast_only(self._process_reject),
+                messages.AllowedFast:
+                self._fast_only(lambda m: self.allowed_fast
+                                .add(m.piece_index)),
+
+                messages.SuggestPiece:
+                self._fast_only(lambda m: self.suggested.add(m.piece_index))
             },
             messages.OUTGOING: {
                 messages.Handshake: self._record_handshake,
-                messages.Request:
-                lambda m: self.outstanding_requests.add(m.get_triple()[:2]),
-
+                messages.Request: self._record_request,
                 messages.Cancel:
-                lambda m: self.outstanding_requests.discard(m
-                                                            .get_triple()[:2]),
+                lambda m: self.outstanding_requests.pop((m.index, m.begin),
+                                                        None),
 
                 messages.Choke: lambda _: am_choking_setter(True),
                 messages.Unchoke: lambda _: am_choking_setter(False),
                 messages.Interested: lambda _: am_interested_setter(True),
-                messages.NotInterested: lambda _: am_interested_setter(False)
+                messages.NotInterested: lambda _: am_interested_setter(False),
+                messages.AllowedFast:
+                lambda m: self.granted_fast.add(m.piece_index)
             }
         }
 
@@ -97,116 +139,126 @@ class Peer(torrent_exceptions.ExceptionManager,
         return '<Peer at {0}:{1}>'.format(self.ip,  self.port)
 
     def fileno(self):
-        return self._socket.fileno()
+        return self.socket.fileno()
 
     def handle_incoming(self):
+        try:
+            received = self.inbox.recv_into(self.socket)
+        except socket.error as e:
+            if e.errno in _RETRY:
+                return
+            raise torrent_exceptions.ConnectionLost(str(e), peer=self)
+        if not received:
+            raise torrent_exceptions.ConnectionLost('closed by peer',
+                                                    peer=self)
+        self._count_down(received)
+        self.process_inbox()
+
+    def handle_error(self, e):
+        '''The reactor's error handler, for a failed or hung-up socket'''
+        e.peer = self
+        self.handle_exception(e)
+
+    def receive(self, data):
+        '''Handles bytes read from the peer by whichever engine owns the
+        connection'''
+        self.inbox.feed(data)
+        self._count_down(len(data))
+        self.process_inbox()
+
+    def received_into(self, amount):
+        '''Handles amount bytes an engine read straight into the inbox'''
+        self.inbox.commit(amount)
+        self._count_down(amount)
+        self.process_inbox()
+
+    def process_inbox(self):
+        '''Parses and handles every complete message in the inbox. Engines
+        that read straight into the inbox call this after committing.'''
         self.last_heard_from = time()
 
-        for msg in self._read_from_socket():
-            try:
-                self.handle_message(msg)
-            except torrent_exceptions.FatallyFlawedIncomingMessage as e:
-                self.handle_exception(e)
+        try:
+            for msg in self._decoder.messages():
+                if not self.active:  # dropped over an earlier message
+                    return
+                msg.peer = self
+                try:
+                    self.handle_message_event(msg)
+                except torrent_exceptions.FatallyFlawedIncomingMessage as e:
+                    self.handle_exception(e)
+        except torrent_exceptions.MessageParsingError:
+            # gets caught by strategy
+            raise torrent_exceptions.FatallyFlawedIncomingMessage(peer=self,
+                                                                  msg=None)
 
     def handle_outgoing(self):
-        sent_msgs = self._send_via_socket()
+        queued = len(self.outbox)
+        try:
+            sent_msgs = self.outbox.send(self.socket)
+        except socket.error as e:
+            if e.errno in _RETRY:
+                return
+            raise torrent_exceptions.ConnectionLost(str(e), peer=self)
+        blocks = payload = 0
+        for msg in sent_msgs:
+            if type(msg) is messages.Piece:
+                blocks += 1
+                payload += len(msg.block) if msg.block is not None \
+                    else self._file_blocks.popleft()
+        self._count_up(queued - len(self.outbox), blocks, payload)
 
         if sent_msgs:
             self.last_spoke_to = time()
 
         for msg in sent_msgs:
+            msg.peer = self
             try:
-                self.handle_message(msg)
+                self.handle_message_event(msg)
             except torrent_exceptions.FatallyFlawedOutgoingMessage as e:
                 self.handle_exception(e)
 
-        if not self._pending_send:
+        if not self.outbox:
             self.handle_event(events.PeerDoneSending(peer=self))
 
-    def enqueue_message(self, msg):
+    def enqueue_message(self, msg, encoded=None):
+        '''Queues msg to send. encoded, if given, is its wire form -- for
+        messages encoded once and sent to many peers.'''
         # if outbox is currently empty,  then we'll want to tell the client
-        notify = not self._pending_send
-        self._pending_send.append([msg, len(msg)])
+        notify = not self.outbox
+        if encoded is None:
+            encoded = msg.encode()  # encoded once,  here
+        self.outbox.push(encoded, msg)
+        if type(msg) is messages.Request:
+            self.unsent_requests += 1
+
+        if notify:  # tell client
+            self.handle_event(events.PeerReadyToSend(peer=self))
+
+    def enqueue_piece(self, index, begin, segments):
+        '''Queues a Piece whose block goes straight from disk to the socket.
+        segments are the FileSegments backing the block, in order.'''
+        notify = not self.outbox
+        length = sum(len(segment) for segment in segments)
+
+        self.outbox.push(_PIECE_HEADER.pack(9 + length, messages.Piece.id,
+                                            index, begin))
+        msg = messages.Piece(index, begin, None)
+        self._file_blocks.append(length)
+        for i, segment in enumerate(segments, 1):
+            self.outbox.push_file(segment, msg if i == len(segments) else None)
 
         if notify:  # tell client
             self.handle_event(events.PeerReadyToSend(peer=self))
 
     def drop(self):
         '''Procedure to disconnect socket'''
+        if not self.active:
+            return
         self.active = False
+        self.handle_event(events.PeerDropped(peer=self))
+        self.outbox.close()
         self.socket.close()
 
-    def _read_from_socket(self):
-        new_string = self.socket.recv(config.DEFAULT_READ_AMOUNT)
-        stream = StreamReader(self._read_buffer + new_string)
-
-        try:
-            while True:
-                yield self._parse_string_to_message(stream)
-        except torrent_exceptions.LeftoverException as e:
-            self._read_buffer = e.leftover
-
-    def _send_via_socket(self):
-        '''Attempts to send message via socket. Returns a list of
-        msgs sent -- potentially empty if sent was incomplete'''
-
-        strung = ''.join(str(msg)[-length:]
-                         for msg, length in self._pending_send)
-        amt_sent = self._socket.send(strung)
-
-        sent_msgs = []
-
-        while amt_sent:
-            # loop over lengths of pending msgs,  updating their remaining
-            # amount or appending them to the response list if they've been
-            # completely sent
-            if self._pending_send[0][1] > amt_sent:
-                self._pending_send[0][1] -= amt_sent
-                amt_sent = 0
-            else:
-                amt_sent -= length
-                # appends actual msg to self
-                sent_msgs.append(self._pending_send.leftpop()[0])
-
-        return sent_msgs
-
-    def _parse_string_to_message(self, stream):
-        parts = []
-        try:
-            if not self.handshake['received']:  # must be handshake
-                try:
-                    parts.append(ord(stream.read(1)))
-                    pstrlen = parts[0]
-                    # protocol string,  reserved,  info hash,  peer_id
-                    for l in (pstrlen, 8, 20, 20):
-                        parts.append(stream.read(l))
-                    info_hash, peer_id = parts[3], parts[4]
-                    return messages.Handshake(peer_id, info_hash,
-                                              reserved=parts[2],
-                                              pstr=parts[1],
-                                              msg_event=messages.INCOMING)
-                except torrent_exceptions.RanDryException as e:
-                    leftover = ''.join(parts)+e.unused
-                    raise torrent_exceptions.LeftoverException(value=leftover)
-            # normal message
-            try:
-                parts.append(stream.read(4))
-                bytes_length_prefix = parts[0]
-                length = four_bytes_to_int(bytes_length_prefix)
-                if length == 0:
-                    return messages.KeepAlive()
-                parts.append(stream.read(length))
-                msg_body = parts[1]
-                msg_id = ord(msg_body[0])
-                return messages.lookup[msg_id](msg_body[1:],
-                                               from_string=True,
-                                               msg_event=messages.INCOMING)
-            except torrent_exceptions.RanDryException as e:
-                leftover = ''.join(parts)+e.unused
-                raise torrent_exceptions.LeftoverException(value=leftover)
-        except torrent_exceptions.MessageParsingError as e:
-            self.handle_exception(e)
-
     def _record_handshake(self, msg):
         '''Fires as callback when handshake is sent. This is a method
         because assignment can't happen in lambdas...'''
@@ -216,6 +268,10 @@ class Peer(torrent_exceptions.ExceptionManager,
         self.handshake['received'] = True
         self.peer_id = msg.peer_id
 
+        byte, mask = config.FAST_EXTENSION_BIT
+        self.fast = bool(ord(msg.reserved[byte:byte+1]) & mask &
+                         ord(config.RESERVED_BYTES[byte:byte+1]))
+
         if msg.pstr != config.PROTOCOL:
             # will be caught by strategy
             raise torrent_exceptions.FatallyFlawedIncomingMessage(peer=self,
@@ -225,8 +281,35 @@ class Peer(torrent_exceptions.ExceptionManager,
             # will resolve to client,  where it'll be handled
             self.handle_event(events.UnknownPeerHandshake(msg=msg, peer=self))
 
+    def _fast_only(self, handler=None):
+        '''Fast extension messages are a protocol error unless both sides
+        negotiated it'''
+        def checked(msg):
+            if not self.fast:
+                # will be caught by strategy
+                raise torrent_exceptions.FatallyFlawedIncomingMessage(
+                    peer=self, msg=msg)
+            if handler is not None:
+                handler(msg)
+        return checked
+
+    def _process_choke(self, msg):
+        self.choking_me = True
+        if not self.fast:
+            # without the fast extension a choke silently drops everything
+            # we've asked for; with it each request gets an explicit reject
+            self.outstanding_requests.clear()
+
+    def _process_reject(self, msg):
+        self.outstanding_requests.pop((msg.index, msg.begin), None)
+
+    # has itself is kept by the torrent, which counts availability from it
+
     def _process_have(self, msg):
-        self.has[msg.piece_index] = 1
+        if msg.piece_index >= self.torrent.num_pieces:
+            # gets caught by strategy
+            raise torrent_exceptions.FatallyFlawedIncomingMessage(peer=self,
+                                                                  msg=msg)
 
     def _process_bitfield(self, msg):
         quotient,  remainder = divmod(self.torrent.num_pieces, 8)
@@ -239,27 +322,83 @@ class Peer(torrent_exceptions.ExceptionManager,
             raise torrent_exceptions.FatallyFlawedIncomingMessage(peer=self,
                                                                   msg=msg)
 
-        for i, p in enumerate(msg.bitfield):
-            try:
-                self.has[i] = p
-            except IndexError:
-                break
-
     def _process_request(self, msg):
-        if self.am_choking:
-            # peer is being obnoxious -- do something about it?
-            pass
-        if msg.length > config.MAX_REQUESTED_PIECE_LENGTH:
-            raise torrent_exceptions.FatallyFlawedIncomingMessage(peer=self,
-                                                                  msg=msg)
+        # requests made while we're choking are answered by the strategy --
+        # rejected, or served if the piece is in the allowed fast set
+        self._check_range(msg)
         self.wants.add((msg.index, msg.begin, msg.length))
 
     def _process_cancel(self, msg):
-        if msg.length > config.MAX_REQUESTED_PIECE_LENGTH:
+        self._check_range(msg)
+        self.wants.discard((msg.index, msg.begin, msg.length))
+
+    def _check_range(self, msg):
+        '''A Request or Cancel must fit inside one of the torrent's pieces;
+        reading past the end would serve the next piece's bytes'''
+        torrent = self.torrent
+        if torrent is None or \
+                msg.length > config.MAX_REQUESTED_PIECE_LENGTH or \
+                msg.index >= torrent.num_pieces or \
+                msg.begin + msg.length > torrent.piece_lengths[msg.index]:
+            # gets caught by strategy
             raise torrent_exceptions.FatallyFlawedIncomingMessage(peer=self,
                                                                   msg=msg)
-        self.wants.discard((msg.index, msg.begin, msg.length))
+
+    def _record_request(self, msg):
+        self.unsent_requests -= 1
+        self.outstanding_requests[(msg.index, msg.begin)] = time()
 
     def _process_piece(self, msg):
-        # do something in this context?
-        self.outstanding_requests.discard((msg.index, msg.begin))
+        requested = self.outstanding_requests.pop((msg.index, msg.begin),
+                                                  None)
+        if requested is None:  # unrequested, or cancelled in the meantime
+            return
+
+        self._count_down(0, 1, len(msg.block))
+        self.last_piece_at = self.last_heard_from
+
+        rtt = self.last_heard_from - requested
+        if self.request_rtt is None or rtt < self.request_rtt:
+            self.request_rtt = rtt
+
+    def _count_down(self, amount, blocks=0, payload=0):
+        self.down.add(amount, blocks, payload)
+        if self.torrent is not None:
+            self.torrent.down.add(amount, blocks, payload)
+
+    def _count_up(self, amount, blocks=0, payload=0):
+        self.up.add(amount, blocks, payload)
+        if self.torrent is not None:
+            self.torrent.up.add(amount, blocks, payload)
+
+    @property
+    def snubbed(self):
+        '''Sitting on our requests without sending anything back'''
+        return bool(self.outstanding_requests) and \
+            time() - self.last_piece_at > config.SNUB_TIMEOUT
+
+    @property
+    def download_rate(self):
+        return self.down.rate
+
+    @property
+    def upload_rate(self):
+        return self.up.rate
+
+    @property
+    def request_queue_depth(self):
+        '''How many requests to keep outstanding: the bandwidth-delay
+        product -- the peer's download rate over its round trip -- plus
+        config.REQUEST_QUEUE_TIME seconds more, so a peer far away isn't
+        left idle waiting for our next request. The round trip is the
+        fastest seen rather than an average, which would grow with the
+        queue and grow the queue with it.'''
+        delay = config.REQUEST_QUEUE_TIME + (self.request_rtt or 0)
+        depth = int(self.download_rate * delay / config.MAX_REQUEST_AMOUNT)
+        return max(config.REQUEST_QUEUE_MIN,
+                   min(depth, config.REQUEST_QUEUE_MAX))
+
+    @property
+    def free_request_slots(self):
+        return max(0, self.request_queue_depth - self.unsent_requests -
+                   len(self.outstanding_requests))
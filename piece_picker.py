@@ -0,0 +1,278 @@
+import numpy
+import random
+from bitarray import bitarray
+from itertools import islice
+
+'''Rarest-first piece picking. Pieces we still want sit in levels by
+priority and by how many peers have them, each level a bitarray over the
+whole torrent. A Have moves one bit up a level; a bitfield arriving or
+leaving moves every piece it covers with a few bitwise operations per
+level; and a pick ANDs the peer's pieces against the rarest levels until
+it has enough. Nothing is sorted or rebuilt along the way.
+
+Seeds' bitfields aren't added at all -- they only change how many seeds
+there are.'''
+
+DONT_DOWNLOAD = 0
+NORMAL = 1
+
+try:
+    bitarray('1').search(1)
+    _ONE = 1  # searching for a bitarray pattern is much slower
+except TypeError:  # bitarray before 2.3
+    _ONE = bitarray('1')
+
+_BULK_PIECES = 128  # bitfields with fewer pieces set go a piece at a time
+_SPARSE_FRACTION = 256  # peers with under 1/256 of wanted pieces are ranked
+_DENSE_FRACTION = 16  # ties over 1/16 of pieces are drawn by probing
+
+
+class PiecePicker(object):
+    '''Tracks availability and chooses which pieces to ask a peer for.
+    Ties are broken randomly.'''
+
+    def __init__(self, num_pieces):
+        self.seeds = 0  # peers with every piece, not in availability
+        # other peers with each piece
+        self.availability = numpy.zeros(num_pieces, dtype=numpy.int32)
+        # bytes, so numpy can view them without copying
+        self._priority = bytearray([NORMAL]) * num_pieces
+        self._raised = 0  # pieces above NORMAL
+        self._had = bytearray(num_pieces)
+        self._wanted = bitarray(num_pieces)
+        self._wanted.setall(True)
+        self._wanted_count = num_pieces
+        # priority -> the wanted pieces at each availability, and how many
+        # there are; empty levels are None
+        self._levels = {NORMAL: [self._wanted.copy()]}
+        self._sizes = {NORMAL: [num_pieces]}
+
+    def increment(self, index):
+        self._unlink(index)
+        self.availability[index] += 1
+        self._link(index)
+
+    def decrement(self, index):
+        self._unlink(index)
+        self.availability[index] -= 1
+        self._link(index)
+
+    def add_pieces(self, has):
+        '''A peer has arrived with, or announced, the pieces set in the
+        bitarray has'''
+        if has.all():
+            self.seeds += 1
+        else:
+            self._add_bitfield(has, 1)
+
+    def remove_pieces(self, has):
+        '''A peer with the pieces set in the bitarray has has gone'''
+        # a peer that filled in its bitfield a Have at a time was counted
+        # piece by piece, but once it has everything any seed will do
+        if self.seeds and has.all():
+            self.seeds -= 1
+        else:
+            self._add_bitfield(has, -1)
+
+    def have(self, index):
+        '''We have the piece, so it's never picked again'''
+        self._unlink(index)
+        self._had[index] = 1
+        self._set_wanted(index, False)
+
+    def lost(self, index):
+        '''The piece we thought we had has to be downloaded again'''
+        if self._had[index]:
+            self._had[index] = 0
+            self._set_wanted(index, self._priority[index] != DONT_DOWNLOAD)
+            self._link(index)
+
+    def set_priority(self, index, priority):
+        '''Higher priorities are picked first; DONT_DOWNLOAD never is'''
+        self._unlink(index)
+        self._raised += (priority > NORMAL) - (self._priority[index] > NORMAL)
+        self._priority[index] = priority
+        self._set_wanted(index, not self._had[index] and
+                         priority != DONT_DOWNLOAD)
+        self._link(index)
+
+    def wanted(self, index):
+        return self._wanted[index]
+
+    def wanted_pieces(self, has=None):
+        '''The indices of the pieces still wanted, or of those set in the
+        bitarray has'''
+        wanted = self._wanted if has is None else has & self._wanted
+        return wanted.search(_ONE)
+
+    def _set_wanted(self, index, wanted):
+        if self._wanted[index] != wanted:
+            self._wanted[index] = wanted
+            self._wanted_count += 1 if wanted else -1
+
+    def pick(self, has, count, partial=(), exclude=()):
+        '''Up to count pieces to ask a peer with the pieces set in has for'''
+        return list(islice(self.candidates(has, partial, exclude), count))
+
+    def candidates(self, has, partial=(), exclude=()):
+        '''Yields the wanted pieces set in has, best first: pieces in
+        partial we've started on, then the rarest by priority. Pieces in
+        exclude are passed over.'''
+        mine = has & self._wanted  # cleared as each piece is yielded
+        for index in exclude:
+            mine[index] = False
+
+        for index in partial:
+            if mine[index]:
+                mine[index] = False
+                yield index
+
+        left = mine.count()
+        if not left:
+            return
+
+        if left * _SPARSE_FRACTION < self._wanted_count:
+            # walking the levels would mostly turn up pieces it hasn't
+            # got, so rank the ones it has instead
+            ranked = self._ranked(numpy.fromiter(mine.search(_ONE),
+                                                 numpy.int64, left))
+        else:
+            ranked = self._walk(mine, left)
+        for index in ranked:
+            yield index
+
+    def _walk(self, mine, left):
+        '''The left pieces set in mine, from the rarest level up'''
+        for priority in sorted(self._levels, reverse=True):
+            for level, size in zip(self._levels[priority],
+                                   self._sizes[priority]):
+                if not size:
+                    continue
+                hits = level & mine
+                found = hits.count()
+                if found:
+                    for index in _shuffled(hits, found):
+                        yield index
+                    left -= found
+                    if not left:
+                        return
+
+    def _ranked(self, indices):
+        '''The pieces in the numpy array indices, best first, straight
+        from the counts. Each availability level costs a pass over what's
+        left, so taking the first few pieces costs about one.'''
+        levels = [indices]
+        if self._raised:
+            priority = numpy.frombuffer(self._priority,
+                                        dtype=numpy.uint8)[indices]
+            levels = []
+            while len(indices):
+                top = priority == priority.max()
+                levels.append(indices[top])
+                indices, priority = indices[~top], priority[~top]
+
+        for pieces in levels:
+            counts = self.availability[pieces]
+            while len(pieces):
+                rarest = counts == counts.min()
+                ties = pieces[rarest].tolist()
+                random.shuffle(ties)
+                for index in ties:
+                    yield index
+                pieces, counts = pieces[~rarest], counts[~rarest]
+
+    def _add_bitfield(self, has, sign):
+        if has.count() < _BULK_PIECES:
+            move = self.increment if sign > 0 else self.decrement
+            for index in has.search(_ONE):
+                move(index)
+            return
+
+        bits = self._unpack(has)
+        if sign > 0:
+            self.availability += bits
+        else:
+            self.availability -= bits
+        for priority in list(self._levels):
+            self._shift(priority, has, sign)
+
+    def _shift(self, priority, has, sign):
+        '''Moves the pieces at priority that are set in has one level up,
+        or down. Levels are visited so that moved pieces land on ones
+        already done, and only move once.'''
+        levels, sizes = self._levels[priority], self._sizes[priority]
+        if sign > 0:
+            order = range(len(levels) - 1, -1, -1)
+        else:
+            order = range(1, len(levels))
+        for availability in order:
+            if not sizes[availability]:
+                continue
+            moved = levels[availability] & has
+            count = moved.count()
+            if not count:
+                continue
+            levels[availability] ^= moved
+            self._resize(priority, availability, -count)
+            target = self._level(priority, availability + sign)
+            target |= moved
+            self._resize(priority, availability + sign, count)
+
+    def _level(self, priority, availability):
+        '''The bitarray of wanted pieces at priority that availability
+        peers have, made if there isn't one'''
+        levels = self._levels.setdefault(priority, [])
+        sizes = self._sizes.setdefault(priority, [])
+        while len(levels) <= availability:
+            levels.append(None)
+            sizes.append(0)
+        if levels[availability] is None:
+            level = bitarray(len(self._wanted))
+            level.setall(False)
+            levels[availability] = level
+        return levels[availability]
+
+    def _resize(self, priority, availability, change):
+        sizes = self._sizes[priority]
+        sizes[availability] += change
+        if not sizes[availability]:
+            self._levels[priority][availability] = None
+
+    @staticmethod
+    def _unpack(bits):
+        '''A bitarray as a numpy array of bools'''
+        unpacked = numpy.unpackbits(numpy.frombuffer(bits.tobytes(),
+                                                     dtype=numpy.uint8))
+        return unpacked[:len(bits)].view(bool)
+
+    def _link(self, index):
+        if self._wanted[index]:
+            priority, availability = self._priority[index], \
+                self.availability[index]
+            self._level(priority, availability)[index] = True
+            self._resize(priority, availability, 1)
+
+    def _unlink(self, index):
+        if self._wanted[index]:
+            priority, availability = self._priority[index], \
+                self.availability[index]
+            self._levels[priority][availability][index] = False
+            self._resize(priority, availability, -1)
+
+
+def _shuffled(bits, count):
+    '''Yields the count pieces set in bits in random order, clearing them
+    as it goes. While they're dense, random positions are probed until one
+    is set; once they thin out, the rest are listed and drawn from.'''
+    size = len(bits)
+    while count and count * _DENSE_FRACTION >= size:
+        index = random.randrange(size)
+        if bits[index]:
+            bits[index] = False
+            count -= 1
+            yield index
+    pieces = list(bits.search(_ONE))
+    while pieces:
+        i = random.randrange(len(pieces))
+        pieces[i], pieces[-1] = pieces[-1], pieces[i]
+        yield pieces.pop()
@@ -0,0 +1,89 @@
+import config
+from time import time
+
+'''Transfer rate meters cheap enough to update for every message. Counts go
+into a ring of fixed-width time buckets, so the windowed rate is a running
+sum and the smoothed rate is updated once per bucket rather than per add.'''
+
+_SMOOTHING_GAIN = 0.2  # weight of each finished bucket in the smoothed rate
+
+
+class RateMeter(object):
+    '''Bytes and blocks moved in one direction, in total and over the last
+    config.RATE_WINDOW seconds. payload is just the bytes of blocks, which
+    is what trackers are told.'''
+
+    __slots__ = ('total', 'blocks', 'payload', '_clock', '_span', '_bytes',
+                 '_counts', '_window_bytes', '_window_blocks', '_bucket',
+                 '_started', '_smoothed')
+
+    def __init__(self, window=config.RATE_WINDOW,
+                 buckets=config.RATE_BUCKETS, clock=time):
+        self.total = 0
+        self.blocks = 0
+        self.payload = 0
+        self._clock = clock
+        self._span = float(window) / buckets
+        self._bytes = [0] * buckets
+        self._counts = [0] * buckets
+        self._window_bytes = self._window_blocks = 0
+        self._started = clock()
+        self._bucket = int(self._started / self._span)
+        self._smoothed = 0.0
+
+    def add(self, amount, blocks=0, payload=0):
+        self._roll()
+        slot = self._bucket % len(self._bytes)
+        self._bytes[slot] += amount
+        self._counts[slot] += blocks
+        self._window_bytes += amount
+        self._window_blocks += blocks
+        self.total += amount
+        self.blocks += blocks
+        self.payload += payload
+
+    @property
+    def rate(self):
+        '''Bytes per second over the window'''
+        self._roll()
+        return self._window_bytes / self._elapsed()
+
+    @property
+    def block_rate(self):
+        '''Blocks per second over the window'''
+        self._roll()
+        return self._window_blocks / self._elapsed()
+
+    @property
+    def smoothed_rate(self):
+        '''Bytes per second, exponentially smoothed over finished buckets'''
+        self._roll()
+        return self._smoothed
+
+    def _elapsed(self):
+        '''Seconds the window's counts cover: the finished buckets and as
+        much of the current one as has gone by'''
+        now = self._clock()
+        covered = self._span * (len(self._bytes) - 1 + now / self._span -
+                                self._bucket)
+        return max(self._span, min(covered, now - self._started))
+
+    def _roll(self):
+        bucket = int(self._clock() / self._span)
+        passed = bucket - self._bucket
+        if passed <= 0:
+            return
+
+        # the current bucket is finished; any after it were idle
+        slots = len(self._bytes)
+        finished = self._bytes[self._bucket % slots] / self._span
+        self._smoothed += _SMOOTHING_GAIN * (finished - self._smoothed)
+        self._smoothed *= (1 - _SMOOTHING_GAIN) ** (passed - 1)
+
+        first = self._bucket + 1
+        for b in range(first, first + min(passed, slots)):
+            slot = b % slots
+            self._window_bytes -= self._bytes[slot]
+            self._window_blocks -= self._counts[slot]
+            self._bytes[slot] = self._counts[slot] = 0
+        self._bucket = bucket
@@ -0,0 +1,190 @@
+import os
+import errno
+import fcntl
+import select
+import logging
+import torrent_exceptions
+
+logger = logging.getLogger(__name__)
+
+
+class Reactor(object):
+    '''Keeps persistent registrations of socket managers with the kernel's
+    readiness interface -- epoll where available, poll otherwise -- so that
+    a pass through the loop costs as much as the number of active sockets
+    rather than the number of registered ones.
+
+    Socket managers are anything with a fileno(); handlers are stored under
+    the same 'read', 'write' and 'error' keys the client has always used.
+    Write interest is off until asked for with want_write.
+
+    Readiness is level-triggered, so a handler need only read or write
+    once per event. An error handler is called with a ConnectionLost when
+    the socket fails or hangs up; a manager without one is handed the
+    hang-up as a read, and finds out from the read.'''
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._READ = select.EPOLLIN | select.EPOLLPRI
+            self._WRITE = select.EPOLLOUT
+            self._ERROR = select.EPOLLERR | select.EPOLLHUP
+            self._epoll = True
+        else:
+            self._poller = select.poll()
+            self._READ = select.POLLIN | select.POLLPRI
+            self._WRITE = select.POLLOUT
+            self._ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            self._epoll = False
+
+        self._fds = {}  # sock_manager -> fd it was registered under
+        self._managers = {}  # fd -> sock_manager
+        self._handlers = {}  # sock_manager -> dict of handlers
+        self._masks = {}  # sock_manager -> current interest mask
+
+    def __len__(self):
+        return len(self._managers)
+
+    def __contains__(self, sock_manager):
+        return sock_manager in self._fds
+
+    def register(self, sock_manager, **socket_handlers):
+        '''Adds or updates handlers for sock_manager. Read interest follows
+        the presence of a read handler.'''
+        if sock_manager in self._fds:
+            self._handlers[sock_manager].update(socket_handlers)
+            mask = self._masks[sock_manager]
+            if 'read' in socket_handlers:
+                mask |= self._READ
+            self._modify(sock_manager, mask)
+            return
+
+        fd = sock_manager.fileno()
+        if fd in self._managers:
+            # the kernel has recycled the number of a socket that was closed
+            # without being unregistered
+            self.unregister(self._managers[fd])
+
+        mask = self._READ if 'read' in socket_handlers else 0
+        self._poller.register(fd, mask)
+
+        self._fds[sock_manager] = fd
+        self._managers[fd] = sock_manager
+        self._handlers[sock_manager] = dict(socket_handlers)
+        self._masks[sock_manager] = mask
+
+    def unregister(self, sock_manager):
+        try:
+            fd = self._fds.pop(sock_manager)
+        except KeyError:
+            return
+
+        del self._managers[fd]
+        del self._handlers[sock_manager]
+        del self._masks[sock_manager]
+
+        try:
+            self._poller.unregister(fd)
+        except (IOError, OSError, ValueError, KeyError):
+            pass  # already closed -- the kernel has dropped it for us
+
+    def want_write(self, sock_manager, wanted=True):
+        '''Turns write interest on or off for a registered socket manager'''
+        try:
+            mask = self._masks[sock_manager]
+        except KeyError:
+            return
+
+        new_mask = mask | self._WRITE if wanted else mask & ~self._WRITE
+        if new_mask != mask:
+            self._modify(sock_manager, new_mask)
+
+    def poll(self, timeout=None):
+        '''Waits up to timeout seconds (forever if None) and returns a list
+        of (sock_manager, event) pairs, event being 'read', 'write' or
+        'error'.'''
+        if self._epoll:
+            ready = self._poller.poll(-1 if timeout is None else timeout)
+        else:
+            ready = self._poller.poll(None if timeout is None
+                                      else int(timeout * 1000))
+
+        fired = []
+        for fd, mask in ready:
+            try:
+                sock_manager = self._managers[fd]
+            except KeyError:
+                continue  # unregistered by an earlier handler
+            # whatever was read before a hang-up is handled first
+            on_error = 'error' in self._handlers[sock_manager]
+            if mask & self._READ or (mask & self._ERROR and not on_error):
+                fired.append((sock_manager, 'read'))
+            if mask & self._WRITE:
+                fired.append((sock_manager, 'write'))
+            if mask & self._ERROR and on_error:
+                fired.append((sock_manager, 'error'))
+        return fired
+
+    def dispatch(self, fired):
+        '''Calls the registered handler for each fired event'''
+        for sock_manager, event in fired:
+            try:
+                handler = self._handlers[sock_manager][event]
+            except KeyError:
+                if sock_manager not in self._fds:
+                    continue  # dropped while handling an earlier event
+                raise torrent_exceptions.UnhandledSocketEvent(event)
+
+            try:
+                if event == 'error':
+                    handler(torrent_exceptions.ConnectionLost(
+                        'socket failed or hung up'))
+                else:
+                    handler()
+            except Exception as e:
+                sock_manager.handle_exception(e)
+
+    def close(self):
+        if self._epoll:
+            self._poller.close()
+
+    def _modify(self, sock_manager, mask):
+        self._masks[sock_manager] = mask
+        self._poller.modify(self._fds[sock_manager], mask)
+
+
+class Waker(object):
+    '''Self-pipe that lets other threads interrupt Reactor.poll. Register
+    it for reads with drain as the handler; wake() is safe to call from any
+    thread.'''
+
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self._read_fd
+
+    def wake(self):
+        try:
+            os.write(self._write_fd, b'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:  # a full pipe will wake us anyway
+                raise
+
+    def drain(self):
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def handle_exception(self, e):
+        raise e
+
+    def close(self):
+        os.close(self._read_fd)
+        os.close(self._write_fd)
@@ -1,11 +1,16 @@
+import logging
 import messages
-import socket
 import random
+import utils
 import config
 import torrent_exceptions
 import events
-from peer import Peer
+from choker import TitForTatChoker
 from torrent import Torrent
+from collections import deque
+from time import time
+
+logger = logging.getLogger(__name__)
 
 '''Strategy objects would be chosen based on the current state of the
 local torrent,  while the strategy object makes decisions about actions for
@@ -16,21 +21,24 @@ class TorrentManager(events.EventManager,
                      torrent_exceptions.ExceptionManager,
                      object):
 
-    def __init__(self, client_id, filename, events_strategies):
+    def __init__(self, client, filename, events_strategies):
         '''Instantiates torrent object and strategy'''
 
         if not events_strategies:
             events_strategies = default_set
 
-        self._torrent = Torrent(filename, client_id)
+        self.client = client
+        self._torrent = Torrent(filename, client.client_id, client.disk)
         self._events_strategies = events_strategies
-        self._set_strategy(events.INIT_EVENT)
+        self._set_strategy(events.TorrentInitiated(torrent=self._torrent))
 
     def _set_strategy(self, ev):
         strategy_type = self._choose_strategy(ev)
         self._strategy = strategy_type(self._torrent)
+        self._strategy.client = self.client
         self._strategy.event_observer = self
         self._strategy.next_exception_level = self
+        self._strategy.start()
 
     def _choose_strategy(self, ev):
         ev_type = type(ev)
@@ -40,13 +48,34 @@ class TorrentManager(events.EventManager,
         raise torrent_exceptions.NoStrategyFound()
 
     def register_unknown_peer(self, peer):
-        if self._strategy.want_peer(peer):
-            self._establish_contact(peer)
+        if self._strategy.want_peer(peer.address):
+            self._strategy._establish_contact(peer)
 
     @property
     def hashed_info(self):
         return self._torrent.hashed_info
 
+    def stats(self):
+        '''Counters a worker process reports back to its supervisor'''
+        torrent, disk = self._torrent, self._torrent.disk_stats
+        return {'peers': len(torrent.peers),
+                'pieces': torrent.num_pieces,
+                'pieces_had': torrent.have_count,
+                'downloaded': torrent.downloaded,
+                'uploaded': torrent.uploaded,
+                'download_rate': torrent.down.rate,
+                'upload_rate': torrent.up.rate,
+                'endgame': int(self._strategy.endgame),
+                'wasted': torrent.wasted,
+                'duplicate_requests':
+                self._strategy.endgame_stats['duplicate_requests'],
+                'cancels_sent': self._strategy.endgame_stats['cancels_sent'],
+                'disk_queue_depth': disk.depth,
+                'disk_jobs': disk.jobs,
+                'disk_queue_latency': disk.latency,
+                'disk_queue_max_latency': disk.max_latency,
+                'disk_job_time': disk.service}
+
 
 class Strategy(events.EventManager,
                torrent_exceptions.ExceptionManager,
@@ -54,15 +83,30 @@ class Strategy(events.EventManager,
     '''extensible class internalizing the strategy'''
 
     _MAX_PEERS = 50
+    choker_type = TitForTatChoker
 
     def __init__(self, torrent):
 
         self._torrent = torrent
+        torrent.strategy = self
         torrent.next_message_level = self
         torrent.event_observer = self
 
+        self._pending_haves = []  # completed pieces not yet announced
+        self._have_timer = None
+        # suggested to fast-extension peers, since they're likely cached
+        self._recently_served = deque(maxlen=config.SUGGEST_COUNT)
+        self._choker = self.choker_type()
+        self._choke_timer = self._expiry_timer = self._request_timer = None
+
+        # in endgame, the last blocks are requested from every peer that
+        # has them, and cancelled everywhere else as soon as one arrives
+        self.endgame = False
+        self._endgame_pieces = set()  # wanted pieces still missing blocks
+        self.endgame_stats = {'duplicate_requests': 0, 'cancels_sent': 0}
+
         self._event_handlers = {
-            events.TrackerResponse: self._tracker_response_callback,
+            events.TrackerResponse: self.tracker_response_callback,
             events.HaveCompletePiece: self._handle_have_event
             }
 
@@ -75,12 +119,38 @@ class Strategy(events.EventManager,
             lambda e: self._drop_peer(e.peer),
 
             torrent_exceptions.MessageParsingError:
+            lambda e: self._drop_peer(e.peer),
+
+            torrent_exceptions.ConnectionLost:
             lambda e: self._drop_peer(e.peer)
             }
 
+        # blocks are served as requests arrive and topped up as each Piece
+        # goes out, so a peer's outbox never holds much more than the
+        # high-water mark. Our own requests are topped up as blocks come
+        # in and whenever a peer might have more for us.
         self._message_handlers = {
-            messages.OUTGOING: {},
-            messages.INCOMING: {}
+            messages.OUTGOING: {
+                messages.Handshake: lambda m: self._send_availability(m.peer),
+                messages.Choke: lambda m: self._refuse_requests(m.peer),
+                messages.Unchoke: lambda m: self._serve_requests(m.peer),
+                messages.Piece: lambda m: self._serve_requests(m.peer)
+                },
+            messages.INCOMING: {
+                messages.Handshake: lambda m: self._send_availability(m.peer),
+                messages.Interested: lambda m: self._suggest_pieces(m.peer),
+                messages.Request: lambda m: self._serve_requests(m.peer),
+                messages.Piece: self._block_arrived,
+                messages.Have: self._process_have,
+                messages.Unchoke: lambda m: self.act(m.peer),
+                messages.AllowedFast: lambda m: self.act(m.peer),
+                # their blocks are free for other peers
+                messages.Choke: lambda m: self.act(),
+                messages.RejectRequest: lambda m: self.act(),
+                messages.Bitfield: lambda m: self._update_interest(m.peer),
+                messages.HaveAll: lambda m: self._update_interest(m.peer),
+                messages.HaveNone: lambda m: self._update_interest(m.peer)
+                }
             }
 
     def init_callback(self):
@@ -89,9 +159,76 @@ class Strategy(events.EventManager,
         for url in self._torrent.all_announce_urls:
             self._torrent.trackers.add(self.make_tracker(url))
 
+    def start(self):
+        '''Called once the strategy has a client to schedule work with'''
+        self._choke_timer = self.client.add_timer(
+            config.CHOKE_INTERVAL, self._choke_round, self.handle_exception,
+            repeat=True)
+        self._expiry_timer = self.client.add_timer(
+            config.REQUEST_TIMEOUT, self._expire_requests,
+            self.handle_exception, repeat=True)
+        # catches what the messages don't: the disk catching up, expired
+        # requests freeing their blocks
+        self._request_timer = self.client.add_timer(
+            config.REQUEST_INTERVAL, self.act, self.handle_exception,
+            repeat=True)
+
+    def _choke_round(self):
+        '''Unchokes the peers the choker picks and chokes the rest'''
+        peers = list(self._torrent.peers.values())
+        unchoke = self._choker.choose(peers, self._torrent.complete,
+                                      self._torrent.up.rate)
+        for peer in peers:
+            if peer in unchoke:
+                if peer.am_choking:
+                    self._torrent.dispatch(peer, messages.Unchoke)
+            elif not peer.am_choking:
+                self._torrent.dispatch(peer, messages.Choke)
+
+    def download_completed(self, index):
+        logger.info('Finished downloading %s', self._torrent)
+        self.have_event(index)
+
     def have_event(self, index):
+        '''Announces a completed piece. With config.HAVE_BATCH_WINDOW set,
+        pieces completed within the window go out together.'''
         for peer in self._torrent.peers.values():
-            self._torrent.dispatch(peer, messages.Have, index)
+            if peer.am_interested:  # it may have nothing else for us
+                self._update_interest(peer)
+
+        if not config.HAVE_BATCH_WINDOW:
+            self._broadcast_haves([index])
+            return
+
+        self._pending_haves.append(index)
+        if self._have_timer is None or not self._have_timer.active:
+            self._have_timer = self.client.add_timer(
+                config.HAVE_BATCH_WINDOW, self._flush_haves,
+                self.handle_exception)
+
+    def _process_have(self, msg):
+        if not msg.peer.am_interested and \
+                not self._torrent.have[msg.piece_index]:
+            self._torrent.dispatch(msg.peer, messages.Interested)
+        self.act(msg.peer)
+
+    def _update_interest(self, peer):
+        interested = self._torrent.interesting(peer)
+        if interested != peer.am_interested:
+            self._torrent.dispatch(peer, messages.Interested if interested
+                                   else messages.NotInterested)
+
+    def _flush_haves(self):
+        indices, self._pending_haves = self._pending_haves, []
+        self._broadcast_haves(indices)
+
+    def _broadcast_haves(self, indices):
+        '''Each Have is encoded once and only sent to peers that don't
+        already have the piece'''
+        peers = list(self._torrent.peers.values())
+        for index in indices:
+            self._torrent.broadcast([p for p in peers if not p.has[index]],
+                                    messages.Have, index)
 
     def want_peer(self, peer_address):
         '''All these tests must pass in order for a peer to be added'''
@@ -102,10 +239,7 @@ class Strategy(events.EventManager,
     def tracker_response_callback(self, ev):
         for adr in ev.new_peer_addresses:
             if self.want_peer(adr):
-                s = socket.socket()
-                s.connect(adr)
-                peer = Peer(s)
-                self._establish_contact(peer)
+                self.client.connect(adr, self._establish_contact)
 
         # check back in at requested interval
         self.client \
@@ -118,22 +252,38 @@ class Strategy(events.EventManager,
 
     def _establish_contact(self, peer):
         self._torrent.peers[peer.address] = peer
-        msgs = [messages.Handshake]
-
-        if any(self._torrent.have):
-            msgs.append(messages.Bitfield)
-
-        for msg in msgs:
-            self._torrent.dispatch(peer, msg)
+        peer.torrent = self._torrent
+        peer.next_message_level = self._torrent
+        peer.next_exception_level = self
+        peer.has = self._torrent.bitfield()
+        self._torrent.dispatch(peer, messages.Handshake)
+
+    def _send_availability(self, peer):
+        '''Once both handshakes are through, says which pieces we have --
+        with HaveAll or HaveNone if the peer speaks the fast extension, in
+        which case it's also granted its allowed fast set'''
+        if not (peer.handshake['sent'] and peer.handshake['received']):
+            return
+
+        if peer.fast or self._torrent.have_count:
+            self._torrent.dispatch(peer, messages.Bitfield)
+
+        if peer.fast:
+            for index in utils.allowed_fast_set(peer.ip,
+                                                self._torrent.hashed_info,
+                                                self._torrent.num_pieces,
+                                                config.ALLOWED_FAST_COUNT):
+                if self._torrent.have[index]:
+                    self._torrent.dispatch(peer, messages.AllowedFast, index)
 
     def make_announce_request(self, tracker, event_type=None):
         announce_params = {
             'info_hash': self._torrent.hashed_info,
             'peer_id': self.client.client_id,
             'port': self.client.port,
-            'uploaded': self.torrent.uploaded,
-            'downloaded': self.torrent.downloaded,
-            'left': self.torrent.total_length,
+            'uploaded': self._torrent.uploaded,
+            'downloaded': self._torrent.downloaded,
+            'left': self._torrent.total_length,
             'compact': 1,
             'supportcrypto': 1}
 
@@ -149,11 +299,156 @@ class Strategy(events.EventManager,
                                          tracker.handle_response,
                                          self.handle_exception)
 
-    def _get_rarest_desirable_pieces(self):
-        '''Outstanding pieces that are still required '''
-        return sorted((i for i, f in enumerate(self._torrent.frequency)
-                       if not self._torrent.have[i]),
-                      key=lambda x: x[1], reversed=True)
+    def act(self, peer=None):
+        '''Tops up the requests of peer, or of every peer, and moves in or
+        out of endgame'''
+        # blocks would only pile up behind pieces waiting on the disk
+        if self._torrent.disk_backlogged:
+            return
+
+        peers = self._torrent.peers.values() if peer is None else [peer]
+        for p in self._get_priority_peers(peers):
+            self._request_blocks(p)
+
+        self._update_endgame()
+        if self.endgame:
+            self._request_duplicates(peers)
+
+    def _candidates(self, peer):
+        '''The pieces to ask peer for blocks of, best first'''
+        raise NotImplementedError
+
+    def _request_blocks(self, peer):
+        '''Fills peer's free request slots with blocks nobody has been
+        asked for, working through each candidate piece in order'''
+        slots = peer.free_request_slots
+        candidates = self._candidates(peer)
+        if peer.choking_me:  # only its allowed fast pieces
+            candidates = (i for i in candidates if i in peer.allowed_fast)
+
+        blocks = self._torrent.blocks
+        for index in candidates:
+            while slots:
+                block = blocks.next_missing(index)
+                if block is None:
+                    break
+                self._request(peer, *block)
+                slots -= 1
+            if not slots:
+                return
+
+    def _request(self, peer, index, begin, length):
+        self._torrent.blocks.request(index, begin, peer)
+        self._torrent.dispatch(peer, messages.Request, index, begin, length)
+
+    def _expire_requests(self):
+        '''Requests unanswered for config.REQUEST_TIMEOUT are cancelled and
+        their blocks handed back for someone else to send'''
+        deadline = time() - config.REQUEST_TIMEOUT
+        blocks = self._torrent.blocks
+        for peer in self._torrent.peers.values():
+            for (index, begin), sent in list(peer.outstanding_requests
+                                             .items()):
+                if sent < deadline:
+                    blocks.release(index, begin, peer)
+                    self._torrent.dispatch(peer, messages.Cancel, index,
+                                           begin, blocks.length(index, begin))
+
+    def _serve_requests(self, peer):
+        '''Queues the blocks peer wants while its outbox has room. While
+        we're choking it, only pieces in its allowed fast set are served;
+        requests we won't serve are refused.'''
+        for request in list(peer.wants):
+            if peer.outbox.above_high_water:
+                break
+            index, begin, length = request
+            if not self._torrent.have[index] or \
+                    (peer.am_choking and index not in peer.granted_fast):
+                self._refuse(peer, request)
+                continue
+            peer.wants.discard(request)
+            self._torrent.serve_request(peer, index, begin, length)
+            if not self._recently_served or \
+                    self._recently_served[-1] != index:
+                self._recently_served.append(index)
+
+    def _refuse_requests(self, peer):
+        '''Choking a peer drops what it asked for, bar allowed fast pieces'''
+        for request in list(peer.wants):
+            if request[0] not in peer.granted_fast:
+                self._refuse(peer, request)
+
+    def _refuse(self, peer, request):
+        '''Fast-extension peers are told; others just never hear back'''
+        peer.wants.discard(request)
+        if peer.fast:
+            self._torrent.dispatch(peer, messages.RejectRequest, *request)
+
+    def _suggest_pieces(self, peer):
+        if peer.fast:
+            for index in set(self._recently_served):
+                if not peer.has[index]:
+                    self._torrent.dispatch(peer, messages.SuggestPiece, index)
+
+    def _update_endgame(self):
+        '''Endgame starts once every block we're missing has been
+        requested'''
+        blocks = self._torrent.blocks
+        if not blocks.remaining or blocks.unrequested:
+            self.endgame = False
+            self._endgame_pieces.clear()
+        elif not self.endgame:
+            logger.info('Endgame for %s with %d blocks left', self._torrent,
+                        blocks.remaining)
+            self.endgame = True
+            self._endgame_pieces = set(self._torrent.picker.wanted_pieces())
+
+    def _missing_blocks(self):
+        '''The blocks endgame is still waiting on. Pieces drop out of the
+        set as their last block arrives, or if they stop being wanted.'''
+        torrent = self._torrent
+        for index in sorted(self._endgame_pieces):
+            if not torrent.picker.wanted(index):
+                self._endgame_pieces.discard(index)
+                continue
+            for block in torrent.blocks.unreceived(index):
+                yield block
+
+    def _request_duplicates(self, peers):
+        '''Asks each unchoked peer for missing blocks it has that it hasn't
+        been asked for, up to config.ENDGAME_MAX_DUPLICATE_BYTES in flight'''
+        peers = self._filter_peers(peers,
+                                   [self.predicates[p] for p in
+                                    ('NON_CHOKING', 'REQUEST_QUEUE_NOT_FULL',
+                                     'OUTBOX_BELOW_HIGH_WATER')])
+        blocks = self._torrent.blocks
+        missing = list(self._missing_blocks())
+        for peer in peers:
+            slots = peer.free_request_slots
+            for index, begin, length in missing:
+                if not slots or blocks.duplicate_bytes + length > \
+                        config.ENDGAME_MAX_DUPLICATE_BYTES:
+                    break
+                if not peer.has[index] or blocks.asked(index, begin, peer):
+                    continue
+                self._request(peer, index, begin, length)
+                self.endgame_stats['duplicate_requests'] += 1
+                slots -= 1
+
+    def _block_arrived(self, msg):
+        self._cancel_duplicates(msg)
+        self.act(msg.peer)
+
+    def _cancel_duplicates(self, msg):
+        '''A block's in, so nobody else needs to send it'''
+        if not self.endgame:
+            return
+        key = msg.index, msg.begin
+        for peer in self._torrent.peers.values():
+            if key in peer.outstanding_requests:
+                self._torrent.dispatch(peer, messages.Cancel, msg.index,
+                                       msg.begin, len(msg.block))
+                self.endgame_stats['cancels_sent'] += 1
 
     def _drop_peer(self, peer):
         self._torrent.drop_peer(peer)
@@ -161,10 +456,22 @@ class Strategy(events.EventManager,
 
     predicates = {
         'NON_CHOKING': lambda p: not p.choking_me,
-        'UNDER_TEN_REQUESTS': lambda p: len(p.outstanding_requests) < 10,
-        'WANTED_PIECES': lambda p: bool(p.wanted_pieces)
+        'NON_CHOKING_OR_ALLOWED_FAST':
+        lambda p: not p.choking_me or bool(p.allowed_fast),
+        'REQUEST_QUEUE_NOT_FULL': lambda p: p.free_request_slots > 0,
+        'OUTBOX_BELOW_HIGH_WATER': lambda p: not p.outbox.above_high_water
         }
 
+    def _get_priority_peers(self, peers):
+        '''Those of peers worth sending requests to right now. Peers whose
+        outbox is backed up past the high-water mark are skipped until it
+        drains.'''
+        return self._filter_peers(peers,
+                                  [self.predicates[p] for p in
+                                   ('NON_CHOKING_OR_ALLOWED_FAST',
+                                    'REQUEST_QUEUE_NOT_FULL',
+                                    'OUTBOX_BELOW_HIGH_WATER')])
+
     def _filter_peers(self, peers, predicates):
         return (peer for peer in peers if
                 all(predicate(peer) for predicate in predicates))
@@ -172,23 +479,16 @@ class Strategy(events.EventManager,
 
 class RandomPieceStrategy(Strategy):
 
-    def act(self):
-        for peer, pieces in self._get_interesting_peers():
-            self._torrent.dispatch(peer, messages.Interested)
-
-        for peer in self._get_priority_peers():
-            for i, p_index in enumerate(peer.wanted_pieces):
-                if self._torrent.piece_record[p_index]:
-                    block_index = max(self._torrent
-                                          .piece_record[p_index].keys(),
-                                      key=lambda x: x[1])[1]
-                else:
-                    block_index = 0
-                self._torrent.dispatch(peer, messages.Request, p_index,
-                                       block_index, config.MAX_REQUEST_AMOUNT)
-
-    def choose_random_piece(self, n):
-        return random.shuffle([k for k, v in self._torrent.piece_record.items()
-                               if v != self._torrent.piece_length])[:n]
-
-default_set = ((events.INIT_EVENT,  RandomPieceStrategy), )
+    def _candidates(self, peer):
+        pieces = list(self._torrent.picker.wanted_pieces(peer.has))
+        random.shuffle(pieces)
+        return pieces
+
+
+class RarestFirstStrategy(Strategy):
+
+    def _candidates(self, peer):
+        return self._torrent.picker.candidates(peer.has,
+                                               self._torrent.partial)
+
+default_set = ((events.TorrentInitiated,  RarestFirstStrategy), )
@@ -0,0 +1,244 @@
+import io
+import os
+import socket
+import config
+import logging
+import torrent_exceptions
+from hashlib import sha1
+from multiprocessing import Process, Pipe, cpu_count
+from multiprocessing.reduction import send_handle, recv_handle
+from main import BitTorrentClient
+from reactor import Reactor
+from timers import TimerScheduler
+from utils import bdecode,  bencode
+
+'''Sharded mode: a supervisor process owns the listening socket and hands
+each incoming connection to the worker process running the torrent its
+handshake asks for. Every worker is an ordinary BitTorrentClient with a
+subset of the torrents, so the work spreads over as many cores as there
+are workers.'''
+
+logger = logging.getLogger(__name__)
+
+
+def info_hash_of(filename):
+    with io.open(filename, 'rb') as f:
+        return sha1(bencode(bdecode(f)['info'])).digest()
+
+
+class Supervisor(torrent_exceptions.ExceptionManager, object):
+    '''Starts the workers, routes incoming connections by info hash and
+    collects the stats the workers report'''
+
+    def __init__(self, filenames, workers=None, port=config.DEFAULT_PORT,
+                 client_id=config.CLIENT_ID):
+        self.port,  self.client_id = port,  client_id
+        workers = workers or cpu_count()
+        logger.info('Supervising %d workers on port %d', workers, port)
+
+        self._reactor = Reactor()
+        self._timers = TimerScheduler()
+        self._owners = {}  # info hash -> WorkerHandle
+        self.stats = {}  # worker index -> latest report
+
+        for index in range(workers):
+            shard = filenames[index::workers]
+            if not shard:
+                continue
+
+            parent_end, child_end = Pipe()
+            process = Process(target=run_worker,
+                              args=(child_end, shard, port, client_id))
+            process.daemon = True
+            process.start()
+            child_end.close()
+
+            worker = WorkerHandle(index, process, parent_end, self)
+            self._watch(worker)
+            for filename in shard:
+                self._owners[info_hash_of(filename)] = worker
+
+        s = socket.socket()
+        s.bind((socket.gethostname(), self.port))
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.listen(config.MAX_LISTEN)
+
+        self._socket = s
+        self._reactor.register(self, read=self._accept_connection)
+
+        self._timers.add(config.STATS_INTERVAL, self._log_stats,
+                         self.handle_exception, repeat=True)
+
+        self._exception_handlers = {}
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def aggregate_stats(self):
+        '''Sums the latest per-torrent reports of every worker'''
+        totals = {}
+        for report in self.stats.values():
+            for torrent_stats in report.values():
+                for key, value in torrent_stats.items():
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def run_loop(self):
+        logger.info('Beginning supervisor loop...')
+        while True:
+            self._timers.run_due()
+            self._reactor.dispatch(
+                self._reactor.poll(self._timers.time_until_next()))
+
+    def hand_off(self, pending, info_hash):
+        '''Called once a pending connection has revealed its info hash'''
+        self._forget(pending)
+
+        try:
+            worker = self._owners[info_hash]
+        except KeyError:
+            logger.info('Dropping handshake for unknown torrent')
+        else:
+            worker.hand_off(pending.socket, pending.received)
+        pending.socket.close()  # the worker has its own copy now
+
+    def drop_pending(self, pending):
+        self._forget(pending)
+        pending.socket.close()
+
+    def _accept_connection(self):
+        sock,  address = self._socket.accept()
+        logger.info('Connecting at %s.', address)
+
+        pending = PendingHandshake(sock, self)
+        pending.timer = self._timers.add(config.HANDSHAKE_TIMEOUT,
+                                         lambda: self.drop_pending(pending),
+                                         self.handle_exception)
+        self._reactor.register(pending, read=pending.handle_incoming,
+                               error=lambda e: self.drop_pending(pending))
+
+    def _watch(self, worker):
+        self._reactor.register(worker, read=worker.handle_incoming,
+                               error=lambda e: self._worker_exited(worker))
+
+    def _forget(self, pending):
+        self._reactor.unregister(pending)
+        pending.timer.cancel()
+
+    def _worker_exited(self, worker):
+        logger.warning('Worker %d exited', worker.index)
+        self._reactor.unregister(worker)
+        self.stats.pop(worker.index, None)
+        worker.close()
+
+    def _log_stats(self):
+        logger.info('Aggregate stats: %s', self.aggregate_stats())
+
+
+class PendingHandshake(object):
+    '''A connection the supervisor is reading the start of the handshake
+    from. Everything read is passed on to the worker with the socket.'''
+
+    def __init__(self, sock, supervisor):
+        self.socket = sock
+        self.received = b''
+        self.timer = None
+        self._supervisor = supervisor
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def handle_incoming(self):
+        data = self.socket.recv(config.DEFAULT_READ_AMOUNT)
+        if not data:
+            self._supervisor.drop_pending(self)
+            return
+
+        self.received += data
+        pstrlen = ord(self.received[0:1])
+        # length prefix, protocol string and reserved bytes come first
+        start = 1 + pstrlen + 8
+        if len(self.received) >= start + 20:
+            self._supervisor.hand_off(self, self.received[start:start+20])
+
+    def handle_exception(self, e):
+        self._supervisor.drop_pending(self)
+
+
+class WorkerHandle(object):
+    '''Supervisor's end of the pipe to one worker process'''
+
+    def __init__(self, index, process, conn, supervisor):
+        self.index = index
+        self.process = process
+        self._conn = conn
+        self._supervisor = supervisor
+
+    def fileno(self):
+        return self._conn.fileno()
+
+    def hand_off(self, sock, received):
+        self._conn.send(received)
+        send_handle(self._conn, sock.fileno(), self.process.pid)
+
+    def close(self):
+        self._conn.close()
+
+    def handle_incoming(self):
+        try:
+            self._supervisor.stats[self.index] = self._conn.recv()
+        except EOFError:
+            self._supervisor._worker_exited(self)
+
+    def handle_exception(self, e):
+        self._supervisor.handle_exception(e)
+
+
+class HandoffReceiver(torrent_exceptions.ExceptionManager, object):
+    '''Worker's end of the pipe: adopts the connections the supervisor
+    passes down and reports stats back up'''
+
+    def __init__(self, conn, client):
+        self._conn = conn
+        self._client = client
+        self.next_exception_level = client
+        self._exception_handlers = {}
+
+    def fileno(self):
+        return self._conn.fileno()
+
+    def handle_incoming(self):
+        received = self._conn.recv()
+        fd = recv_handle(self._conn)
+        sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)  # fromfd made a duplicate
+        self._client.adopt_connection(sock, received)
+
+    def report_stats(self):
+        self._conn.send({manager.hashed_info: manager.stats()
+                         for manager in self._client.managers})
+
+
+def run_worker(conn, filenames, port, client_id):
+    '''Entry point of a worker process'''
+    client = BitTorrentClient(port, client_id, listen=False)
+    for filename in filenames:
+        client.start_torrent(filename)
+
+    receiver = HandoffReceiver(conn, client)
+    client.register(receiver, read=receiver.handle_incoming)
+    client.add_timer(config.STATS_INTERVAL, receiver.report_stats,
+                     client.handle_exception, repeat=True)
+    client.run_loop()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run torrents sharded '
+                                     'across worker processes')
+    parser.add_argument('torrents', nargs='+')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes (default: cores)')
+    args = parser.parse_args()
+
+    Supervisor(args.torrents, workers=args.workers).run_loop()
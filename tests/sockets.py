@@ -0,0 +1,26 @@
+import socket
+
+'''Connected loopback TCP sockets for tests that push real bytes through
+peers. Peers need an address, so a socketpair won't do.'''
+
+
+def tcp_pair():
+    '''(ours, theirs): two ends of one connection'''
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    ours = socket.create_connection(listener.getsockname())
+    theirs, _ = listener.accept()
+    listener.close()
+    return ours, theirs
+
+
+def recv_exactly(sock, amount, timeout=5):
+    sock.settimeout(timeout)
+    data = b''
+    while len(data) < amount:
+        chunk = sock.recv(amount - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+import messages
+import torrent_exceptions
+from buffers import FileSegment
+from tests.sockets import tcp_pair, recv_exactly
+
+try:
+    import asyncio
+    from asyncio_client import AsyncioBitTorrentClient, PeerProtocol
+except ImportError:  # Python 2 without trollius
+    asyncio = None
+
+
+class Strategy(object):
+    '''Stands in for the strategy of a torrent the peer's been matched
+    to, noting the exceptions it's handed'''
+
+    def __init__(self):
+        self.exceptions = []
+
+    def handle_exception(self, e, e_type=None):
+        self.exceptions.append(e)
+
+
+class ProtocolTestCase(unittest.TestCase):
+    '''A peer on one end of a connection the loop has taken on'''
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncioBitTorrentClient(port=0, loop=self.loop)
+        self.ours, self.theirs = tcp_pair()
+        _, self.protocol = self.loop.run_until_complete(
+            self.loop.connect_accepted_socket(
+                lambda: PeerProtocol(self.client), self.ours))
+        self.peer = self.protocol.peer
+
+    def tearDown(self):
+        self.theirs.close()
+        self.client._server.close()
+        self.loop.run_until_complete(self.client._server.wait_closed())
+        self.loop.close()
+
+    def run_loop(self):
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+
+@unittest.skipIf(asyncio is None, 'needs asyncio')
+class ConnectionLostTest(ProtocolTestCase):
+    '''The remote end closing a connection reaches whoever handles the
+    peer's exceptions'''
+
+    def test_unmatched_peer_dropped(self):
+        self.theirs.close()
+        self.run_loop()
+        self.assertFalse(self.peer.active)
+
+    def test_matched_peer_reaches_strategy(self):
+        strategy = Strategy()
+        self.peer.next_exception_level = strategy
+        self.theirs.close()
+        self.run_loop()
+        e, = strategy.exceptions
+        self.assertIsInstance(e, torrent_exceptions.ConnectionLost)
+        self.assertIs(e.peer, self.peer)
+
+    def test_no_exception_after_our_drop(self):
+        strategy = Strategy()
+        self.peer.next_exception_level = strategy
+        self.peer.drop()
+        self.run_loop()
+        self.assertEqual(strategy.exceptions, [])
+
+
+@unittest.skipIf(asyncio is None, 'needs asyncio')
+class FlushTest(ProtocolTestCase):
+    '''More in the outbox than one send takes: a hundred Haves and a
+    block served from a file'''
+
+    def setUp(self):
+        super(FlushTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.block = os.urandom(2**14)
+        path = os.path.join(self.directory, 'piece')
+        with open(path, 'wb') as f:
+            f.write(self.block)
+
+        for index in range(100):
+            self.peer.enqueue_message(messages.Have(index))
+        self.peer.enqueue_piece(0, 0, [FileSegment(os.open(path, os.O_RDONLY),
+                                                   0, len(self.block))])
+        self.expected = b''.join(messages.Have(i).encode()
+                                 for i in range(100)) + \
+            messages.Piece(0, 0, self.block).encode()
+
+    def tearDown(self):
+        super(FlushTest, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_outbox_drained(self):
+        self.run_loop()
+        self.assertEqual(len(self.peer.outbox), 0)
+        self.assertEqual(recv_exactly(self.theirs, len(self.expected)),
+                         self.expected)
+        # only the block counts towards what the tracker's told
+        self.assertEqual((self.peer.up.total, self.peer.up.payload),
+                         (len(self.expected), len(self.block)))
+
+    def test_paused_until_resumed(self):
+        self.protocol.pause_writing()
+        self.run_loop()
+        self.assertEqual(len(self.peer.outbox), len(self.expected))
+        self.protocol.resume_writing()
+        self.run_loop()
+        self.assertEqual(len(self.peer.outbox), 0)
+        self.assertEqual(recv_exactly(self.theirs, len(self.expected)),
+                         self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
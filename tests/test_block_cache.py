@@ -0,0 +1,140 @@
+import os
+import random
+import unittest
+from hashlib import sha1
+from block_cache import BlockCache, CachedPiece
+
+BLOCK = 4
+PIECE = 2 * BLOCK
+
+
+class Owner(object):
+    '''Stands in for a FileHandler, noting the pieces flushed to it'''
+
+    def __init__(self):
+        self.flushed = []
+
+    def flush_cached(self, index, piece):
+        self.flushed.append((index, piece))
+
+
+class BlockCacheTest(unittest.TestCase):
+    '''A budget of three two-block pieces'''
+
+    def setUp(self):
+        self.cache = BlockCache(budget=3 * PIECE, block_size=BLOCK)
+        self.owner = Owner()
+
+    def put(self, index, begin=0, owner=None):
+        self.cache.put(owner or self.owner, index, PIECE, begin,
+                       bytearray([index]) * BLOCK)
+
+    def test_within_budget(self):
+        for index in range(3):
+            self.put(index)
+        self.assertEqual((len(self.cache), self.cache.size), (3, 3 * PIECE))
+        self.assertEqual(self.cache.evictions, 0)
+        self.assertEqual(self.owner.flushed, [])
+
+    def test_least_recently_written_evicted(self):
+        for index in range(3):
+            self.put(index)
+        self.put(0, BLOCK)  # 1 is now the stalest
+        self.put(3)
+        (index, piece), = self.owner.flushed
+        self.assertEqual(index, 1)
+        self.assertEqual(list(piece.runs()), [(0, BLOCK)])
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertIsNone(self.cache.take(self.owner, 1))
+
+    def test_evicted_until_released(self):
+        for index in range(4):
+            self.put(index)
+        self.assertEqual(len(self.owner.flushed), 1)
+        self.assertEqual((self.cache.size, self.cache.in_flight),
+                         (3 * PIECE, PIECE))
+        self.put(4)  # just one more goes; the first is on its way out
+        self.assertEqual(self.cache.evictions, 2)
+        for _, piece in self.owner.flushed:
+            self.cache.release(piece)
+        self.assertEqual(self.cache.in_flight, 0)
+
+    def test_taken_pieces_fill_the_cache(self):
+        self.put(0)
+        self.put(1)
+        first = self.cache.take(self.owner, 0)
+        self.assertFalse(self.cache.full)
+        second = self.cache.take(self.owner, 1)
+        self.assertTrue(self.cache.full)  # half the budget waiting on disk
+        self.put(2)
+        self.put(3)  # taken pieces count against the budget too
+        self.assertEqual([index for index, _ in self.owner.flushed], [2])
+        self.cache.release(first)
+        self.cache.release(second)
+        self.assertFalse(self.cache.full)
+
+    def test_budget_shared_by_owners(self):
+        other = Owner()
+        self.put(0)
+        self.put(0, owner=other)
+        self.put(1)
+        self.put(1, owner=other)
+        self.assertEqual([index for index, _ in self.owner.flushed], [0])
+        self.assertEqual(other.flushed, [])
+
+    def test_flush_one_owner(self):
+        other = Owner()
+        self.put(0)
+        self.put(0, owner=other)
+        self.cache.flush(self.owner)
+        self.assertEqual([index for index, _ in self.owner.flushed], [0])
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.in_flight, PIECE)
+
+
+class HashTest(unittest.TestCase):
+    '''A piece of five blocks, the last one short'''
+
+    def setUp(self):
+        self.data = os.urandom(4 * BLOCK + 1)
+        self.piece = CachedPiece(len(self.data), BLOCK)
+
+    def put(self, block):
+        begin = block * BLOCK
+        self.piece.put(begin, self.data[begin:begin + BLOCK])
+
+    def test_in_order(self):
+        for block in range(5):
+            self.put(block)
+            self.assertEqual(self.piece.hashed,
+                             min((block + 1) * BLOCK, len(self.data)))
+        self.assertTrue(self.piece.complete)
+        self.assertEqual(self.piece.digest(), sha1(self.data).digest())
+
+    def test_gap_filled(self):
+        for block in (0, 2, 3):
+            self.put(block)
+        self.assertEqual(self.piece.hashed, BLOCK)  # stopped at the gap
+        self.put(1)
+        self.assertEqual(self.piece.hashed, 4 * BLOCK)  # and ran on past it
+        self.put(4)
+        self.assertEqual(self.piece.digest(), sha1(self.data).digest())
+
+    def test_any_order(self):
+        for _ in range(10):
+            self.setUp()
+            blocks = list(range(5))
+            random.shuffle(blocks)
+            for block in blocks:
+                self.put(block)
+            self.assertEqual(self.piece.digest(), sha1(self.data).digest())
+
+    def test_block_put_twice(self):
+        for block in (1, 1, 0, 2, 0, 3, 4):
+            self.put(block)
+        self.assertEqual(self.piece.filled, len(self.data))
+        self.assertEqual(self.piece.digest(), sha1(self.data).digest())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+from block_map import BlockMap
+
+BLOCK = 2**14
+
+
+class WantedTest(unittest.TestCase):
+    '''Two whole pieces of two blocks and a last piece of one'''
+
+    def setUp(self):
+        self.blocks = BlockMap([2 * BLOCK, 2 * BLOCK, BLOCK], BLOCK)
+
+    def assert_counts(self, remaining, unrequested):
+        self.assertEqual((self.blocks.remaining, self.blocks.unrequested),
+                         (remaining, unrequested))
+
+    def test_unwanted_piece_not_counted(self):
+        self.blocks.set_wanted(1, False)
+        self.assert_counts(3, 3)
+        self.blocks.set_wanted(1, False)
+        self.assert_counts(3, 3)
+
+    def test_unwanted_piece_blocks_leave_counts_alone(self):
+        self.blocks.request(1, 0, 'peer')
+        self.blocks.set_wanted(1, False)
+        self.assert_counts(3, 3)
+        self.blocks.release(1, 0, 'peer')
+        self.blocks.request(1, BLOCK, 'peer')
+        self.blocks.receive(1, BLOCK)
+        self.assert_counts(3, 3)
+        self.blocks.reset(1)
+        self.assert_counts(3, 3)
+
+    def test_wanted_again(self):
+        self.blocks.set_wanted(1, False)
+        self.blocks.request(1, 0, 'peer')
+        self.blocks.receive(1, BLOCK)
+        self.blocks.set_wanted(1, True)
+        self.assert_counts(4, 3)
+        self.blocks.receive(1, 0)
+        self.assert_counts(3, 3)
+
+
+class DuplicateTest(unittest.TestCase):
+    '''The first block asked of three peers'''
+
+    def setUp(self):
+        self.blocks = BlockMap([2 * BLOCK, BLOCK], BLOCK)
+        for peer in 'abc':
+            self.blocks.request(0, 0, peer)
+
+    def test_duplicates_counted(self):
+        self.assertEqual(self.blocks.duplicate_bytes, 2 * BLOCK)
+        self.blocks.request(0, 0, 'a')
+        self.assertEqual(self.blocks.duplicate_bytes, 2 * BLOCK)
+        self.assertTrue(self.blocks.asked(0, 0, 'a'))
+        self.assertFalse(self.blocks.asked(0, BLOCK, 'a'))
+
+    def test_release(self):
+        self.blocks.release(0, 0, 'a')
+        self.assertEqual(self.blocks.duplicate_bytes, BLOCK)
+        self.blocks.release_peer('b')
+        self.blocks.release_peer('c')
+        self.assertEqual(self.blocks.duplicate_bytes, 0)
+        self.assertEqual(self.blocks.unrequested, 3)
+
+    def test_receive(self):
+        self.blocks.receive(0, 0)
+        self.assertEqual(self.blocks.duplicate_bytes, 0)
+        self.blocks.release_peer('a')
+        self.assertEqual(self.blocks.duplicate_bytes, 0)
+
+    def test_reset(self):
+        self.blocks.reset(0)
+        self.assertEqual(self.blocks.duplicate_bytes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
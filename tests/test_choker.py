@@ -0,0 +1,99 @@
+import config
+import unittest
+from choker import TitForTatChoker
+
+
+class Peer(object):
+    '''Just what a choker looks at'''
+
+    def __init__(self, name, down=0.0, up=0.0, interested=True,
+                 snubbed=False, connected_at=0.0):
+        self.name = name
+        self.download_rate, self.upload_rate = down, up
+        self.interested_me = interested
+        self.snubbed = snubbed
+        self.active = True
+        self.connected_at = connected_at
+        self.unchoked_at = 0.0
+
+    def __repr__(self):
+        return self.name
+
+
+class ChokerTestCase(unittest.TestCase):
+    '''Four slots, one of them optimistic, and peers connected long
+    enough ago not to count as new'''
+
+    def setUp(self):
+        self.now = 1000.0
+        self.choker = TitForTatChoker(slots=4, clock=lambda: self.now)
+        self.peers = [Peer(str(i), down=i, up=10 - i) for i in range(10)]
+
+    def regular(self, unchoked):
+        return unchoked - set([self.choker.optimistic])
+
+
+class LeechingTest(ChokerTestCase):
+
+    def test_fastest_downloads_reciprocated(self):
+        unchoked = self.choker.choose(self.peers, False, 0)
+        self.assertEqual(len(unchoked), 4)
+        self.assertEqual(self.regular(unchoked), set(self.peers[7:]))
+        self.assertIn(self.choker.optimistic, self.peers[:7])
+        for peer in unchoked:
+            self.assertEqual(peer.unchoked_at, self.now)
+
+    def test_uninterested_and_snubbed_passed_over(self):
+        self.peers[9].interested_me = False
+        self.peers[8].snubbed = True
+        unchoked = self.choker.choose(self.peers, False, 0)
+        self.assertEqual(self.regular(unchoked), set(self.peers[5:8]))
+        self.assertNotIn(self.peers[9], unchoked)
+
+    def test_optimistic_kept_for_its_rounds(self):
+        self.choker.choose(self.peers, False, 0)
+        optimistic = self.choker.optimistic
+        for _ in range(config.OPTIMISTIC_UNCHOKE_ROUNDS - 1):
+            unchoked = self.choker.choose(self.peers, False, 0)
+            self.assertIn(optimistic, unchoked)
+            self.assertIs(self.choker.optimistic, optimistic)
+
+    def test_new_peers_likelier_optimistic_picks(self):
+        new = Peer('new', connected_at=self.now)
+        candidates = self.peers[:7] + [new]
+        picks = [self.choker._pick_optimistic(candidates)
+                 for _ in range(2000)]
+        # three chances in ten against one in ten for each of the others
+        self.assertGreater(picks.count(new), 2 * picks.count(self.peers[0]))
+
+
+class SeedingTest(ChokerTestCase):
+
+    def test_fastest_uploads_favoured(self):
+        self.peers[0].snubbed = True  # doesn't matter to a seed
+        unchoked = self.choker.choose(self.peers, True, 0)
+        self.assertEqual(self.regular(unchoked), set(self.peers[:3]))
+
+    def test_round_robin(self):
+        self.addCleanup(setattr, config, 'SEED_ROUND_ROBIN',
+                        config.SEED_ROUND_ROBIN)
+        config.SEED_ROUND_ROBIN = True
+        for i, peer in enumerate(self.peers):
+            peer.unchoked_at = i
+        unchoked = self.choker.choose(self.peers, True, 0)
+        self.assertEqual(self.regular(unchoked), set(self.peers[:3]))
+
+
+class SlotsTest(unittest.TestCase):
+
+    def test_scaled_with_upload_rate(self):
+        choker = TitForTatChoker(slots=None)
+        peers = [Peer(str(i), down=i) for i in range(20)]
+        self.assertEqual(len(choker.choose(peers, False, 0)), 2)
+        self.assertEqual(len(choker.choose(peers, False, 100 * 1024)), 7)
+        # the peak is kept, so a quiet round doesn't take slots away
+        self.assertEqual(len(choker.choose(peers, False, 0)), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import logging
+import threading
+import unittest
+from disk_io import DiskQueue, InlineQueue
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+class DiskQueueTest(unittest.TestCase):
+    '''Two workers, with callbacks waiting until the test runs them as
+    the loop would'''
+
+    def setUp(self):
+        self.calls = queue.Queue()
+        self.disk = DiskQueue(self.calls.put, threads=2, depth=2)
+        self.results = []
+        self.owner = object()
+
+    def run_callbacks(self, count):
+        for _ in range(count):
+            self.calls.get(timeout=5)()
+
+    def test_callback_on_the_loop(self):
+        worker = []
+
+        def job():
+            worker.append(threading.current_thread())
+            return 'done'
+        self.disk.submit(self.owner, 0, job, self.results.append)
+        self.assertEqual(self.disk.stats(self.owner).depth, 1)
+        self.run_callbacks(1)
+        self.assertEqual(self.results, ['done'])
+        self.assertIsNot(worker[0], threading.current_thread())
+        stats = self.disk.stats(self.owner)
+        self.assertEqual((stats.depth, stats.jobs), (0, 1))
+
+    def test_same_key_in_order(self):
+        ran = []
+        for i in range(20):
+            self.disk.submit(self.owner, 'piece', lambda i=i: ran.append(i),
+                             self.results.append)
+        self.run_callbacks(20)
+        self.assertEqual(ran, list(range(20)))
+        self.assertEqual(self.results, [None] * 20)
+
+    def test_failed_job_calls_back_with_none(self):
+        logger = logging.getLogger('disk_io')
+        logger.disabled = True
+        self.addCleanup(setattr, logger, 'disabled', False)
+        self.disk.submit(self.owner, 0, lambda: 1 // 0, self.results.append)
+        self.run_callbacks(1)
+        self.assertEqual(self.results, [None])
+
+    def test_full_per_owner(self):
+        release = threading.Event()
+        for _ in range(2):
+            self.disk.submit(self.owner, 0, release.wait)
+        self.assertTrue(self.disk.full(self.owner))
+        self.assertFalse(self.disk.full(object()))
+        release.set()
+        self.run_callbacks(2)
+        self.assertFalse(self.disk.full(self.owner))
+
+
+class InlineQueueTest(unittest.TestCase):
+
+    def test_runs_at_once(self):
+        disk, results = InlineQueue(), []
+        disk.submit(self, 0, lambda: 'done', results.append)
+        self.assertEqual(results, ['done'])
+        self.assertEqual(disk.stats(self).depth, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import os
+import shutil
+import tempfile
+import unittest
+from hashlib import sha1
+from block_cache import BlockCache
+from disk_io import InlineQueue
+from file_handler import FileHandler
+from file_pool import FilePool
+
+BLOCK = 2**14
+PIECE = 2 * BLOCK
+
+
+class HeldQueue(InlineQueue):
+    '''Holds jobs until they're run'''
+
+    def __init__(self):
+        super(HeldQueue, self).__init__()
+        self.jobs = []
+
+    def submit(self, owner, key, job, callback=None):
+        self.stats(owner).depth += 1
+        self.jobs.append((owner, job, callback))
+
+    def run(self):
+        jobs, self.jobs = self.jobs, []
+        for owner, job, callback in jobs:
+            self._finish(owner, callback, self._run(job), 0.0, 0.0)
+
+
+class HandlerTestCase(unittest.TestCase):
+    '''Torrents of four two-block pieces, all in one file'''
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.pool = FilePool(capacity=4)
+        self.data = os.urandom(4 * PIECE)
+
+    def tearDown(self):
+        self.pool.close_all()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def handler(self, name, cache, disk):
+        hashes = [sha1(self.data[i:i + PIECE]).digest()
+                  for i in range(0, len(self.data), PIECE)]
+        return FileHandler(name, [{'path': ['data'],
+                                   'length': len(self.data)}],
+                           [PIECE] * 4, hashes, pool=self.pool, cache=cache,
+                           disk=disk)
+
+    def write_piece(self, handler, index):
+        for begin in range(0, PIECE, BLOCK):
+            start = index * PIECE + begin
+            handler.write(index, begin, self.data[start:start + BLOCK])
+
+
+class InFlightTest(HandlerTestCase):
+    '''Pieces waiting on the disk still count against the cache budget,
+    which all torrents share'''
+
+    def setUp(self):
+        super(InFlightTest, self).setUp()
+        self.cache = BlockCache(budget=4 * PIECE, block_size=BLOCK)
+        self.disk = HeldQueue()
+        self.handlers = [self.handler(name, self.cache, self.disk)
+                         for name in ('a', 'b')]
+        self.checked = []
+
+    def test_checked_pieces_count_until_done(self):
+        a, b = self.handlers
+        self.write_piece(a, 0)
+        a.check_piece(0, self.checked.append)
+        self.assertEqual((self.cache.size, self.cache.in_flight), (0, PIECE))
+        self.assertFalse(b.backlogged)
+
+        self.write_piece(b, 1)
+        b.check_piece(1, self.checked.append)
+        self.assertTrue(self.cache.full)
+        self.assertTrue(a.backlogged)
+        self.assertTrue(b.backlogged)
+
+        self.disk.run()
+        self.assertEqual(self.checked, [True, True])
+        self.assertEqual(self.cache.in_flight, 0)
+        self.assertFalse(a.backlogged)
+
+    def test_evicted_pieces_count_until_written(self):
+        a, b = self.handlers
+        for index in range(3):
+            self.write_piece(a, index)
+            a.check_piece(index, self.checked.append)
+        self.write_piece(b, 0)
+        self.write_piece(b, 1)  # over budget with three still queued
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual((self.cache.size, self.cache.in_flight),
+                         (PIECE, 4 * PIECE))
+        self.write_piece(b, 2)  # the evicted piece is on its way out
+        self.assertEqual(self.cache.evictions, 2)
+
+        self.disk.run()
+        self.assertEqual(self.cache.in_flight, 0)
+        self.assertEqual(self.cache.size, PIECE)
+        b.check_piece(1, self.checked.append)
+        b.check_piece(0, self.checked.append)
+        self.assertEqual(self.checked, [True] * 3)  # both still queued
+        self.disk.run()
+        self.assertEqual(self.checked, [True] * 5)  # read back from disk
+
+
+class BlockToFilesTest(HandlerTestCase):
+    '''Eight-byte pieces over files of 10, 0, 6, 0 and 16 bytes'''
+
+    lengths = 10, 0, 6, 0, 16
+
+    def setUp(self):
+        super(BlockToFilesTest, self).setUp()
+        self.data = os.urandom(32)
+        files = [{'path': [name], 'length': length}
+                 for name, length in zip('abcde', self.lengths)]
+        hashes = [sha1(self.data[i:i + 8]).digest() for i in range(0, 32, 8)]
+        self.files = FileHandler('files', files, [8] * 4, hashes,
+                                 pool=self.pool,
+                                 cache=BlockCache(block_size=4),
+                                 disk=InlineQueue())
+
+    def spans(self, piece, offset, length):
+        return [(os.path.basename(path), seek, amount) for path, seek, amount
+                in self.files._block_to_files(piece, offset, length)]
+
+    def test_inside_one_file(self):
+        self.assertEqual(self.spans(0, 2, 4), [('a', 2, 4)])
+        self.assertEqual(self.spans(2, 0, 8), [('e', 0, 8)])
+
+    def test_across_an_empty_file(self):
+        self.assertEqual(self.spans(1, 0, 8), [('a', 8, 2), ('c', 0, 6)])
+
+    def test_starting_where_empty_files_do(self):
+        self.assertEqual(self.spans(1, 2, 4), [('c', 0, 4)])
+        self.assertEqual(self.spans(2, 0, 2), [('e', 0, 2)])
+
+    def test_ending_on_a_boundary(self):
+        self.assertEqual(self.spans(0, 0, 10), [('a', 0, 10)])
+
+    def test_past_the_end(self):
+        self.assertEqual(self.spans(3, 0, 8), [('e', 8, 8)])
+        self.assertRaises(ValueError, list,
+                          self.files._block_to_files(3, 4, 8))
+
+    def test_pieces_written_across_files(self):
+        checked = []
+        for index in range(4):
+            for begin in (0, 4):
+                start = index * 8 + begin
+                self.files.write(index, begin, self.data[start:start + 4])
+            self.files.check_piece(index, checked.append)
+        self.assertEqual(checked, [True] * 4)
+        self.pool.close_all()
+
+        start = 0
+        for path, length in zip(self.files._file_paths, self.lengths):
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), self.data[start:start + length])
+            start += length
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+from file_pool import FilePool
+
+
+class FilePoolTest(unittest.TestCase):
+    '''A pool of two descriptors over four files'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.directory, name) for name in 'abcd']
+        self.pool = FilePool(capacity=2)
+
+    def tearDown(self):
+        self.pool.close_all()
+        shutil.rmtree(self.directory)
+
+    def open_paths(self):
+        return list(self.pool._files)
+
+    def test_least_recently_used_closed(self):
+        a, b, c, _ = self.paths
+        self.pool.write(a, 0, b'a')
+        self.pool.write(b, 0, b'b')
+        self.pool.read(a, 0, 1)  # b is now the stalest
+        self.pool.write(c, 0, b'c')
+        self.assertEqual(self.open_paths(), [a, c])
+
+    def test_reopened_where_it_left_off(self):
+        a, b, c, _ = self.paths
+        self.pool.write(a, 0, b'first')
+        self.pool.write(b, 0, b'b')
+        self.pool.write(c, 0, b'c')
+        self.assertNotIn(a, self.open_paths())
+        self.pool.write(a, 5, b' second')
+        self.assertEqual(self.pool.read(a, 0, 12), b'first second')
+        self.assertEqual(len(self.pool), 2)
+
+    def test_descriptors_in_use_kept_open(self):
+        a, b, c, d = self.paths
+        fd = self.pool.acquire(a)
+        for path in (b, c, d):
+            self.pool.write(path, 0, b'x')
+        self.assertIn(a, self.open_paths())
+        self.assertEqual(len(self.pool), 2)
+        os.write(fd, b'still open')
+
+        self.pool.acquire(b)
+        self.pool.acquire(c)  # over capacity while all three are lent out
+        self.assertEqual(len(self.pool), 3)
+        self.pool.release(a)
+        self.assertEqual(self.open_paths(), [b, c])
+        self.pool.release(b)
+        self.pool.release(c)
+
+    def test_close_waits_for_users(self):
+        a = self.paths[0]
+        self.pool.acquire(a)
+        self.pool.close(a)
+        self.assertIn(a, self.open_paths())
+        self.pool.release(a)
+        self.pool.close(a)
+        self.assertEqual(self.open_paths(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
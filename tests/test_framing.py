@@ -0,0 +1,30 @@
+import struct
+import unittest
+import messages
+import torrent_exceptions
+from framing import FrameDecoder
+
+
+class ShortBodyTest(unittest.TestCase):
+    '''A frame too short for its message's fields is a parsing error'''
+
+    def decode(self, frame):
+        decoder = FrameDecoder(expect_handshake=False)
+        decoder.feed(frame)
+        return list(decoder.messages())
+
+    def test_short_have(self):
+        with self.assertRaises(torrent_exceptions.MessageParsingError):
+            self.decode(struct.pack('>IBH', 3, messages.Have.id, 1))
+
+    def test_short_piece(self):
+        with self.assertRaises(torrent_exceptions.MessageParsingError):
+            self.decode(struct.pack('>IBI', 5, messages.Piece.id, 0))
+
+    def test_whole_request(self):
+        msg, = self.decode(messages.Request(1, 2, 3).encode())
+        self.assertEqual(msg.get_triple(), (1, 2, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import messages
+from framing import FrameDecoder
+
+SAMPLES = [messages.KeepAlive(), messages.Choke(), messages.Unchoke(),
+           messages.Interested(), messages.NotInterested(),
+           messages.Have(2**32 - 1), messages.Bitfield(b'\xff\x80'),
+           messages.Request(1, 2**14, 2**14),
+           messages.Piece(3, 2**15, b'block' * 100),
+           messages.Cancel(1, 2**14, 2**14), messages.Port(6881),
+           messages.SuggestPiece(4), messages.HaveAll(),
+           messages.HaveNone(), messages.RejectRequest(5, 0, 2**14),
+           messages.AllowedFast(6)]
+
+
+def payload(msg):
+    '''A message's fields, with any block copied out of the buffer'''
+    return tuple(value.tobytes() if isinstance(value, memoryview) else value
+                 for value in msg.payload)
+
+
+class RoundTripTest(unittest.TestCase):
+    '''Every message decodes to what was encoded'''
+
+    def decode(self, data, chunk=None):
+        decoder = FrameDecoder(expect_handshake=False)
+        chunk = chunk or len(data)
+        decoded = []
+        for i in range(0, len(data), chunk):
+            decoded.extend((type(msg), payload(msg))
+                           for msg in decoder.feed(data[i:i + chunk]))
+        return decoded
+
+    def expected(self):
+        return [(type(msg), msg.payload) for msg in SAMPLES]
+
+    def test_each_message(self):
+        for msg in SAMPLES:
+            self.assertEqual(self.decode(msg.encode()),
+                             [(type(msg), msg.payload)])
+
+    def test_back_to_back(self):
+        data = b''.join(msg.encode() for msg in SAMPLES)
+        self.assertEqual(self.decode(data), self.expected())
+
+    def test_a_byte_at_a_time(self):
+        data = b''.join(msg.encode() for msg in SAMPLES)
+        self.assertEqual(self.decode(data, 1), self.expected())
+
+    def test_fixed_messages_shared(self):
+        self.assertIs(messages.Choke().encode(), messages.Choke().encode())
+        self.assertEqual(messages.HaveAll().encode(), b'\x00\x00\x00\x01\x0e')
+
+    def test_handshake(self):
+        sent = messages.Handshake(b'-TS0001-' + b'0' * 12, b'i' * 20,
+                                  reserved=b'\x00' * 7 + b'\x04')
+        decoder = FrameDecoder()
+        msgs = list(decoder.feed(sent.encode() + messages.HaveAll().encode()))
+        received, have_all = msgs
+        self.assertEqual((received.pstr, received.reserved,
+                          received.info_hash, received.peer_id),
+                         (sent.pstr, sent.reserved, sent.info_hash,
+                          sent.peer_id))
+        self.assertIsInstance(have_all, messages.HaveAll)
+        self.assertEqual(received.EVENT_TYPE, messages.INCOMING)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import time
+import struct
+import config
+import unittest
+import messages
+from rates import RateMeter
+from tests.test_reactor import ClientTestCase
+from tests.torrents import TorrentTestCase, PIECE_LENGTH, python2_only
+
+
+@python2_only
+class RequestRangeTest(TorrentTestCase):
+    '''Requests and cancels must lie inside a piece; the last is short'''
+
+    def test_request_in_range(self):
+        self.send(messages.Request(2, 0, PIECE_LENGTH // 2))
+        self.assertTrue(self.peer.active)
+        self.assertIn(self.peer.address, self.torrent.peers)
+
+    def test_request_past_last_piece(self):
+        self.send(messages.Request(3, 0, 2**14))
+        self.assert_dropped()
+
+    def test_request_running_into_next_piece(self):
+        self.send(messages.Request(0, PIECE_LENGTH - 2**13, 2**14))
+        self.assert_dropped()
+
+    def test_request_past_end_of_short_last_piece(self):
+        self.send(messages.Request(2, PIECE_LENGTH // 2 - 2**13, 2**14))
+        self.assert_dropped()
+
+    def test_cancel_out_of_range(self):
+        self.send(messages.Cancel(2**20, 0, 2**14))
+        self.assert_dropped()
+
+
+@python2_only
+class ShortMessageTest(TorrentTestCase):
+
+    def test_short_have_drops_peer(self):
+        self.theirs.sendall(struct.pack('>IBH', 3, messages.Have.id, 1))
+        self.loop_once()
+        self.assert_dropped()
+
+
+class RequestQueueTest(ClientTestCase):
+
+    def answer(self, index, sent_ago):
+        '''Has a block arrive for a request sent sent_ago seconds back'''
+        self.peer.outstanding_requests[(index, 0)] = time.time() - sent_ago
+        msg = messages.Piece(index, 0, b'', msg_event=messages.INCOMING)
+        msg.peer = self.peer
+        self.peer.handle_message_event(msg)
+
+    def test_fastest_round_trip_is_kept(self):
+        self.answer(0, 2.0)
+        self.answer(1, 0.5)
+        self.answer(2, 4.0)  # sat in the peer's queue
+        self.assertAlmostEqual(self.peer.request_rtt, 0.5, places=1)
+
+    def test_depth_covers_round_trip(self):
+        now = [0.0]
+        self.peer.down = RateMeter(clock=lambda: now[0])
+        for _ in range(config.RATE_WINDOW):
+            self.peer.down.add(20 * config.MAX_REQUEST_AMOUNT)
+            now[0] += 1
+        nearby = self.peer.request_queue_depth
+
+        self.peer.request_rtt = 2.0
+        blocks_per_second = self.peer.download_rate / \
+            config.MAX_REQUEST_AMOUNT
+        self.assertEqual(self.peer.request_queue_depth,
+                         nearby + int(2 * blocks_per_second))
+
+
+if __name__ == '__main__':
+    unittest.main()
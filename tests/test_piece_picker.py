@@ -0,0 +1,161 @@
+import unittest
+import piece_picker
+from bitarray import bitarray
+from piece_picker import PiecePicker, DONT_DOWNLOAD, NORMAL
+
+PIECES = 1024  # enough that half a bitfield is added in bulk
+
+
+def bitfield(indices, length=PIECES):
+    has = bitarray(length)
+    has.setall(False)
+    for index in indices:
+        has[index] = True
+    return has
+
+
+class PickerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.picker = PiecePicker(PIECES)
+
+    def counts(self):
+        return [self.picker.seeds + int(self.picker.availability[i])
+                for i in range(PIECES)]
+
+    def assert_levels(self):
+        '''Every wanted piece is on the level for its priority and count,
+        and on no other'''
+        picker = self.picker
+        for priority, levels in picker._levels.items():
+            for availability, level in enumerate(levels):
+                pieces = list(level.search(piece_picker._ONE)) \
+                    if level is not None else []
+                self.assertEqual(len(pieces),
+                                 picker._sizes[priority][availability])
+                for index in pieces:
+                    self.assertTrue(picker.wanted(index))
+                    self.assertEqual(picker._priority[index], priority)
+                    self.assertEqual(picker.availability[index],
+                                     availability)
+        self.assertEqual(sum(sum(sizes) for sizes in picker._sizes.values()),
+                         picker._wanted.count())
+
+
+class SeedTest(PickerTestCase):
+
+    def setUp(self):
+        super(SeedTest, self).setUp()
+        self.everything = bitfield(range(PIECES))
+
+    def test_seed_only_counted(self):
+        self.picker.add_pieces(self.everything)
+        self.assertEqual(self.picker.seeds, 1)
+        self.assertEqual(len(self.picker.pick(self.everything, 4)), 4)
+        self.picker.remove_pieces(self.everything)
+        self.assertEqual(self.counts(), [0] * PIECES)
+
+    def test_peer_completed_by_haves(self):
+        self.picker.add_pieces(bitfield(range(PIECES // 2)))
+        for index in range(PIECES // 2, PIECES):
+            self.picker.increment(index)
+        self.picker.remove_pieces(self.everything)
+        self.assertEqual(self.counts(), [0] * PIECES)
+        self.assert_levels()
+
+    def test_seed_and_peer_completed_by_haves(self):
+        self.picker.add_pieces(self.everything)
+        self.picker.add_pieces(bitfield(range(1, PIECES)))
+        self.picker.increment(0)
+        self.picker.remove_pieces(self.everything)
+        self.assertEqual(self.counts(), [1] * PIECES)
+        self.picker.remove_pieces(self.everything)
+        self.assertEqual(self.counts(), [0] * PIECES)
+        self.assert_levels()
+
+
+class LevelTest(PickerTestCase):
+    '''Pieces move between levels as bitfields come and go'''
+
+    def test_bulk_and_single_moves(self):
+        halves = bitfield(range(0, PIECES, 2)), bitfield(range(PIECES // 2))
+        few = bitfield(range(5, 50, 3))
+        for has in halves + (few,):
+            self.picker.add_pieces(has)
+            self.assert_levels()
+        self.picker.set_priority(7, NORMAL + 1)
+        self.picker.set_priority(8, DONT_DOWNLOAD)
+        self.picker.have(9)
+        self.picker.add_pieces(halves[0])
+        self.assert_levels()
+        for has in halves + (few, halves[0]):
+            self.picker.remove_pieces(has)
+            self.assert_levels()
+        self.assertEqual(self.counts(), [0] * PIECES)
+        self.picker.lost(9)
+        self.picker.set_priority(7, NORMAL)
+        self.assert_levels()
+
+
+class PickTest(PickerTestCase):
+    '''Two peers' bitfields, leaving pieces 512-767 rarer than 0-511 and
+    nobody with 768 on'''
+
+    rare = list(range(512, 768))
+
+    def setUp(self):
+        super(PickTest, self).setUp()
+        self.picker.add_pieces(bitfield(range(512)))
+        self.has = bitfield(range(768))
+        self.picker.add_pieces(self.has)
+
+    def test_rarest_first(self):
+        for _ in range(3):
+            picked = self.picker.pick(self.has, len(self.rare))
+            self.assertEqual(sorted(picked), self.rare)
+
+    def test_ties_broken_randomly(self):
+        firsts = set(self.picker.pick(self.has, 1)[0] for _ in range(20))
+        self.assertGreater(len(firsts), 1)
+
+    def test_partial_first_and_exclude_passed_over(self):
+        picked = self.picker.pick(self.has, len(self.rare), partial=[5],
+                                  exclude=[600])
+        self.assertEqual(picked[0], 5)
+        self.assertNotIn(600, picked)
+        self.assertEqual(sorted(picked[1:]),
+                         [i for i in self.rare if i != 600])
+
+    def test_raised_priority_first(self):
+        self.picker.set_priority(3, NORMAL + 1)
+        self.assertEqual(self.picker.pick(self.has, 1), [3])
+
+    def test_unwanted_never_picked(self):
+        for index in range(512, 640):
+            self.picker.set_priority(index, DONT_DOWNLOAD)
+        for index in range(640, 768):
+            self.picker.have(index)
+        picked = list(self.picker.candidates(self.has))
+        self.assertEqual(sorted(picked), list(range(512)))
+        self.assertFalse(self.picker.wanted(512))
+        self.assertFalse(self.picker.wanted(640))
+
+    def test_nothing_wanted(self):
+        for index in range(768):
+            self.picker.have(index)
+        self.assertEqual(list(self.picker.candidates(self.has)), [])
+
+    def test_sparse_peer(self):
+        has = bitfield([0, 700, 701])  # ranked rather than walked
+        self.picker.add_pieces(has)
+        self.assertEqual(sorted(self.picker.pick(has, 2)), [700, 701])
+        self.assertEqual(sorted(self.picker.pick(has, 3)), [0, 700, 701])
+
+
+class ShuffledTest(unittest.TestCase):
+
+    def test_every_piece_once(self):
+        for indices in range(0, PIECES, 2), [3, 500, 1000]:
+            bits = bitfield(indices)
+            drawn = list(piece_picker._shuffled(bits, bits.count()))
+            self.assertEqual(sorted(drawn), list(indices))
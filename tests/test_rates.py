@@ -0,0 +1,36 @@
+import unittest
+from rates import RateMeter
+
+
+class RateMeterTest(unittest.TestCase):
+    '''A steady 1000 bytes a second, added every tenth of a second'''
+
+    def setUp(self):
+        self.now = 0.0
+        self.meter = RateMeter(window=10, buckets=10, clock=lambda: self.now)
+
+    def run_for(self, seconds):
+        for _ in range(int(seconds * 10)):
+            self.now += 0.1
+            self.meter.add(100)
+
+    def test_steady_rate_partway_through_a_bucket(self):
+        self.run_for(30.5)
+        self.assertAlmostEqual(self.meter.rate, 1000, delta=15)
+
+    def test_steady_rate_at_a_bucket_boundary(self):
+        self.run_for(30)
+        self.assertAlmostEqual(self.meter.rate, 1000, delta=15)
+
+    def test_rate_while_window_fills(self):
+        self.run_for(3.5)
+        self.assertAlmostEqual(self.meter.rate, 1000, delta=15)
+
+    def test_idle_meter(self):
+        self.run_for(5)
+        self.now += 20
+        self.assertEqual(self.meter.rate, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
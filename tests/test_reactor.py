@@ -0,0 +1,226 @@
+import gc
+import os
+import socket
+import struct
+import events
+import unittest
+import weakref
+import messages
+import torrent_exceptions
+from main import BitTorrentClient, PendingConnection
+from peer import Peer
+from reactor import Reactor
+from tests.sockets import tcp_pair, recv_exactly
+
+
+class ClientTestCase(unittest.TestCase):
+    '''A reactor client with no listening socket and one connected peer'''
+
+    def setUp(self):
+        self.client = BitTorrentClient(listen=False)
+        self.reactor = self.client._reactor
+        self.ours, self.theirs = tcp_pair()
+        self.ours.setblocking(False)  # as the client would have it
+        self.peer = Peer(self.ours, self.client)
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+        self.reactor.close()
+        self.client._waker.close()
+
+    def loop_once(self, timeout=1):
+        self.reactor.dispatch(self.reactor.poll(timeout))
+
+
+class OutboxTest(ClientTestCase):
+
+    def test_write_interest_dropped_once_outbox_drains(self):
+        self.peer.enqueue_message(messages.Interested())
+        self.assertTrue(self.reactor._masks[self.peer] & self.reactor._WRITE)
+
+        self.loop_once()
+
+        self.assertEqual(recv_exactly(self.theirs, 5), b'\x00\x00\x00\x01\x02')
+        self.assertFalse(self.peer.outbox)
+        self.assertFalse(self.reactor._masks[self.peer] &
+                         self.reactor._WRITE)
+
+
+class DisconnectTest(ClientTestCase):
+    '''Peers not yet matched to a torrent are dropped by the client'''
+
+    def assert_dropped(self):
+        for _ in range(3):
+            if self.peer not in self.reactor:
+                break
+            self.loop_once()
+        self.assertNotIn(self.peer, self.reactor)
+        self.assertFalse(self.peer.active)
+
+    def test_closed_by_peer(self):
+        self.theirs.close()
+        self.assert_dropped()
+
+    def test_reset_by_peer(self):
+        self.theirs.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                               struct.pack('ii', 1, 0))
+        self.theirs.close()
+        self.assert_dropped()
+
+    def test_dropped_peer_let_go(self):
+        self.theirs.close()
+        self.assert_dropped()
+        peer, self.peer = weakref.ref(self.peer), None
+        gc.collect()
+        self.assertIsNone(peer())
+
+
+class ConnectTest(ClientTestCase):
+    '''Peer sockets never block the loop'''
+
+    def setUp(self):
+        super(ConnectTest, self).setUp()
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.address = self.listener.getsockname()
+        self.connected = []
+
+    def tearDown(self):
+        super(ConnectTest, self).tearDown()
+        self.listener.close()
+        for peer in self.connected:
+            peer.socket.close()
+
+    def pending(self):
+        return [m for m in self.reactor._fds
+                if isinstance(m, PendingConnection)]
+
+    def test_connect_completes_on_the_loop(self):
+        self.client.connect(self.address, self.connected.append)
+        pending, = self.pending()
+        for _ in range(3):
+            if self.connected:
+                break
+            self.loop_once()
+        peer, = self.connected
+        self.assertEqual(peer.socket.gettimeout(), 0.0)
+        self.assertIn(peer, self.reactor)
+        self.assertEqual(self.pending(), [])
+        self.assertFalse(pending.timer.active)
+
+    def test_refused(self):
+        self.listener.close()
+        self.client.connect(self.address, self.connected.append)
+        for _ in range(3):
+            if not self.pending():
+                break
+            self.loop_once()
+        self.assertEqual(self.pending(), [])
+        self.assertEqual(self.connected, [])
+
+    def test_timed_out(self):
+        self.client.connect(self.address, self.connected.append)
+        pending, = self.pending()
+        pending.timer.callback()
+        self.assertEqual(self.pending(), [])
+        self.assertRaises(socket.error, pending.socket.getpeername)  # closed
+        self.loop_once(0.1)
+        self.assertEqual(self.connected, [])
+
+    def test_adopted_socket_doesnt_block(self):
+        ours, theirs = tcp_pair()
+        self.addCleanup(theirs.close)
+        peer = self.client.adopt_connection(ours)
+        self.connected.append(peer)
+        self.assertEqual(ours.gettimeout(), 0.0)
+        # far more than the socket buffers hold, with nobody reading
+        peer.outbox.push(bytearray(2**25))
+        peer.handle_outgoing()
+        self.assertTrue(peer.outbox)
+        self.assertTrue(peer.active)
+
+
+class AcceptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = BitTorrentClient(port=0)
+        self.reactor = self.client._reactor
+
+    def tearDown(self):
+        for m in list(self.reactor._fds):
+            if isinstance(m, Peer):
+                m.socket.close()
+        self.client._socket.close()
+        self.reactor.close()
+        self.client._waker.close()
+
+    def test_accepted_socket_doesnt_block(self):
+        theirs = socket.create_connection(self.client._socket.getsockname())
+        self.addCleanup(theirs.close)
+        self.reactor.dispatch(self.reactor.poll(1))
+        peer, = [m for m in self.reactor._fds if isinstance(m, Peer)]
+        self.assertEqual(peer.socket.gettimeout(), 0.0)
+
+    def test_nothing_to_accept(self):
+        self.client._accept_connection()
+        self.assertEqual(len(self.reactor), 2)  # the listener and waker
+
+
+class Pipe(object):
+    '''Read end of a pipe, as a socket manager'''
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.events = []
+
+    def fileno(self):
+        return self.read_fd
+
+    def handle_exception(self, e):
+        raise e
+
+    def close(self):
+        os.close(self.read_fd)
+
+
+class HangUpTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = Reactor()
+        self.pipe = Pipe()
+        os.close(self.pipe.write_fd)  # the read end hangs up
+
+    def tearDown(self):
+        self.reactor.close()
+        self.pipe.close()
+
+    def test_hang_up_reads_without_an_error_handler(self):
+        read = lambda: self.pipe.events.append(os.read(self.pipe.read_fd, 1))
+        self.reactor.register(self.pipe, read=read)
+        self.reactor.dispatch(self.reactor.poll(1))
+        self.assertEqual(self.pipe.events, [b''])
+
+    def test_error_handler_gets_an_exception(self):
+        self.reactor.register(self.pipe, read=lambda: None,
+                              error=self.pipe.events.append)
+        self.reactor.dispatch(self.reactor.poll(1))
+        self.assertEqual(len(self.pipe.events), 1)
+        self.assertIsInstance(self.pipe.events[0],
+                              torrent_exceptions.ConnectionLost)
+
+
+class EventTest(unittest.TestCase):
+
+    def test_missing_keyword(self):
+        with self.assertRaises(torrent_exceptions.InvalidEventCreated):
+            events.PeerDoneSending()
+
+    def test_peer_events_need_no_torrent(self):
+        events.PeerDoneSending(peer=None)
+        events.UnknownPeerHandshake(peer=None, msg=None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import unittest
+import messages
+from piece_picker import DONT_DOWNLOAD
+from tests.sockets import tcp_pair
+from tests.torrents import TorrentTestCase, python2_only
+
+
+class DownloadTestCase(TorrentTestCase):
+    '''The remote end has every piece'''
+
+    def setUp(self):
+        super(DownloadTestCase, self).setUp()
+        self.send(messages.Bitfield(self.torrent.bitfield(True).tobytes()))
+
+    def requests(self):
+        return [msg for msg in self.received()
+                if isinstance(msg, messages.Request)]
+
+    def serve(self, request):
+        self.serve_block(*request.get_triple()[:2])
+
+    def serve_block(self, index, begin):
+        start = index * self.torrent.piece_length + begin
+        length = self.torrent.blocks.length(index, begin)
+        self.send(messages.Piece(index, begin,
+                                 self.data[start:start + length]))
+
+
+@python2_only
+class RequestTest(DownloadTestCase):
+
+    def test_unchoke_sends_requests(self):
+        self.send(messages.Unchoke())
+        self.assertEqual(len(self.requests()), self.peer.request_queue_depth)
+
+    def test_unsent_requests_fill_slots(self):
+        # both top up the queue before any request goes out
+        self.send(messages.Unchoke(), messages.Have(0))
+        self.assertEqual(len(self.requests()), self.peer.request_queue_depth)
+
+    def test_block_arriving_tops_up(self):
+        self.send(messages.Unchoke())
+        first = self.requests()[0]
+        self.serve(first)
+        topped_up = self.requests()
+        self.assertTrue(topped_up)
+        self.assertNotIn(first.get_triple(),
+                         [r.get_triple() for r in topped_up])
+
+    def test_whole_download(self):
+        self.send(messages.Unchoke())
+        for _ in range(20):
+            requests = self.requests()
+            if not requests:
+                break
+            for request in requests:
+                self.serve(request)
+        self.assertEqual(self.torrent.blocks.remaining, 0)
+        self.assertFalse(self.strategy.endgame)
+        self.assertEqual(self.torrent.downloaded, self.length)
+        self.assertGreater(self.torrent.down.total, self.length)
+
+    def test_nothing_requested_from_unwanted_pieces(self):
+        self.torrent.set_file_priority(0, DONT_DOWNLOAD)
+        self.assertEqual(self.torrent.blocks.remaining, 0)
+        self.send(messages.Unchoke())
+        self.assertEqual(self.requests(), [])
+        self.assertEqual(list(self.strategy._missing_blocks()), [])
+        self.assertFalse(self.strategy.endgame)
+
+
+@python2_only
+class EndgameTest(DownloadTestCase):
+    '''Every block has been asked of the first peer; a second, fast one
+    unchokes us and is asked for duplicates'''
+
+    def setUp(self):
+        super(EndgameTest, self).setUp()
+        self.send(messages.Unchoke())
+        self.serve(self.requests()[0])
+        self.assertEqual(self.torrent.blocks.unrequested, 0)
+
+        ours, self.theirs_too = tcp_pair()
+        self.addCleanup(ours.close)
+        self.addCleanup(self.theirs_too.close)
+        self.second = self.connect(ours, self.theirs_too, fast=True)
+        self.send_from(self.theirs_too, messages.HaveAll(),
+                       messages.Unchoke())
+        self.loop_once(0)  # the duplicates go out
+        self.assertTrue(self.strategy.endgame)
+        self.assertTrue(self.second.outstanding_requests)
+        self.assertTrue(self.torrent.blocks.duplicate_bytes)
+
+    def test_choked_and_rejected(self):
+        length = self.torrent.blocks.length
+        self.send_from(self.theirs_too, messages.Choke(), *[
+            messages.RejectRequest(index, begin, length(index, begin))
+            for index, begin in self.second.outstanding_requests])
+        self.assertEqual(self.torrent.blocks.duplicate_bytes, 0)
+
+    def test_expired(self):
+        for request in self.second.outstanding_requests:
+            self.second.outstanding_requests[request] = 0
+        self.strategy._expire_requests()
+        self.assertEqual(self.torrent.blocks.duplicate_bytes, 0)
+
+    def test_dropped(self):
+        self.theirs_too.close()
+        self.loop_once()
+        self.assertFalse(self.second.active)
+        self.assertEqual(self.torrent.blocks.duplicate_bytes, 0)
+
+    def test_arrived(self):
+        for index, begin in list(self.peer.outstanding_requests):
+            self.serve_block(index, begin)
+        self.assertEqual(self.torrent.blocks.duplicate_bytes, 0)
+        self.assertFalse(self.strategy._endgame_pieces)
+
+    def test_pieces_tracked(self):
+        pieces = self.strategy._endgame_pieces
+        self.assertEqual(pieces, set(self.torrent.picker.wanted_pieces()))
+        first, last = min(pieces), max(pieces)
+        for index, begin in list(self.peer.outstanding_requests):
+            if index == first:
+                self.serve_block(index, begin)
+        self.assertNotIn(first, pieces)
+
+        self.torrent.picker.set_priority(last, DONT_DOWNLOAD)
+        self.assertNotIn(last, [index for index, _, _ in
+                                self.strategy._missing_blocks()])
+        self.assertNotIn(last, pieces)
+
+
+@python2_only
+class DropTest(DownloadTestCase):
+
+    def test_dropped_twice(self):
+        self.strategy._drop_peer(self.peer)
+        self.strategy._drop_peer(self.peer)
+        self.assert_dropped()
+        self.assertFalse(any(self.torrent.picker.availability))
+
+    def test_bad_messages_in_one_read(self):
+        self.send(messages.Request(2**20, 0, 2**14),
+                  messages.Request(2**20, 0, 2**14))
+        self.assert_dropped()
+        self.assertFalse(any(self.torrent.picker.availability))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import socket
+import unittest
+import config
+from multiprocessing import Process, Pipe
+from main import BitTorrentClient
+from supervisor import Supervisor, WorkerHandle, HandoffReceiver
+
+INFO_HASH = b'i' * 20
+
+
+class Manager(object):
+    '''Stands in for a TorrentManager, noting the peers it's offered'''
+
+    hashed_info = INFO_HASH
+
+    def __init__(self):
+        self.peers = []
+
+    def register_unknown_peer(self, peer):
+        self.peers.append(peer)
+
+
+class ThisProcess(object):
+    pid = os.getpid()
+
+
+class SupervisorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = Supervisor([], port=0)
+
+    def tearDown(self):
+        self.supervisor._socket.close()
+        self.supervisor._reactor.close()
+
+    def supervisor_loop_once(self):
+        reactor = self.supervisor._reactor
+        reactor.dispatch(reactor.poll(1))
+
+
+class HandOffTest(SupervisorTestCase):
+    '''A connection accepted by the supervisor reaches a worker client's
+    torrent manager, handshake and all'''
+
+    def setUp(self):
+        super(HandOffTest, self).setUp()
+        supervisor_end, worker_end = Pipe()
+        worker = WorkerHandle(0, ThisProcess(), supervisor_end,
+                              self.supervisor)
+        self.supervisor._watch(worker)
+        self.supervisor._owners[INFO_HASH] = worker
+
+        self.client = BitTorrentClient(listen=False)
+        self.manager = Manager()
+        self.client.managers = {self.manager}
+        receiver = HandoffReceiver(worker_end, self.client)
+        self.client.register(receiver, read=receiver.handle_incoming)
+
+    def tearDown(self):
+        super(HandOffTest, self).tearDown()
+        self.client._reactor.close()
+        self.client._waker.close()
+
+    def test_hand_off(self):
+        remote = socket.create_connection(
+            self.supervisor._socket.getsockname())
+        self.addCleanup(remote.close)
+        remote.sendall(b'\x13' + config.PROTOCOL + config.RESERVED_BYTES +
+                       INFO_HASH + b'p' * 20)
+
+        for _ in range(2):  # accept, then read the handshake
+            self.supervisor_loop_once()
+        reactor = self.client._reactor
+        reactor.dispatch(reactor.poll(1))
+
+        self.assertEqual(len(self.manager.peers), 1)
+        peer = self.manager.peers[0]
+        self.assertEqual(peer.peer_id, b'p' * 20)
+        self.assertEqual(peer.address, remote.getsockname())
+        peer.drop()
+
+
+def exit_at_once(conn):
+    conn.close()
+
+
+class WorkerExitTest(SupervisorTestCase):
+
+    def test_worker_exit_is_noticed(self):
+        supervisor_end, worker_end = Pipe()
+        process = Process(target=exit_at_once, args=(worker_end,))
+        process.start()
+        worker_end.close()
+        worker = WorkerHandle(0, process, supervisor_end, self.supervisor)
+        self.supervisor._watch(worker)
+        self.supervisor.stats[0] = {}
+
+        process.join()
+        self.supervisor_loop_once()
+
+        self.assertNotIn(worker, self.supervisor._reactor)
+        self.assertNotIn(0, self.supervisor.stats)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+from timers import TimerScheduler
+
+
+class TimerTestCase(unittest.TestCase):
+    '''A scheduler on a clock the test moves by hand'''
+
+    def setUp(self):
+        self.now = 0.0
+        self.timers = TimerScheduler(clock=lambda: self.now)
+        self.fired = []
+        self.errors = []
+
+    def add(self, delay, name, repeat=False):
+        return self.timers.add(delay, lambda: self.fired.append(name),
+                               self.errors.append, repeat=repeat)
+
+    def advance(self, seconds):
+        self.now += seconds
+        self.timers.run_due()
+
+
+class OneShotTest(TimerTestCase):
+
+    def test_fired_in_deadline_order(self):
+        for delay, name in ((3, 'c'), (1, 'a'), (2, 'b'), (1, 'a2')):
+            self.add(delay, name)
+        self.assertEqual(self.timers.time_until_next(), 1)
+        self.advance(2)
+        self.assertEqual(self.fired, ['a', 'a2', 'b'])
+        self.assertEqual(self.timers.time_until_next(), 1)
+        self.advance(1)
+        self.assertEqual(self.fired, ['a', 'a2', 'b', 'c'])
+        self.assertEqual(len(self.timers), 0)
+        self.assertIsNone(self.timers.time_until_next())
+
+    def test_overdue(self):
+        timer = self.add(1, 'a')
+        self.now = 5
+        self.assertEqual(self.timers.time_until_next(), 0)
+        self.timers.run_due()
+        self.assertFalse(timer.active)
+
+    def test_cancelled(self):
+        first, second = self.add(1, 'a'), self.add(2, 'b')
+        first.cancel()
+        first.cancel()  # twice is harmless
+        self.assertEqual(len(self.timers), 1)
+        self.assertEqual(self.timers.time_until_next(), 2)
+        self.advance(2)
+        self.assertEqual(self.fired, ['b'])
+        self.assertFalse(second.active)
+
+    def test_rescheduled(self):
+        timer = self.add(1, 'a')
+        timer.reschedule(5)
+        self.advance(1)
+        self.assertEqual(self.fired, [])
+        self.advance(4)
+        self.assertEqual(self.fired, ['a'])
+        timer.reschedule(1)  # revived once fired
+        self.assertTrue(timer.active)
+        self.advance(1)
+        self.assertEqual(self.fired, ['a', 'a'])
+
+    def test_exception_handled(self):
+        def fail():
+            raise ValueError('boom')
+        self.timers.add(1, fail, self.errors.append)
+        self.add(1, 'a')
+        self.advance(1)
+        self.assertIsInstance(self.errors[0], ValueError)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_heap_compacted(self):
+        timers = [self.add(i + 1, i) for i in range(100)]
+        for timer in timers[:90]:
+            timer.cancel()
+        self.assertLess(len(self.timers._heap), 100)
+        self.assertEqual(len(self.timers), 10)
+        self.advance(100)
+        self.assertEqual(self.fired, list(range(90, 100)))
+
+
+class RepeatTest(TimerTestCase):
+
+    def test_repeats_on_schedule(self):
+        self.add(2, 'tick', repeat=True)
+        for _ in range(3):
+            self.advance(2)
+        self.assertEqual(self.fired, ['tick'] * 3)
+        self.assertEqual(len(self.timers), 1)
+
+    def test_missed_rounds_skipped(self):
+        timer = self.add(2, 'tick', repeat=True)
+        self.advance(7)  # a stalled loop
+        self.assertEqual(self.fired, ['tick'])
+        self.assertEqual(timer.deadline, 9)
+
+    def test_cancelled_from_its_callback(self):
+        timer = self.timers.add(1, lambda: timer.cancel(), self.errors.append,
+                                repeat=True)
+        self.advance(1)
+        self.assertFalse(timer.active)
+        self.assertEqual(len(self.timers), 0)
+        self.assertIsNone(self.timers.time_until_next())
+
+    def test_needs_an_interval(self):
+        self.assertRaises(ValueError, self.add, 0, 'tick', True)
+
+
+if __name__ == '__main__':
+    unittest.main()
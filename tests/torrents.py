@@ -0,0 +1,118 @@
+import os
+import sys
+import shutil
+import socket
+import tempfile
+import config
+import unittest
+import messages
+from hashlib import sha1
+from framing import FrameDecoder
+from main import BitTorrentClient
+from peer import Peer
+from strategies import TorrentManager
+from utils import bencode
+from tests.sockets import tcp_pair
+
+'''A torrent loaded from a real metainfo file, with one peer connected
+through the reactor and past its handshake. utils.bencode speaks Python 2
+strs, so tests built on this only run there.'''
+
+python2_only = unittest.skipIf(sys.version_info[0] > 2,
+                               'utils.bencode is Python 2 only')
+
+PIECE_LENGTH = 2**15
+REMOTE_ID = b'-TS0001-' + b'0' * 12
+
+
+class TorrentTestCase(unittest.TestCase):
+    '''Two and a half pieces of data, none of which we have'''
+
+    length = PIECE_LENGTH * 5 // 2
+    fast = False  # whether the remote end offers the fast extension
+
+    def setUp(self):
+        self.data = os.urandom(self.length)
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)  # the download is written under its name
+        self.write_metainfo('test.torrent')
+
+        self.client = BitTorrentClient(listen=False)
+        self.reactor = self.client._reactor
+        self.manager = TorrentManager(self.client, 'test.torrent', None)
+        self.torrent = self.manager._torrent
+        self.strategy = self.manager._strategy
+
+        self.ours, self.theirs = tcp_pair()
+        self.decoder = FrameDecoder()  # what the remote end is sent
+        self.peer = self.connect(self.ours, self.theirs, self.fast)
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+        self.reactor.close()
+        self.client._waker.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def write_metainfo(self, filename):
+        pieces = b''.join(sha1(self.data[i:i + PIECE_LENGTH]).digest()
+                          for i in range(0, self.length, PIECE_LENGTH))
+        info = {'name': 'test.bin', 'piece length': PIECE_LENGTH,
+                'pieces': pieces, 'length': self.length}
+        with open(filename, 'wb') as f:
+            f.write(bencode({'announce': 'http://localhost/announce',
+                             'info': info}))
+
+    def connect(self, ours, theirs, fast=False):
+        '''A peer on ours, handed to the strategy and handshaken from
+        theirs'''
+        ours.setblocking(False)  # as the client would have it
+        peer = Peer(ours, self.client)
+        self.strategy._establish_contact(peer)
+        self.loop_once()  # our handshake goes out first
+        reserved = bytearray(8)
+        if fast:
+            byte, mask = config.FAST_EXTENSION_BIT
+            reserved[byte] |= mask
+        self.send_from(theirs, messages.Handshake(
+            REMOTE_ID, self.torrent.hashed_info, reserved=bytes(reserved)))
+        return peer
+
+    def send(self, *msgs):
+        self.send_from(self.theirs, *msgs)
+
+    def send_from(self, theirs, *msgs):
+        '''Sends msgs from a remote end and handles them'''
+        theirs.sendall(b''.join(m.encode() for m in msgs))
+        self.loop_once()
+        for _ in range(10):  # a block may take more than one read
+            events = self.reactor.poll(0.01)
+            if not events:
+                break
+            self.reactor.dispatch(events)
+
+    def received(self):
+        '''Messages sent to the remote end since the last call'''
+        self.loop_once(0)  # flushes the outbox
+        self.theirs.setblocking(False)
+        try:
+            while True:
+                data = self.theirs.recv(2**16)
+                if not data:
+                    break
+                self.decoder.feed(data)
+        except socket.error:
+            pass
+        return [msg for msg in self.decoder.messages()
+                if not isinstance(msg, messages.Handshake)]
+
+    def loop_once(self, timeout=1):
+        self.reactor.dispatch(self.reactor.poll(timeout))
+
+    def assert_dropped(self, peer=None):
+        peer = peer or self.peer
+        self.assertFalse(peer.active)
+        self.assertNotIn(peer.address, self.torrent.peers)
+        self.assertNotIn(peer, self.reactor)
@@ -0,0 +1,119 @@
+import heapq
+import logging
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class Timer(object):
+    '''Handle for a scheduled callback. Returned by TimerScheduler.add so
+    the owner can cancel or reschedule it.'''
+
+    __slots__ = ('callback', 'exception_handler', 'interval', 'deadline',
+                 '_scheduler', '_seq')
+
+    def __init__(self, scheduler, callback, exception_handler, interval):
+        self.callback = callback
+        self.exception_handler = exception_handler
+        self.interval = interval  # None unless repeating
+        self.deadline = None
+        self._scheduler = scheduler
+        self._seq = None  # matches the live heap entry; None once finished
+
+    @property
+    def active(self):
+        return self._seq is not None
+
+    def cancel(self):
+        self._scheduler.cancel(self)
+
+    def reschedule(self, delay):
+        self._scheduler.reschedule(self, delay)
+
+
+class TimerScheduler(object):
+    '''Binary heap of deadlines: O(log n) insert, O(1) cancel and a cheap
+    query for the time until the next deadline, which is what the event
+    loop blocks on. Cancelled entries are left in the heap and skipped when
+    they surface; the heap is rebuilt once they make up half of it.'''
+
+    def __init__(self, clock=time):
+        self._clock = clock
+        self._heap = []  # (deadline, seq, timer)
+        self._next_seq = 0
+        self._live = 0
+
+    def __len__(self):
+        return self._live
+
+    def add(self, delay, callback, exception_handler, repeat=False):
+        '''Schedules callback in delay seconds -- and every delay seconds
+        after that if repeat is set. Returns a Timer handle.'''
+        if repeat and delay <= 0:
+            raise ValueError('repeating timers need a positive interval')
+        timer = Timer(self, callback, exception_handler,
+                      delay if repeat else None)
+        self._live += 1
+        self._push(timer, self._clock() + delay)
+        return timer
+
+    def cancel(self, timer):
+        if timer._seq is None:
+            return
+        timer._seq = None
+        self._live -= 1
+
+        if len(self._heap) > 64 and self._live < len(self._heap) // 2:
+            self._heap = [entry for entry in self._heap
+                          if entry[2]._seq == entry[1]]
+            heapq.heapify(self._heap)
+
+    def reschedule(self, timer, delay):
+        '''Moves a timer's next deadline to delay seconds from now,
+        reviving it if it had already fired or been cancelled'''
+        if timer._seq is None:
+            self._live += 1
+        self._push(timer, self._clock() + delay)
+
+    def time_until_next(self):
+        '''Seconds until the earliest live deadline, 0 if one is overdue,
+        or None if nothing is scheduled'''
+        heap = self._heap
+        while heap and heap[0][2]._seq != heap[0][1]:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        return max(0, heap[0][0] - self._clock())
+
+    def run_due(self):
+        '''Fires every timer whose deadline has passed'''
+        heap, now = self._heap, self._clock()
+
+        while heap and heap[0][0] <= now:
+            deadline, seq, timer = heapq.heappop(heap)
+            if timer._seq != seq:
+                continue  # cancelled or rescheduled
+
+            if timer.interval is None:
+                timer._seq = None
+                self._live -= 1
+            else:
+                # rearm before running, so the callback may cancel it; a
+                # stalled loop skips missed rounds rather than replaying them
+                next_deadline = deadline + timer.interval
+                if next_deadline <= now:
+                    next_deadline = now + timer.interval
+                self._push(timer, next_deadline)
+
+            logger.debug('Running callback %r due at %f', timer.callback,
+                         deadline)
+            try:
+                timer.callback()
+            except Exception as e:
+                timer.exception_handler(e)
+
+    def _push(self, timer, deadline):
+        seq = self._next_seq
+        self._next_seq += 1
+        timer._seq, timer.deadline = seq, deadline
+        heapq.heappush(self._heap, (deadline, seq, timer))
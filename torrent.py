@@ -4,8 +4,13 @@ import messages
 import events
 import bitarray
 import torrent_exceptions
+from bisect import bisect_right
+from functools import partial
+from block_map import BlockMap
 from file_handler import FileHandler
+from piece_picker import PiecePicker, DONT_DOWNLOAD
 from tracker import TrackerHandler
+from rates import RateMeter
 from hashlib import sha1
 from utils import memo,  bencode,  bdecode
 
@@ -19,21 +24,23 @@ class Torrent(events.EventManager,
     doesn't make any 'decisions.' They're all handled in the Strategy
     instance.'''
 
-    def __init__(self, filename, client_id):
-        '''Opens file with context manager'''
+    def __init__(self, filename, client_id, disk=None):
+        '''Opens file with context manager. Pieces are checked and written
+        by disk, a disk_io.DiskQueue, if given.'''
         self.client_id = client_id
         self.peers = {}
-        self._cached_messages = {}
+        self._cached_messages = {}  # message type -> (args, encoded)
         self._trackers = set()
+        self.down, self.up = RateMeter(), RateMeter()  # summed over peers
 
         with io.open(filename, 'rb') as f:
             self._data = bdecode(f)
 
         # just so this init function doesn't get any bigger...
         self._calculate_properties()
-        self._file_handler = FileHandler(self.query('name'), self.files,
-                                         [p['length'] for p in self.pieces],
-                                         self.piece_hashes)
+        self._file_handler = FileHandler(self._query('name'), self.files,
+                                         self.piece_lengths,
+                                         self.piece_hashes, disk=disk)
 
         self._message_dispatch = {
             messages.Handshake: self._handshake_maker,
@@ -42,16 +49,30 @@ class Torrent(events.EventManager,
 
         self._message_handlers = {
             messages.INCOMING: {
-                messages.Have:
-                lambda msg: self._increment_frequency(msg.index),
-
+                messages.Have: self._process_have,
                 messages.Bitfield: self._process_bitfield,
-                messages.Piece: lambda m: self.file_handler.write(*m.payload)
+                messages.HaveAll:
+                lambda m: self._replace_has(m.peer, self.bitfield(True)),
+
+                messages.HaveNone:
+                lambda m: self._replace_has(m.peer, self.bitfield()),
+
+                messages.Piece: self._process_piece,
+                messages.Choke: self._process_choke,
+                messages.RejectRequest:
+                lambda m: self.blocks.release(m.index, m.begin, m.peer)
                 },
             messages.OUTGOING: {
+                messages.Cancel:
+                lambda m: self.blocks.release(m.index, m.begin, m.peer)
                 }
             }
 
+        self._event_handlers = {
+            events.HaveCompletePiece: self._piece_verified,
+            events.PieceHashFailed: self._piece_failed
+            }
+
         self._exception_handlers = {}
 
     def __str__(self):
@@ -69,75 +90,190 @@ class Torrent(events.EventManager,
             self._parse_announce_list(announce_list)
 
         self.info = self._query('info')
-        self.have = [0] * self.num_pieces
-        self.frequency = [0] * self.num_pieces
         self.hashed_info = sha1(bencode(self.info)).digest()
         self.piece_length = self._query('piece length')
 
         pieces = self._query('pieces')
         self.piece_hashes = [pieces[i:i+20] for i in range(0, len(pieces), 20)]
         self.num_pieces = len(self.piece_hashes)
+        self.have = self.bitfield()
+        self.have_count = 0
+        self.picker = PiecePicker(self.num_pieces)
 
         self.file_mode = 'multi' if 'files' in self.info else 'single'
         if self.file_mode == 'single':
-            self.files = [{'length': int(self.query('length')),
+            self.files = [{'length': int(self._query('length')),
                            'path': [self._query('name')]}]
         else:
             self.files = [{'length': int(f['length']),
                            'path': f['path']} for f in self._query('files')]
 
         self.total_length = sum(f['length'] for f in self.files)
+        self.file_priorities = [1] * len(self.files)
+        self._file_starts = []
+        start = 0
+        for f in self.files:
+            self._file_starts.append(start)
+            start += f['length']
+        self.piece_lengths = [self.piece_length] * (self.num_pieces - 1) + \
+            [self.total_length - self.piece_length * (self.num_pieces - 1)]
+
+        self.blocks = BlockMap(self.piece_lengths)
+        self.partial = set()  # pieces with some blocks but not all
+        self.wasted = 0  # bytes of blocks received more than once
+
+    def bitfield(self, value=False):
+        '''A bitarray with a bit for every piece'''
+        bits = bitarray.bitarray(self.num_pieces)
+        bits.setall(value)
+        return bits
+
+    def interesting(self, peer):
+        '''Whether peer has any piece we don't'''
+        return (peer.has & ~self.have).any()
+
+    @property
+    def complete(self):
+        return self.have_count == self.num_pieces
 
     def drop_peer(self, peer):
-        '''Procedure to disconnect from peer'''
+        '''Procedure to disconnect from peer. A peer can be dropped more
+        than once -- say a bad message, then its connection closing.'''
+        if self.peers.get(peer.address) is not peer:
+            return
         del self.peers[peer.address]
+        self.picker.remove_pieces(peer.has)
+        self.blocks.release_peer(peer)
+
+    def set_file_priority(self, file_index, priority):
+        '''Pieces take the highest priority of the files they overlap;
+        piece_picker.DONT_DOWNLOAD skips a file's pieces altogether'''
+        self.file_priorities[file_index] = priority
+        start = self._file_starts[file_index]
+        length = self.files[file_index]['length']
+        if not length:
+            return
+        first = start // self.piece_length
+        last = (start + length - 1) // self.piece_length
+        for index in range(first, last + 1):
+            piece_priority = max(self.file_priorities[f]
+                                 for f in self._files_in_piece(index))
+            self.picker.set_priority(index, piece_priority)
+            self.blocks.set_wanted(index, piece_priority != DONT_DOWNLOAD)
+
+    def _files_in_piece(self, index):
+        start = index * self.piece_length
+        end = start + self.piece_lengths[index]
+        f = bisect_right(self._file_starts, start) - 1
+        while f < len(self.files) and self._file_starts[f] < end:
+            yield f
+            f += 1
+
+    @property
+    def disk_stats(self):
+        return self._file_handler.disk.stats(self._file_handler)
+
+    @property
+    def disk_backlogged(self):
+        '''Whether enough pieces are waiting to be checked or written that
+        no more blocks should be requested'''
+        return self._file_handler.backlogged
 
     @property
     def downloaded(self):
-        return 0
-        return sum(len(piece.bytes) for piece in self._dled_pieces)
+        '''Bytes of blocks received, for the tracker. Wire bytes, with
+        message overhead, are only for rates.'''
+        return self.down.payload
 
     @property
     def uploaded(self):
-        return sum(peer.given for peer in self.peers.values())
+        '''Bytes of blocks sent, for the tracker'''
+        return self.up.payload
 
     def dispatch(self, peer, message_type, *args, **kwargs):
-        '''Handles instructing peers to send messages'''
+        '''Handles instructing peers to send messages. Makers return the
+        message and, if it's shared between peers, its encoding.'''
         try:
-            msg = self._message_dispatch[message_type](peer, *args, **kwargs)
+            maker = self._message_dispatch[message_type]
         except KeyError:
-            msg = message_type(*args, **kwargs)
-        peer.enqueue_message(msg)
+            msg, encoded = message_type(*args, **kwargs), None
+        else:
+            msg, encoded = maker(peer, *args, **kwargs)
+        peer.enqueue_message(msg, encoded)
+
+    def broadcast(self, peers, message_type, *args):
+        '''Sends the same message to several peers, encoding it just once'''
+        encoded = message_type(*args).encode()
+        for peer in peers:
+            peer.enqueue_message(message_type(*args), encoded)
+
+    def serve_request(self, peer, index, begin, length):
+        '''Queues a requested block to go from disk to the peer'''
+        peer.enqueue_piece(index, begin,
+                           self._file_handler.segments(index, begin, length))
 
     def start_tracker(self, announce_url):
         t = TrackerHandler(self, announce_url)
         t.announce('started')
         self.trackers.add(t)
 
+    def _process_have(self, msg):
+        has = msg.peer.has
+        if not has[msg.piece_index]:
+            has[msg.piece_index] = True
+            self.picker.increment(msg.piece_index)
+
     def _process_bitfield(self, msg):
-        for i, p in enumerate(msg.bitfield):
-            if p:
-                self._increment_frequency(i)
-
-    def _increment_frequency(self, index):
-        self.frequency[index] += 1
-
-    def _verify_piece_hash(self, index):
-        keys = sorted(self.piece_record[index].keys())
-        joined = ''.join(self.piece_record[index][k] for k in keys)
-        hashed = sha1(joined).digest()
-        return hashed in self.piece_hashes
-
-    def _complete_piece_callback(self, index):
-        if not self._verify_piece_hash(index):
-            self.piece_record[index] = {}
+        self._replace_has(msg.peer, msg.bitfield[:self.num_pieces])
+
+    def _replace_has(self, peer, has):
+        self.picker.remove_pieces(peer.has)
+        peer.has = has
+        self.picker.add_pieces(has)
+
+    def _process_choke(self, msg):
+        # fast peers reject each request they drop instead
+        if not msg.peer.fast:
+            self.blocks.release_peer(msg.peer)
+
+    def _process_piece(self, msg):
+        blocks = self.blocks
+        if msg.index >= self.num_pieces or msg.begin % blocks.block_size or \
+                msg.begin >= self.piece_lengths[msg.index] or \
+                len(msg.block) != blocks.length(msg.index, msg.begin) or \
+                not blocks.receive(msg.index, msg.begin):
+            self.wasted += len(msg.block)
+            return
+        self._file_handler.write(msg.index, msg.begin, msg.block)
+        if blocks.received(msg.index) < blocks.blocks_in(msg.index):
+            self.partial.add(msg.index)
+        else:  # nothing left to pick while it's checked
+            self.partial.discard(msg.index)
+            self.picker.have(msg.index)
+            self._file_handler.check_piece(
+                msg.index, partial(self._complete_piece_callback, msg.index))
+
+    def _complete_piece_callback(self, index, good):
+        event_type = events.HaveCompletePiece if good \
+            else events.PieceHashFailed
+        self.handle_event(event_type(torrent=self, index=index))
+
+    def _piece_failed(self, ev):
+        logger.info('Piece %d failed its hash check', ev.index)
+        self.blocks.reset(ev.index)
+        self.picker.lost(ev.index)
+
+    def _piece_verified(self, ev):
+        index = ev.index
+        self.blocks.verify(index)
+        self.have[index] = True
+        self.have_count += 1
+        self._cached_messages.pop(messages.Bitfield, None)
+
+        if self.complete:
+            self.strategy.download_completed(index)
         else:
-            self.have[index] = 1
-
-            if all(self.have):  # download is completed
-                self.strategy.download_completed(index)
-            else:
-                self.strategy.have_event(index)
+            self.strategy.have_event(index)
 
     def _parse_announce_list(self, announce_list):
         '''Recursive method that will make sure to get every possible Tracker
@@ -171,10 +307,28 @@ class Torrent(events.EventManager,
             raise KeyError('{} not found in torrent data.'.format(key))
 
     def _handshake_maker(self, peer):
-        return messages.Handshake(self.client_id, self.hashed_info)
+        return self._shared(messages.Handshake,
+                            lambda: (self.client_id, self.hashed_info))
 
     def _bitfield_maker(self, peer, override=None, *args):
         # enables lazy bitfield
-        have = override if override is not None else self.have
-        b = bitarray.bitarray(''.join(str(bit) for bit in have))
-        return messages.Bitfield(b.tobytes())
+        if override is not None:
+            return messages.Bitfield(override.tobytes()), None
+        if peer.fast and self.complete:
+            return messages.HaveAll(), None
+        if peer.fast and not self.have_count:
+            return messages.HaveNone(), None
+        # encoded once until a piece completes
+        return self._shared(messages.Bitfield,
+                            lambda: (self.have.tobytes(),))
+
+    def _shared(self, message_type, make_args):
+        '''A fresh message for one peer, with arguments and an encoding
+        shared by all'''
+        try:
+            args, encoded = self._cached_messages[message_type]
+        except KeyError:
+            args = make_args()
+            encoded = message_type(*args).encode()
+            self._cached_messages[message_type] = args, encoded
+        return message_type(*args), encoded
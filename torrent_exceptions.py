@@ -20,20 +20,12 @@ class UnhandledSocketEvent(Exception):
     pass
 
 
-class DoNotSendException(Exception):
+class InvalidEventCreated(Exception):
     pass
 
 
-class LeftoverException(Exception):
-    def __init__(self, message='', value=None):
-        self.leftover = value
-        super(LeftoverException, self).__init__(message)
-
-
-class RanDryException(Exception):
-    def __init__(self, message='', value=None):
-        self.unused = value
-        super(RanDryException, self).__init__(message)
+class DoNotSendException(Exception):
+    pass
 
 
 class MessageParsingError(Exception):
@@ -48,6 +40,12 @@ class MessageException(Exception):
         super(MessageException, self).__init__(text)
 
 
+class ConnectionLost(Exception):
+    '''The peer closed the connection or the socket failed. The reactor
+    raises it without a peer; the peer fills itself in.'''
+    def __init__(self, text='', peer=None):
+        self.peer = peer
+        super(ConnectionLost, self).__init__(text)
 
 
 class FatallyFlawedIncomingMessage(MessageException):
@@ -1,5 +1,7 @@
 from functools import partial
-import struct, torrent_exceptions, io
+from hashlib import sha1
+import socket
+import struct
 
 def memo(f):
     cache = {}
@@ -11,9 +13,6 @@ def memo(f):
             return cache[args]
     return g
 
-def prop_and_memo(f):
-    return property(memo(f))
-
 def bencode(whole):
     '''Takes a data structure and bencodes it'''
 
@@ -94,9 +93,18 @@ def parse_peer_string(p_string):
         peers.append((ip,port))
     return peers
 
-class StreamReader(io.BytesIO):
-    def read(self,n=None):
-        text = super(StreamReader,self).read(n)
-        if n and len(text) != n:
-            raise torrent_exceptions.RanDryException(value=text)
-        return text
+def allowed_fast_set(ip, info_hash, num_pieces, k):
+    '''The canonical BEP 6 allowed fast set for an IPv4 peer'''
+    k = min(k, num_pieces)
+    allowed = []
+    x = struct.pack('>I', struct.unpack('>I', socket.inet_aton(ip))[0]
+                    & 0xFFFFFF00) + info_hash
+    while len(allowed) < k:
+        x = sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(allowed) == k:
+                break
+            index = struct.unpack('>I', x[i:i+4])[0] % num_pieces
+            if index not in allowed:
+                allowed.append(index)
+    return allowed